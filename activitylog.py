@@ -1,5 +1,5 @@
-from datetime import datetime
-import sys
+from datetime import datetime, timedelta
+import sys, os, time, json, threading
 
 class ActivityLog:
     DEBUG = 3
@@ -17,24 +17,50 @@ class ActivityLog:
     log_fd = None
     log_level = 2 # Solo errores
 
+    # Segundos entre cada línea de progreso. 0 no las muestra.
+    progress_interval = 0
+
+    def __init__(self):
+        # Métricas: (nombre, etiquetas) => valor
+        self.metrics = {}
+        self.start_time = time.time()
+
+        # Las rutas se copian en paralelo: cada una tiene su progreso
+        # (inicio, siguiente línea), y los contadores y las líneas del
+        # registro usan el lock. Es reentrante porque el manejador de Ctrl-C
+        # también escribe en el registro.
+        self._progress = {}
+        self._lock = threading.RLock()
+
     def set_log_level(self, log_level):
         self.log_level = log_level
         return self
 
     def set_log_file(self, log_file):
-        self.log_fd = open(log_file, "a", 0)
+        # Un buffer por línea, para que el fichero esté al día si se corta
+        self.log_fd = open(log_file, "a", 1)
+        return self
+
+    def set_progress_interval(self, seconds):
+        self.progress_interval = seconds
         return self
 
     def log(self, level, message, set_date = False):
         # Añadimos la fecha, de ser necesario
         message ="{} {}".format(datetime.now(), message)
 
-        # Siempre guardamos todos los mensajes en el fichero de registro
-        if self.log_fd:
-            self.log_fd.write(message + "\n")
+        # Los nombres de fichero mal codificados llegan con 'surrogateescape',
+        # y no se pueden imprimir. Los mostramos como '\udcxx'.
+        message = message.encode('utf-8', 'backslashreplace').decode('utf-8')
+
+        # Con varios hilos, las líneas no se deben mezclar
+        with self._lock:
+            # Siempre guardamos todos los mensajes en el fichero de registro
+            if self.log_fd:
+                self.log_fd.write(message + "\n")
 
-        if level <= self.log_level:
-            print(message)
+            if level <= self.log_level:
+                print(message)
 
     def debug(self, message, set_date = False):
         self.log(self.DEBUG, message, set_date)
@@ -52,3 +78,83 @@ class ActivityLog:
         ''' Igual que 'error', pero acaba el programa '''
         self.error(message, set_date)
         sys.exit(1)
+
+    # Métricas
+
+    def count(self, name, value = 1, **labels):
+        ''' Suma 'value' a un contador '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.metrics[key] = self.metrics.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        ''' Fija el valor de una métrica '''
+        self.metrics[(name, tuple(sorted(labels.items())))] = value
+
+    def get(self, name, **labels):
+        return self.metrics.get((name, tuple(sorted(labels.items()))), 0)
+
+    def progress(self, label, files, copied_bytes, expected_files = None):
+        ''' Muestra una línea de progreso cada 'progress_interval' segundos.
+        Se llama por cada fichero, así que casi siempre solo compara la hora.
+        'expected_files' es la cantidad aproximada de ficheros (e.g. los de
+        la copia anterior), para calcular el tiempo restante. '''
+        if not self.progress_interval:
+            return
+
+        now = time.monotonic()
+        progress = self._progress.get(label)
+
+        if progress is None:
+            self._progress[label] = [now, now + self.progress_interval]
+            return
+
+        if now < progress[1]:
+            return
+
+        progress[1] = now + self.progress_interval
+        elapsed = now - progress[0]
+
+        message = '{}: {} ficheros, {:.1f} MB copiados ({:.1f} MB/s)'.format(
+            label, files, copied_bytes / 1048576, copied_bytes / 1048576 / elapsed)
+
+        if expected_files and files < expected_files:
+            remaining = elapsed * (expected_files - files) / files
+            message += ', {:.0%}, quedan unos {}'.format(files / expected_files, timedelta(seconds = int(remaining)))
+
+        self.info(message)
+
+    def reset_progress(self, label):
+        self._progress.pop(label, None)
+
+    def write_metrics(self, filename):
+        ''' Graba las métricas. Si el fichero acaba en '.prom' usa el formato
+        de texto de Prometheus (para el 'textfile collector' de
+        node_exporter), y lo reemplaza de forma atómica. Si no, añade una
+        línea JSON por métrica. '''
+        if filename.endswith('.prom'):
+            tmp_filename = filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                f.write(self._prometheus())
+            os.replace(tmp_filename, filename)
+        else:
+            now = time.time()
+            with open(filename, 'a') as f:
+                for (name, labels), value in self.metrics.items():
+                    f.write(json.dumps({'time': now, 'metric': name, 'labels': dict(labels), 'value': value}) + '\n')
+
+    def _prometheus(self):
+        lines = []
+        seen = set()
+
+        for (name, labels), value in sorted(self.metrics.items(), key = lambda m: m[0][0]):
+            name = 'backup_' + name
+
+            if name not in seen:
+                lines.append('# TYPE {} {}'.format(name, 'counter' if name.endswith('_total') else 'gauge'))
+                seen.add(name)
+
+            label_text = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+            lines.append('{}{} {}'.format(name, '{' + label_text + '}' if label_text else '', value))
+
+        return '\n'.join(lines) + '\n'
@@ -15,91 +15,1700 @@ Debería de trabaja en cualquier distro de Linux con Python > 3.2
 https://github.com/drmad/backup.py
 '''
 
-import subprocess, sys, re, os
-import gzip, bz2, shutil, stat
-import time, activitylog, json
+import sys, os
+import stat
+import time, activitylog, json, fileindex, compressors, scanner, exclude, fastcopy, snapshot, retention, chunkstore, restore, iosched, storage, sparse, renames, changejournal, packs, verify, plan
+import collections, concurrent.futures, signal, contextlib, threading, random
 
 from datetime import datetime, timedelta
 
 VERSION = 0.2
 METADATA_FILENAME = ".backup.metadata"
 
+# Sufijo de los ficheros que se están copiando
+TEMPORARY_SUFFIX = ".backup-tmp"
+
 # Parámetros por defecto, con su ayuda.
 DEFAULT_PARAMETERS = dict(
     paths = ("Rutas donde buscar ficheros.", []),
-    target = ("Ruta destino, donde se guardará la copia de respaldo.", ''),
-    compressor = ("Algoritmo de compresión: 'gzip', 'bzip', o '' (solo copia).", 'gzip'),
+    target = ("Ruta destino, donde se guardará la copia de respaldo. Puede ser un bucket de S3: 's3://bucket/prefijo'.", ''),
+    s3_endpoint = ("URL de un servicio compatible con S3, e.g. MinIO. '' usa la variable de entorno BACKUP_S3_ENDPOINT, o AWS.", ''),
+    part_size = ("Tamaño en MB de cada parte de las subidas a S3.", 8),
+    compressor = ("Algoritmo de compresión: 'gzip', 'bzip', 'zstd', 'lz4', 'chunks' (trozos deduplicados), o '' (solo copia).", 'gzip'),
+    compress_level = ("Nivel de compresión. 'None' usa el nivel por defecto de cada compresor.", None),
+    zstd_threads = ("Hilos que usa zstd para comprimir cada fichero. 0 no usa hilos.", 0),
+    codec_policy = ("Compresor por extensión de fichero, e.g. {'.log': 'zstd'}. Se puede usar 'store' para guardar sin comprimir.", {}),
     exclude = ("Patrones de exclusión.", []),
     full_backup = ("¿Generar una copia de respaldo completa? 'False' crea un copia de respaldo incremental.", False),
     historic_backup = ("¿Genera un copia de respaldo histórica? 'True' crea una subcarpeta por cada copia de respaldo.", False),
-    follow_symlinks = ("¿'find' debe seguir enlaces simbólicos?", False),
+    snapshot = ("¿Crear cada copia histórica como clon de la anterior (snapshot de btrfs, reflinks o enlaces duros), y aplicarle solo los cambios?", True),
+    historic_backup_dir = ("Nombre del directorio para la copia histórica. '' usa la fecha y hora actual.", ''),
+    restore = ("Carpeta donde restaurar la copia del destino. 'False' hace una copia.", False),
+    restore_filter = ("Patrones de los ficheros a restaurar. Vacío restaura todos.", []),
+    verify = ("¿Verificar que los ficheros de la copia se pueden leer y coinciden con el índice, en vez de hacer una copia?", False),
+    verify_sample = ("Porcentaje de los ficheros, elegidos al azar, que lee --verify.", 100),
+    plan = ("Fichero JSON donde grabar el plan de la copia, sin copiar nada. 'False' hace la copia.", False),
+    execute_plan = ("Fichero JSON con el plan que grabó --plan: solo se escanean los directorios con cambios. 'False' escanea todo el origen.", False),
+    prune = ("¿Borrar las copias históricas que no conserva la política de retención, y los trozos que ya no se usan?", False),
+    keep_last = ("Copias históricas más recientes que se conservan al borrar.", 0),
+    keep_daily = ("Cantidad de días de los que se conserva la copia histórica más reciente.", 0),
+    keep_weekly = ("Cantidad de semanas de las que se conserva la copia histórica más reciente.", 0),
+    keep_monthly = ("Cantidad de meses de los que se conserva la copia histórica más reciente.", 0),
+    resume = ("¿Continuar la copia histórica interrumpida, en vez de empezar una nueva?", False),
+    checkpoint_interval = ("Segundos entre cada punto de control, que graba en el índice los ficheros ya copiados.", 300),
+    verify_index = ("¿Ignorar el índice y volver a escanear el destino?", False),
+    checksum = ("¿Comparar el contenido de los ficheros cuyo stat cambió, antes de copiarlos?", False),
+    follow_symlinks = ("¿Seguir los enlaces simbólicos al escanear?", False),
+    scan_threads = ("Número de hilos para escanear los directorios de origen.", 1),
+    jobs = ("Número de ficheros a copiar y comprimir en paralelo.", 1),
+    block_threshold = ("Tamaño en MB a partir del cual un fichero se comprime por bloques en paralelo (con 'jobs' mayor que 1).", 64),
+    bwlimit = ("Velocidad máxima de lectura del origen, en MB/s. 0 no la limita.", 0),
+    iops = ("Lecturas por segundo máximas del origen. 0 no las limita.", 0),
+    max_load = ("Carga media del sistema a partir de la cual se pausa la lectura del origen. 0 no la comprueba.", 0),
+    journal = ("Carpeta del diario de cambios del origen, que graba --watch. '' escanea siempre todo el origen.", ''),
+    watch = ("¿Vigilar las rutas de origen y anotar sus cambios en el diario, en vez de hacer una copia?", False),
+    pack_threshold = ("Tamaño en KB por debajo del cual los ficheros de cada directorio se guardan juntos en un paquete. 0 no los agrupa.", 0),
+    drop_cache = ("¿Descartar de la caché de páginas los ficheros del origen ya leídos?", True),
     debug_level = ("Nivel de depuración (0 a 2)", 1),
     debug_file = ("Fichero de mensajes de depuración. 'False' los muestra por STDOUT.", False),
+    stats_file = ("Fichero JSON donde grabar las estadísticas de la copia. 'False' no las graba.", False),
+    metrics_file = ("Fichero de métricas: líneas JSON, o formato de Prometheus si acaba en '.prom'. 'False' no las graba.", False),
+    progress_interval = ("Segundos entre cada línea de progreso. 0 no las muestra.", 60),
 )
 
-# Logger
-logger = activitylog.ActivityLog()
+# Logger
+logger = activitylog.ActivityLog()
+
+def is_excluded (path):
+    return exclude_matcher.match_file(path)
+
+def is_dir_excluded (path):
+    return exclude_matcher.match_dir(path)
+
+def header(prepend = ''):
+    ''' Devuelve una cabecera para imprimir '''
+    h = prepend + 'backup.py v{} - Generador de copias de seguridad incrementales.\n'.format(VERSION)
+    h += prepend + 'por Oliver Etchebarne Bejarano\n'
+    h += prepend + 'https://drmad.org\n'
+
+    return h
+
+def timed (iterable, phases, phase):
+    ''' Recorre 'iterable', sumando a phases[phase] el tiempo que tarda en
+    devolver cada elemento '''
+    iterator = iter(iterable)
+
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            phases[phase] += time.perf_counter() - start
+            return
+
+        phases[phase] += time.perf_counter() - start
+        yield item
+
+def scan_errors (path, error):
+    logger.warning('No pude leer {} ({}).'.format(path, str(error)))
+
+def clone_errors (path, error):
+    logger.warning('No pude enlazar {} en la copia nueva ({}).'.format(path, str(error)))
+
+def forget_lost (registry, lost_targets):
+    ''' Quita del registro los ficheros que faltan en el clon de la copia
+    anterior: 'lost_targets' son los nombres en el destino de los ficheros y
+    directorios que no se pudieron enlazar. Devuelve una tupla (registro,
+    ficheros quitados). '''
+    lost_targets = set(lost_targets)
+
+    def is_lost(target_name):
+        while target_name:
+            if target_name in lost_targets:
+                return True
+            target_name = target_name.rpartition('/')[0]
+
+        return '.' in lost_targets
+
+    lost = [filename for filename, entry in registry.items() if is_lost(entry['target'])]
+
+    if lost:
+        # El registro puede ser el del índice, que sigue siendo el de la
+        # copia anterior
+        registry = registry.copy()
+        for filename in lost:
+            del registry [ filename ]
+
+    return registry, lost
+
+def scan_files (path):
+    ''' Escanea la ruta, y devuelve sus ficheros con su stat, a medida que los
+    encuentra '''
+    if not exclude_matcher:
+        return scanner.scan_tree(path, P['follow_symlinks'], None, scan_errors, P['scan_threads'])
+
+    return scanner.scan_tree(path, P['follow_symlinks'], is_excluded, scan_errors, P['scan_threads'], is_dir_excluded)
+
+def journal_files (path, changes, registry, new_registry, erase_list):
+    ''' Como scan_files, pero solo escanea los directorios que cambiaron
+    según el diario de cambios, o según el plan de --execute-plan. Los ficheros del registro que están fuera de
+    ellos no cambiaron: pasan directamente a new_registry. Devuelve una tupla
+    (ficheros escaneados, cantidad de ficheros sin cambios). '''
+    dir_excluded = {}
+
+    def excluded(filename):
+        if is_excluded(filename):
+            return True
+
+        # Algún directorio padre excluido, quizás desde la copia anterior
+        dirname = filename.rpartition('/')[0]
+        while dirname:
+            if dirname not in dir_excluded:
+                dir_excluded[dirname] = is_dir_excluded(dirname)
+            if dir_excluded[dirname]:
+                return True
+            dirname = dirname.rpartition('/')[0]
+
+        return False
+
+    unchanged = 0
+    recheck = []
+
+    for filename, entry in registry.items():
+        if changes.covers(filename) or (exclude_matcher and excluded(filename)):
+            continue
+
+        # Si ahora se guarda con otro compresor, lo volvemos a comprobar
+        if entry['target'] != target_name_for(filename, codec_for(filename)) and not (P['pack_threshold'] and packs.is_pack(entry['target'])):
+            recheck.append(filename)
+            continue
+
+        new_registry [ filename ] = entry
+        del erase_list[filename]
+        unchanged += 1
+
+    def files():
+        if exclude_matcher:
+            yield from changes.scan(path, scanner, P['follow_symlinks'], is_excluded, is_dir_excluded, scan_errors)
+        else:
+            yield from changes.scan(path, scanner, P['follow_symlinks'], None, None, scan_errors)
+
+        for filename in recheck:
+            try:
+                yield filename, os.stat(os.path.join(path, filename), follow_symlinks = False)
+            except OSError as e:
+                scan_errors(os.path.join(path, filename), e)
+
+    return files(), unchanged
+
+def codec_for (filename):
+    ''' Devuelve el compresor para un fichero, según su extensión '''
+    if codec_policy:
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in codec_policy:
+            return codec_policy[extension]
+
+    return default_codec
+
+def target_name_for (filename, codec):
+    ''' Nombre del fichero en el destino '''
+    return filename + codec.extension if codec else filename
+
+def registry_from_target (target_files, indexed = None, root = None):
+    ''' Convierte los ficheros escaneados en el destino a un registro
+    indexado por el nombre del fichero de origen. Si se pasa el índice
+    anterior, reutiliza sus checksums cuando el fichero no ha variado. Los
+    paquetes de ficheros pequeños se leen de 'root', la carpeta escaneada. '''
+    registry = fileindex.Registry()
+
+    for target_name, st in target_files:
+        # Restos de una copia interrumpida
+        if target_name.endswith(TEMPORARY_SUFFIX):
+            continue
+
+        # Cada fichero del paquete, con su fecha
+        if root and packs.is_pack(target_name):
+            try:
+                reader = packs.PackReader(os.path.join(root, target_name))
+            except (OSError, ValueError) as e:
+                logger.warning('No pude leer el paquete {} ({}).'.format(target_name, str(e)))
+                continue
+
+            dirname = target_name[:-len(packs.PACK_FILENAME)]
+            for member in reader.names():
+                name = dirname + member
+                member_st = reader.stat(member)
+
+                old_entry = indexed.get(name) if indexed else None
+                if old_entry and old_entry['target'] == target_name and old_entry['mtime_ns'] == member_st.st_mtime_ns:
+                    registry [ name ] = old_entry
+                else:
+                    registry [ name ] = fileindex.target_entry(member_st, target_name)
+
+            continue
+
+        name = target_name
+
+        # Sin compresión, el nombre es el mismo que en el origen
+        if default_codec:
+            for extension in compressors.EXTENSIONS:
+                if target_name.endswith(extension):
+                    name = target_name[:-len(extension)]
+                    break
+
+        old_entry = indexed.get(name) if indexed else None
+        if old_entry and old_entry['target'] == target_name and old_entry['mtime_ns'] == st.st_mtime_ns:
+            registry [ name ] = old_entry
+        else:
+            registry [ name ] = fileindex.target_entry(st, target_name)
+
+    if indexed is not None:
+        missing = sum(1 for name in indexed if name not in registry)
+        if missing:
+            logger.warning('{} ficheros del índice no existen en el destino.'.format(missing))
+
+    return registry
+
+
+def load_registry (path, target_scan_path):
+    ''' El registro de la copia anterior de 'path': del índice, si corresponde
+    a esa copia, o escaneando 'target_scan_path' en el destino '''
+    indexed = index.get(path, MD.get('last_historic_dir', '') if P['historic_backup'] else '')
+
+    if indexed is not None and not P['verify_index']:
+        return indexed
+
+    logger.info('{}: Escaneando destino...'.format(path))
+    if target_storage.remote:
+        target_files = target_storage.scan(target_scan_path, scan_errors)
+    else:
+        target_files = scan_files (target_scan_path)
+
+    return registry_from_target(target_files, indexed, None if target_storage.remote else target_scan_path)
+
+def backup_file (source_filename, target_filename, st, codec):
+    ''' Copia un fichero al destino, comprimiéndolo si corresponde, y le
+    aplica los permisos, el dueño y las fechas de 'st', el stat del escaneo.
+    Se puede ejecutar en un hilo de trabajo, así que no escribe en el
+    registro de actividad: devuelve una tupla (copiado, checksum, errores,
+    métricas), donde las métricas son los bytes escritos y los segundos que
+    tardaron los datos y los metadatos. '''
+    errors = []
+    metrics = {'written': 0, 'data': 0, 'metadata': 0}
+    phase_start = time.perf_counter()
+
+    # Creamos la carpeta destino, si no existe. Con algo de suerte,
+    # podemos ignorar tranquilamente los errores
+    try:
+        os.makedirs(os.path.dirname(target_filename))
+    except Exception as e :
+        pass
+
+    # Si falla la copia, el fichero no entra en el registro, y se
+    # volverá a intentar en la siguiente ejecución.
+    copied = True
+    checksum = None
+
+    # Comprimimos?
+    if codec:
+        target_filename += codec.extension
+
+    # Escribimos en un fichero temporal, que se renombra al terminar. Si la
+    # copia se interrumpe, en el destino queda el fichero anterior entero,
+    # nunca uno a medias. Además, no hace falta darle permiso de escritura
+    # al fichero anterior: se reemplaza, no se modifica.
+    final_filename = target_filename
+    target_filename = temporary_name(final_filename)
+
+    if codec:
+        # Intentamos abrir el fichero
+        try:
+            hasher = fileindex.new_checksum()
+
+            with open (source_filename, 'rb') as source_fd:
+                extents = sparse.sparse_extents(source_fd.fileno(), st)
+
+                # De los ficheros dispersos solo se leen las zonas con datos
+                if extents is not None:
+                    with codec.open(target_filename, 'wb') as target_fd:
+                        sparse.write(source_fd.fileno(), target_fd, st.st_size, extents, io_scheduler.throttle if io_scheduler.limited else None, hasher)
+                    io_scheduler.done(source_fd.fileno())
+
+                # Los ficheros grandes se comprimen por bloques, en paralelo
+                elif block_pool and codec.compress_block and st.st_size >= P['block_threshold'] * 1048576:
+                    with open(target_filename, 'wb') as target_fd:
+                        compressors.compress_blocks(io_scheduler.reader(source_fd), target_fd, codec.compress_block, block_pool, hasher, P['jobs'] * 2)
+                else:
+                    with codec.open(target_filename, 'wb') as target_fd:
+                        source_fd = io_scheduler.reader(source_fd)
+
+                        # Si hay más de un bloque, se comprime y se escribe en
+                        # otro hilo mientras leemos el siguiente
+                        if st.st_size > 9216000:
+                            writer = iosched.WriteBehind(target_fd)
+                        else:
+                            writer = contextlib.nullcontext(target_fd)
+
+                        # Procesamos en 9000k a la vez (10 chunks de 900k,
+                        # el usado por la máxima compresión del gzip. Debe de
+                        # ser igual para bzip2)
+                        with writer as target_fd:
+                            while 1:
+                                data = source_fd.read(9216000)
+                                hasher.update(data)
+                                count = target_fd.write (data)
+                                if count == 0:
+                                    break;
+
+            checksum = hasher.hexdigest()
+            metrics['written'] = os.stat(target_filename).st_size
+
+        except Exception as e:
+            copied = False
+            errors.append('No pude copiar ({}).'.format(str(e)))
+
+        metrics['data'] = time.perf_counter() - phase_start
+
+        # Después de copiar, actualizamos permisos, dueño y fechas
+        if copied:
+            phase_start = time.perf_counter()
+            try:
+                fastcopy.apply_metadata(target_filename, st, source_filename)
+            except Exception as e:
+                # No pudimos cambiarle de permisos!
+                errors.append('No pude copiar permisos ni dueño ({}).'.format(str(e)))
+            metrics['metadata'] = time.perf_counter() - phase_start
+
+    else:
+        # Sin compresión, el kernel copia los datos (o los comparte, con un
+        # reflink) y los metadatos se aplican sobre el mismo descriptor. Los
+        # huecos de los ficheros dispersos se mantienen.
+        try:
+            with open (source_filename, 'rb') as source_fd, open (target_filename, 'wb') as target_fd:
+                fastcopy.copy_data(source_fd.fileno(), target_fd.fileno(), st.st_size, io_scheduler.throttle if io_scheduler.limited else None, sparse.is_sparse(st))
+                io_scheduler.done(source_fd.fileno())
+                metrics['written'] = st.st_size
+                metrics['data'] = time.perf_counter() - phase_start
+                phase_start = time.perf_counter()
+
+                try:
+                    fastcopy.apply_metadata(target_fd.fileno(), st, source_filename)
+                except Exception as e:
+                    errors.append('No pude copiar permisos ni dueño ({}).'.format(str(e)))
+
+                metrics['metadata'] = time.perf_counter() - phase_start
+        except Exception as e:
+            copied = False
+            errors.append('No pude copiar ({}).'.format(str(e)))
+
+    try:
+        if copied:
+            os.replace(target_filename, final_filename)
+        else:
+            os.unlink(target_filename)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        copied = False
+        errors.append('No pude renombrar el fichero temporal ({}).'.format(str(e)))
+
+    return copied, checksum, errors, metrics
+
+def upload_file (source_filename, target_filename, st, codec):
+    ''' Como backup_file, para un destino remoto: los datos comprimidos se
+    suben a medida que se generan, sin fichero temporal, y los permisos, el
+    dueño y las fechas se guardan como metadatos del objeto. Si la subida
+    falla, el objeto anterior queda intacto. '''
+    errors = []
+    metrics = {'written': 0, 'data': 0, 'metadata': 0}
+    phase_start = time.perf_counter()
+    hasher = fileindex.new_checksum()
+
+    if codec:
+        target_filename += codec.extension
+
+    try:
+        with open(source_filename, 'rb') as source_fd, target_storage.open_write(target_filename, st) as upload:
+            extents = sparse.sparse_extents(source_fd.fileno(), st) if codec else None
+            source_fd = io_scheduler.reader(source_fd)
+
+            if extents is not None:
+                with codec.open(upload, 'wb') as target_fd:
+                    sparse.write(source_fd.fileno(), target_fd, st.st_size, extents, io_scheduler.throttle if io_scheduler.limited else None, hasher)
+            elif block_pool and codec and codec.compress_block and st.st_size >= P['block_threshold'] * 1048576:
+                compressors.compress_blocks(source_fd, upload, codec.compress_block, block_pool, hasher, P['jobs'] * 2)
+            else:
+                with (codec.open(upload, 'wb') if codec else contextlib.nullcontext(upload)) as target_fd:
+                    while True:
+                        data = source_fd.read(9216000)
+                        if not data:
+                            break
+
+                        hasher.update(data)
+                        target_fd.write(data)
+
+        metrics['written'] = upload.written
+    except Exception as e:
+        errors.append('No pude subir ({}).'.format(str(e)))
+        return False, None, errors, metrics
+
+    metrics['data'] = time.perf_counter() - phase_start
+
+    return True, hasher.hexdigest(), errors, metrics
+
+def backup_pack (source_path, target_filename, files):
+    ''' Escribe un paquete de ficheros pequeños (ver packs.py) en un
+    temporal, que se renombra al terminar. Se puede ejecutar en un hilo de
+    trabajo: devuelve una tupla (escrito, checksums, errores, métricas),
+    donde los errores son tuplas (fichero, error). '''
+    phase_start = time.perf_counter()
+    tmp_filename = temporary_name(target_filename)
+
+    try:
+        os.makedirs(os.path.dirname(target_filename), exist_ok = True)
+        checksums, errors, metrics = packs.write_pack(source_path, files, tmp_filename, pack_level,
+            io_scheduler.throttle if io_scheduler.limited else None)
+        os.replace(tmp_filename, target_filename)
+    except Exception as e:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+
+        return False, {}, [(None, 'No pude escribir el paquete ({}).'.format(str(e)))], {'written': 0, 'read': 0, 'data': time.perf_counter() - phase_start}
+
+    metrics['data'] = time.perf_counter() - phase_start
+    return True, checksums, errors, metrics
+
+def backup_packs (path, target_path, target_scan_path, packer, new_registry, erase_list, errors, in_place):
+    ''' Escribe los paquetes de ficheros pequeños que cambiaron, y registra
+    sus ficheros. Los paquetes sin cambios se dejan como están, o se enlazan
+    desde la copia anterior si no es 'in_place'. Devuelve los contadores
+    ('new', 'updated', 'bytes', 'errors') y el conjunto de paquetes que
+    quedan en el destino, que no hay que borrar. '''
+    counters = collections.Counter()
+    live_packs = set()
+    pending = collections.deque()
+
+    def finish (limit):
+        while len(pending) > limit:
+            pack, files, previous, result = pending.popleft()
+            if isinstance(result, concurrent.futures.Future):
+                if result.cancelled():
+                    continue
+                result = result.result()
+
+            copied, checksums, pack_errors, metrics = result
+
+            logger.count('worker_seconds_total', metrics['data'], path = path, phase = 'data')
+
+            for filename, error in pack_errors:
+                logger.warning('{}: {}'.format(filename or pack, error))
+                errors.append((filename or pack, error))
+
+            if copied:
+                logger.count('codec_bytes_in_total', metrics['read'], codec = 'pack')
+                logger.count('codec_bytes_out_total', metrics['written'], codec = 'pack')
+                logger.count('codec_seconds_total', metrics['data'], codec = 'pack')
+
+                for filename, st in files:
+                    if filename in checksums:
+                        new_registry [ filename ] = fileindex.new_entry(st, pack, checksums[filename])
+
+                        # Si antes se guardaba aparte, se borra
+                        if filename in previous:
+                            del erase_list[filename]
+                    else:
+                        counters['errors'] += 1
+
+                live_packs.add(pack)
+            else:
+                counters['errors'] += len(files)
+
+                # Queda el paquete anterior, con los ficheros como estaban
+                if previous and in_place:
+                    for filename, st in files:
+                        if filename in previous:
+                            new_registry [ filename ] = previous[filename]
+                            del erase_list[filename]
+
+                    live_packs.add(pack)
+
+    for pack, files, previous, changed in packer.changes():
+        if stop_requested:
+            break
+
+        if not changed and not in_place:
+            try:
+                target_storage.link(os.path.join(target_scan_path, pack), os.path.join(target_path, pack))
+            except Exception as e:
+                logger.warning('No pude enlazar {} ({}).'.format(pack, str(e)))
+                changed = True
+
+        if not changed:
+            for filename, st in files:
+                new_registry [ filename ] = previous[filename]
+                del erase_list[filename]
+
+            live_packs.add(pack)
+            continue
+
+        for filename, st in files:
+            if filename not in erase_list:
+                counters['new'] += 1
+            elif filename not in previous or fileindex.stat_changed(previous[filename], st):
+                counters['updated'] += 1
+            else:
+                continue
+
+            counters['bytes'] += st.st_size
+
+        logger.debug("EMPAQUETANDO {} ({} ficheros)...".format(pack, len(files)))
+
+        if pool:
+            pending.append((pack, files, previous, pool.submit(backup_pack, path, os.path.join(target_path, pack), files)))
+        else:
+            pending.append((pack, files, previous, backup_pack(path, os.path.join(target_path, pack), files)))
+
+        finish(max_pending)
+
+    if stop_requested:
+        for pack, files, previous, result in pending:
+            if isinstance(result, concurrent.futures.Future):
+                result.cancel()
+
+    finish(0)
+
+    return counters, live_packs
+
+def temporary_name (filename):
+    ''' Nombre del fichero temporal mientras se copia 'filename' '''
+    head, tail = os.path.split(filename)
+    return os.path.join(head, '.' + tail + TEMPORARY_SUFFIX)
+
+def remove_temporary (path):
+    ''' Borra los ficheros temporales que dejó una copia interrumpida '''
+    for filename, st in scanner.scan_tree(path, False, None, scan_errors):
+        if filename.endswith(TEMPORARY_SUFFIX):
+            logger.debug('BORRANDO temporal {}...'.format(filename))
+            try:
+                os.unlink(os.path.join(path, filename))
+            except OSError as e:
+                logger.warning('No pude eliminar {} ({}).'.format(filename, str(e)))
+
+def same_content (entry, source_filename, target_filename, st, plain = False):
+    ''' Modo --checksum: el stat del fichero cambió, pero ¿cambió su
+    contenido? 'plain' indica que la copia está sin comprimir. Devuelve una
+    tupla (sin cambios, checksum). '''
+    stored = entry.get('checksum')
+
+    # Sin checksum en el índice (copias con -n, o índices reconstruidos
+    # escaneando el destino), una copia sin comprimir se puede leer para
+    # calcularlo. Si el contenido es el mismo, el checksum queda en el índice
+    # y la próxima vez ya no hace falta. Una comprimida se vuelve a copiar.
+    if not stored:
+        if not plain or target_storage.remote:
+            return False, None
+
+        try:
+            stored = fileindex.file_checksum(target_filename)
+        except OSError:
+            return False, None
+
+    try:
+        checksum = fileindex.file_checksum(source_filename)
+    except OSError:
+        return False, None
+
+    if checksum != stored:
+        return False, checksum
+
+    # El contenido es el mismo, pero quizás cambiaron los permisos o el
+    # dueño. En las copias históricas el fichero está enlazado con la copia
+    # anterior, así que no lo podemos modificar: hay que copiarlo.
+    try:
+        target_st = target_storage.stat(target_filename)
+
+        if (target_st.st_mode, target_st.st_uid, target_st.st_gid) != (st.st_mode, st.st_uid, st.st_gid):
+            # Los metadatos de un objeto de S3 tampoco se pueden modificar
+            if P['historic_backup'] or target_storage.remote:
+                return False, checksum
+
+            os.chown(target_filename, st.st_uid, st.st_gid)
+            os.chmod(target_filename, stat.S_IMODE(st.st_mode))
+    except OSError:
+        return False, checksum
+
+    return True, checksum
+
+def start_copy (pending, path, target_path, filename, st, codec, target_name, checksum = None):
+    ''' Empieza la copia de un fichero, en un hilo de trabajo si hay. El
+    resultado queda en 'pending'. '''
+    target_filename = os.path.join (target_path, filename)
+    source_filename = os.path.join(path, filename)
+
+    job = (filename, fileindex.new_entry(st, target_name, checksum), codec.name if codec else 'none')
+
+    if pool:
+        pending.append((job, pool.submit(copy_file, source_filename, target_filename, st, codec)))
+    else:
+        pending.append((job, copy_file(source_filename, target_filename, st, codec)))
+
+def move_target (old_filename, new_filename, st, in_place):
+    ''' Mueve un fichero del destino a su nuevo nombre, o lo enlaza desde la
+    copia histórica anterior si no es 'in_place'. Devuelve False si no se
+    pudo, o si cambiaron sus permisos o su dueño: hay que copiarlo. '''
+    try:
+        target_st = target_storage.stat(old_filename)
+        if (target_st.st_mode, target_st.st_uid, target_st.st_gid) != (st.st_mode, st.st_uid, st.st_gid):
+            return False
+
+        # Encontrado por checksum, con otra fecha. Solo se la podemos cambiar
+        # a un fichero local que no comparte el inodo con otra copia.
+        touch = target_st.st_mtime_ns != st.st_mtime_ns
+        if touch and (P['historic_backup'] or target_storage.remote):
+            return False
+
+        if in_place:
+            target_storage.rename(old_filename, new_filename)
+        else:
+            target_storage.link(old_filename, new_filename)
+
+        if touch:
+            os.utime(new_filename, ns = (st.st_atime_ns, st.st_mtime_ns))
+    except Exception as e:
+        logger.warning('No pude mover {} a {} ({}).'.format(old_filename, new_filename, str(e)))
+        return False
+
+    return True
+
+def checkpoint (path, registry, new_registry):
+    ''' Graba en el índice los ficheros ya copiados de 'path' '''
+    with index_lock:
+        if historic_path:
+            # La copia anterior sigue siendo la última completa
+            index.set_partial(path, historic_path, new_registry.copy())
+        else:
+            # En el destino están los ficheros ya copiados, y los que aún no
+            # procesamos, sin cambios. Si cambió el nombre en el destino de
+            # un fichero copiado (e.g. cambió el compresor), el anterior
+            # sigue en el destino: se borra en la siguiente copia. Los
+            # paquetes se reescriben al final, así que no se tocan.
+            superseded = []
+            for filename, entry in new_registry.items():
+                previous = registry.get(filename)
+                if previous and previous['target'] != entry['target'] and not packs.is_pack(previous['target']):
+                    superseded.append(previous['target'])
+
+            files = registry.copy()
+            files.update(new_registry)
+            index.set(path, '', files, superseded)
+
+        try:
+            index.save()
+        except Exception as e:
+            logger.warning('No pude grabar el índice de ficheros ({}).'.format(str(e)))
+
+def prune ():
+    ''' Borra las copias históricas que no conserva la política de
+    retención, y luego los trozos que ya no usa ningún manifiesto '''
+    keep = {rule: P['keep_' + rule] for rule, period in retention.RULES}
+    generations = MD.get('generations', {})
+    threads = max(4, P['jobs'])
+
+    if generations and not any(keep.values()):
+        logger.warning('No hay una política de retención (--keep-*): no se borra ninguna copia histórica.')
+    elif generations:
+        kept = retention.kept_generations(generations, keep)
+
+        # Nunca borramos la última copia, ni una interrumpida
+        kept.add(MD.get('last_historic_dir'))
+        if 'in_progress' in MD:
+            kept.add(MD['in_progress']['dir'])
+
+        expired = sorted(name for name in generations if name not in kept)
+
+        if expired:
+            logger.info('Borrando {} copias históricas: {}'.format(len(expired), ', '.join(expired)))
+            phase_start = time.perf_counter()
+
+            if target_storage.remote:
+                # Los objetos de S3 no comparten datos: se libera todo
+                remover = retention.TreeRemover()
+                for name in expired:
+                    files, reclaimed = target_storage.remove_tree(os.path.join(P['target'], name))
+                    remover.files += files
+                    remover.reclaimed += reclaimed
+            else:
+                remover = retention.TreeRemover(threads, scan_errors)
+                remover.remove([os.path.join(P['target'], name) for name in expired if os.path.isdir(os.path.join(P['target'], name))])
+
+            for name in expired:
+                del generations[name]
+
+            # Las rutas cuya última copia se borró ya no tienen índice
+            for path, data in list(index.paths.items()):
+                if data['dir'] in expired:
+                    del index.paths[path]
+            for path, data in list(index.partial.items()):
+                if data['dir'] in expired:
+                    index.clear_partial(path)
+
+            save_metadata()
+            try:
+                index.save()
+            except Exception as e:
+                logger.warning('No pude grabar el índice de ficheros ({}).'.format(str(e)))
+
+            logger.info('Borradas {} copias históricas, {} ficheros. Liberados {:.1f} MB; {} ficheros siguen enlazados desde otras copias. Duración: {}'.format(
+                len(expired), remover.files, remover.reclaimed / 1048576, remover.still_shared(), timedelta(seconds = time.perf_counter() - phase_start)))
+
+            logger.count('pruned_generations_total', len(expired))
+            logger.count('pruned_files_total', remover.files)
+            logger.count('reclaimed_bytes_total', remover.reclaimed)
+        else:
+            logger.info('No hay copias históricas por borrar.')
+
+    # Los trozos que ya no usa ningún manifiesto
+    if os.path.isdir(os.path.join(P['target'], chunkstore.CHUNKS_DIRNAME)):
+        roots = [entry.path for entry in os.scandir(P['target'])
+            if entry.is_dir(follow_symlinks = False) and entry.name != chunkstore.CHUNKS_DIRNAME]
+
+        try:
+            removed, reclaimed = chunkstore.ChunkStore(P['target']).collect_garbage(roots, lambda e: logger.warning(str(e)))
+        except RuntimeError as e:
+            logger.warning('No se borró ningún trozo. {}'.format(str(e)))
+        else:
+            logger.info('Borrados {} trozos sin usar. Liberados {:.1f} MB.'.format(removed, reclaimed / 1048576))
+            logger.count('reclaimed_bytes_total', reclaimed)
+
+def restore_backup ():
+    ''' Restaura la copia del destino en P['restore']. Devuelve el código de
+    salida del programa. '''
+    generation = P['historic_backup_dir'] or MD.get('last_historic_dir', '')
+    root = os.path.join(P['target'], generation)
+
+    if not os.path.isdir(root):
+        logger.fail('No existe la copia {}.'.format(root))
+
+    logger.info('Restaurando {} en {}.'.format(root, P['restore']))
+    start_time = time.time()
+
+    # El nombre original de cada fichero de la copia, según el índice
+    original_names = {}
+    for path, data in index.paths.items():
+        if data['dir'] == generation:
+            for name, entry in data['files'].items():
+                original_names[os.path.join(path[1:], entry['target'])] = os.path.join(path[1:], name)
+
+    try:
+        restore_filter = restore.RestoreFilter(P['restore_filter'])
+    except ValueError as e:
+        logger.fail(str(e))
+
+    # Sin la carpeta de trozos, el índice, ni los temporales
+    def is_excluded (filename):
+        return filename.endswith(TEMPORARY_SUFFIX) or ('/' not in filename and filename.startswith('.backup.') and filename != packs.PACK_FILENAME)
+
+    def is_dir_excluded (dirname):
+        return dirname == chunkstore.CHUNKS_DIRNAME
+
+    # La descompresión libera el GIL: por defecto, un hilo por núcleo
+    jobs = P['jobs'] if P['jobs'] > 1 else (os.cpu_count() or 1)
+    restore_pool = concurrent.futures.ThreadPoolExecutor(jobs) if jobs > 1 else None
+
+    codecs = {}
+    pending = collections.deque()
+    c_files = 0
+    c_bytes = 0
+    errors = []
+
+    def process (limit):
+        nonlocal c_files, c_bytes
+
+        while len(pending) > limit:
+            name, result = pending.popleft()
+            if restore_pool:
+                result = result.result()
+
+            restored, written, file_errors = result
+
+            if restored:
+                c_files += 1
+                c_bytes += written
+
+            for error in file_errors:
+                logger.warning('{}: {}'.format(name, error))
+                errors.append((name, error))
+
+    for filename, st in scanner.scan_tree(root, False, is_excluded, scan_errors, P['scan_threads'], is_dir_excluded):
+        # Los ficheros de un paquete se restauran uno por uno
+        if packs.is_pack(filename):
+            try:
+                reader = packs.PackReader(os.path.join(root, filename))
+            except (OSError, ValueError) as e:
+                errors.append((filename, 'No pude leer el paquete ({}).'.format(str(e))))
+                continue
+
+            dirname = filename[:-len(packs.PACK_FILENAME)]
+            for member in reader.names():
+                name = dirname + member
+                if not restore_filter(name):
+                    continue
+
+                logger.debug('RESTAURANDO {}...'.format(name))
+                target_filename = os.path.join(P['restore'], name)
+
+                if restore_pool:
+                    pending.append((name, restore_pool.submit(restore.restore_packed, reader, member, target_filename)))
+                else:
+                    pending.append((name, restore.restore_packed(reader, member, target_filename)))
+
+                process(jobs * 2)
+
+            continue
+
+        name = original_names.get(filename)
+
+        # Sin índice, igual que al escanear el destino: quitamos la extensión
+        # del compresor
+        if name is None:
+            name = filename
+            if P['compressor']:
+                for extension in compressors.EXTENSIONS:
+                    if filename.endswith(extension):
+                        name = filename[:-len(extension)]
+                        break
+
+        if not restore_filter(name):
+            continue
+
+        codec = None
+        if name != filename:
+            extension = filename[len(name):]
+            if extension not in codecs:
+                try:
+                    codecs[extension] = compressors.codec_for_extension(filename, P['target'])
+                except ValueError as e:
+                    codecs[extension] = None
+                    logger.warning(str(e))
+
+            codec = codecs[extension]
+            if codec is None:
+                errors.append((name, 'No hay un compresor para {}.'.format(extension)))
+                continue
+
+        logger.debug('RESTAURANDO {}...'.format(name))
+
+        source_filename = os.path.join(root, filename)
+        target_filename = os.path.join(P['restore'], name)
+
+        if restore_pool:
+            pending.append((name, restore_pool.submit(restore.restore_file, source_filename, target_filename, st, codec)))
+        else:
+            pending.append((name, restore.restore_file(source_filename, target_filename, st, codec)))
+
+        process(jobs * 2)
+        logger.progress('Restaurando', c_files, c_bytes)
+
+    process(0)
+
+    if restore_pool:
+        restore_pool.shutdown()
+
+    elapsed = time.time() - start_time
+    logger.info('Restauración finalizada. {} ficheros, {:.1f} MB ({:.1f} MB/s), {} errores. Duración: {}'.format(
+        c_files, c_bytes / 1048576, c_bytes / 1048576 / elapsed if elapsed else 0, len(errors), timedelta(seconds = elapsed)))
+
+    logger.count('restored_files_total', c_files)
+    logger.count('restored_bytes_total', c_bytes)
+    logger.gauge('restore_seconds', elapsed)
+    if P['metrics_file']:
+        try:
+            logger.write_metrics(P['metrics_file'])
+        except OSError as e:
+            logger.warning('No pude grabar las métricas ({}).'.format(str(e)))
+
+    if errors:
+        logger.warning('{} errores:'.format(len(errors)))
+        for name, error in sorted(errors):
+            logger.warning('  {}: {}'.format(name, error))
+        return 1
+
+    return 0
+
+def verify_backup ():
+    ''' Verifica que los ficheros de la copia del destino se pueden leer, y
+    que su contenido es el que se copió. Devuelve el código de salida del
+    programa. '''
+    generation = P['historic_backup_dir'] or MD.get('last_historic_dir', '')
+    root = os.path.join(P['target'], generation)
+
+    if not os.path.isdir(root):
+        logger.fail('No existe la copia {}.'.format(root))
+
+    logger.info('Verificando {}{}.'.format(root, ' ({}% de los ficheros)'.format(P['verify_sample']) if P['verify_sample'] < 100 else ''))
+    start_time = time.time()
+
+    # Lo que debería haber en la copia, según el índice: los ficheros por
+    # su nombre en el destino, y los de los paquetes por su nombre original
+    expected = {}
+    packed = {}
+    for path, data in index.paths.items():
+        if data['dir'] == generation:
+            for name, entry in data['files'].items():
+                if packs.is_pack(entry['target']):
+                    packed[os.path.join(path[1:], name)] = entry
+                else:
+                    expected[os.path.join(path[1:], entry['target'])] = entry
+
+    def is_excluded (filename):
+        return filename.endswith(TEMPORARY_SUFFIX) or ('/' not in filename and filename.startswith('.backup.') and filename != packs.PACK_FILENAME)
+
+    def is_dir_excluded (dirname):
+        return dirname == chunkstore.CHUNKS_DIRNAME
+
+    # La lectura del destino pasa por el planificador, para poder verificar
+    # sin afectar a otros servicios (--bwlimit, --iops, --max-load)
+    scheduler = iosched.IOScheduler(P['bwlimit'] * 1048576, P['iops'], P['max_load'], P['drop_cache'])
+
+    jobs = P['jobs'] if P['jobs'] > 1 else (os.cpu_count() or 1)
+    verify_pool = concurrent.futures.ThreadPoolExecutor(jobs) if jobs > 1 else None
+
+    codecs = {}
+    pending = collections.deque()
+    c_files = 0
+    c_bytes = 0
+    errors = []
+
+    def sampled ():
+        return P['verify_sample'] >= 100 or random.random() * 100 < P['verify_sample']
+
+    def submit (name, function, *args):
+        if verify_pool:
+            pending.append((name, verify_pool.submit(function, *args)))
+        else:
+            pending.append((name, function(*args)))
+
+        process(jobs * 2)
+
+    def process (limit):
+        nonlocal c_files, c_bytes
+
+        while len(pending) > limit:
+            name, result = pending.popleft()
+            if verify_pool:
+                result = result.result()
+
+            size, error = result
+            c_files += 1
+            c_bytes += size
+
+            if error:
+                logger.warning('DAÑADO {}: {}'.format(name, error))
+                errors.append((name, error))
+
+    for filename, st in scanner.scan_tree(root, False, is_excluded, scan_errors, P['scan_threads'], is_dir_excluded):
+        if packs.is_pack(filename):
+            try:
+                reader = packs.PackReader(os.path.join(root, filename))
+            except (OSError, ValueError) as e:
+                logger.warning('DAÑADO {}: Ilegible ({}).'.format(filename, str(e)))
+                errors.append((filename, 'Ilegible ({}).'.format(str(e))))
+
+                # Sus ficheros están, pero dañados: no los contamos como
+                # que faltan
+                dirname = filename[:-len(packs.PACK_FILENAME)]
+                for name in [name for name in packed if name.startswith(dirname) and '/' not in name[len(dirname):]]:
+                    del packed[name]
+                continue
+
+            dirname = filename[:-len(packs.PACK_FILENAME)]
+            for member in reader.names():
+                entry = packed.pop(dirname + member, None)
+                if sampled():
+                    submit(dirname + member, verify.verify_packed, reader, member, entry, scheduler)
+
+            continue
+
+        entry = expected.pop(filename, None)
+        if not sampled():
+            continue
+
+        codec = None
+        extension = os.path.splitext(filename)[1]
+        if P['compressor'] and extension in compressors.EXTENSION_CODECS:
+            if extension not in codecs:
+                try:
+                    codecs[extension] = compressors.codec_for_extension(filename, P['target'])
+                except ValueError as e:
+                    codecs[extension] = None
+                    logger.warning(str(e))
+
+            codec = codecs[extension]
+            if codec is None:
+                errors.append((filename, 'No hay un compresor para {}.'.format(extension)))
+                continue
+
+        logger.debug('VERIFICANDO {}...'.format(filename))
+        submit(filename, verify.verify_file, os.path.join(root, filename), codec, entry, scheduler)
+
+        logger.progress('Verificando', c_files, c_bytes)
+
+    process(0)
+
+    if verify_pool:
+        verify_pool.shutdown()
+
+    # Los que están en el índice, pero no en la copia
+    missing = sorted(expected) + sorted(packed)
+    for name in missing:
+        logger.warning('FALTA {}'.format(name))
+        errors.append((name, 'No existe en la copia.'))
+
+    elapsed = time.time() - start_time
+    logger.info('Verificación finalizada. {} ficheros, {:.1f} MB ({:.1f} MB/s), {} dañados, {} faltan. Duración: {}'.format(
+        c_files, c_bytes / 1048576, c_bytes / 1048576 / elapsed if elapsed else 0, len(errors) - len(missing), len(missing), timedelta(seconds = elapsed)))
+
+    logger.count('verified_files_total', c_files)
+    logger.count('verified_bytes_total', c_bytes)
+    logger.count('verify_errors_total', len(errors) - len(missing), kind = 'corrupt')
+    logger.count('verify_errors_total', len(missing), kind = 'missing')
+    logger.gauge('verify_seconds', elapsed)
+    logger.gauge('io_throttled_seconds', scheduler.waited)
+    if P['metrics_file']:
+        try:
+            logger.write_metrics(P['metrics_file'])
+        except OSError as e:
+            logger.warning('No pude grabar las métricas ({}).'.format(str(e)))
+
+    return 1 if errors else 0
+
+def plan_path (path):
+    ''' Escanea una ruta de origen y la compara con la copia anterior, como
+    backup_path, pero sin copiar nada. Devuelve su parte del plan. '''
+    path = os.path.abspath(path)
+
+    target_scan_path = os.path.join(P['target'], path[1:])
+    if P['historic_backup']:
+        target_scan_path = os.path.join(P['target'], MD['last_historic_dir'], path[1:]) if 'last_historic_dir' in MD else None
+
+    registry = fileindex.Registry()
+    if target_scan_path and not P['full_backup']:
+        registry = load_registry(path, target_scan_path)
+
+    logger.info('{}: Escaneando origen...'.format(path))
+
+    new = []
+    updated = []
+    deleted = registry.remaining()
+    c_files = 0
+    c_bytes = 0
+    codec_bytes = collections.Counter()
+
+    for filename, st in scan_files(path):
+        c_files += 1
+        deleted.pop(filename, None)
+
+        entry = registry.get(filename)
+        codec = codec_for(filename)
+
+        # El mismo nombre en el destino que le daría backup_path
+        if P['pack_threshold'] and codec is default_codec and st.st_size < P['pack_threshold'] * 1024:
+            target_name = packs.pack_name(filename)
+            codec_name = 'pack'
+        else:
+            target_name = target_name_for(filename, codec)
+            codec_name = codec.name if codec else 'none'
+
+        # Los movidos se cuentan como nuevos: para saberlo habría que leerlos
+        if entry is None:
+            new.append([filename, st.st_size])
+        elif entry['target'] != target_name or fileindex.stat_changed(entry, st):
+            updated.append([filename, st.st_size])
+        else:
+            continue
+
+        c_bytes += st.st_size
+        codec_bytes[codec_name] += st.st_size
+
+        logger.progress(path, c_files, c_bytes, len(registry))
+
+    logger.reset_progress(path)
+    logger.info('{}: {} ficheros: {} nuevos, {} actualizados, {} borrados, {:.1f} MB por leer.'.format(
+        path, c_files, len(new), len(updated), len(deleted), c_bytes / 1048576))
+
+    return {
+        'new': sorted(new),
+        'updated': sorted(updated),
+        'deleted': sorted(deleted),
+        'unchanged': c_files - len(new) - len(updated),
+        'bytes': c_bytes,
+        'codecs': dict(codec_bytes),
+    }
+
+def plan_backup ():
+    ''' Graba el plan de la copia en el fichero de --plan, sin copiar nada.
+    Devuelve el código de salida del programa. '''
+    start_time = time.time()
+
+    backup_plan = {
+        'version': plan.VERSION,
+        'created': datetime.now().isoformat(timespec = 'seconds'),
+        'target': plan.normalize_target(P['target']),
+        'historic': P['historic_backup'],
+        'base': MD.get('last_backup'),
+        'interrupted': 'in_progress' in MD,
+        'paths': {},
+    }
+
+    codec_bytes = collections.Counter()
+    for path in P['paths']:
+        planned = plan_path(path)
+        backup_plan['paths'][os.path.abspath(path)] = planned
+        codec_bytes.update(planned['codecs'])
+
+    backup_plan['files'] = sum(len(planned['new']) + len(planned['updated']) for planned in backup_plan['paths'].values())
+    backup_plan['bytes'] = sum(codec_bytes.values())
+    backup_plan['estimated_seconds'] = plan.estimate(codec_bytes, MD.get('throughput', {}), P['jobs'], P['bwlimit'] * 1048576)
+
+    try:
+        plan.save(P['plan'], backup_plan)
+    except OSError as e:
+        logger.fail('No pude grabar el plan en {} ({}).'.format(P['plan'], str(e)))
+
+    if backup_plan['estimated_seconds'] is None:
+        estimated = 'desconocida, no hay medidas de copias anteriores'
+    else:
+        estimated = str(timedelta(seconds = round(backup_plan['estimated_seconds'])))
+
+    logger.info('Plan grabado en {}. {} ficheros por copiar, {:.1f} MB por leer. Duración estimada de la copia: {}. Duración: {}'.format(
+        P['plan'], backup_plan['files'], backup_plan['bytes'] / 1048576, estimated, timedelta(seconds = time.time() - start_time)))
+
+    return 0
+
+def save_metadata ():
+    ''' Graba la metadata de forma atómica '''
+    target_storage.write(metadata_file, json.dumps(MD).encode())
+
+def request_stop (signum, frame):
+    ''' Ctrl-C o SIGTERM: terminamos el fichero en curso, y grabamos un
+    punto de control. La segunda vez salimos inmediatamente. '''
+    global stop_requested
+
+    if stop_requested:
+        raise KeyboardInterrupt
+
+    stop_requested = True
+    logger.warning('Interrumpiendo la copia. Pulsa Ctrl-C otra vez para salir sin grabar el punto de control.')
+
+def process_results (pending, limit, new_registry, errors, path):
+    ''' Procesa en orden los trabajos de 'pending' hasta dejar como máximo
+    'limit' en la cola. Los elementos de 'pending' son tuplas (trabajo,
+    resultado), donde el trabajo es (fichero, entrada, compresor) y el
+    resultado puede ser un Future. Devuelve la cantidad de ficheros que
+    fallaron. '''
+    failed = 0
+
+    while len(pending) > limit:
+        (filename, entry, codec_name), result = pending.popleft()
+
+        if isinstance(result, concurrent.futures.Future):
+            # Cancelado al interrumpir la copia. Se copiará la próxima vez.
+            if result.cancelled():
+                continue
+
+            result = result.result()
+
+        copied, checksum, file_errors, metrics = result
+
+        # Los tiempos de los hilos de trabajo se suman: son segundos de
+        # trabajo, no de reloj
+        logger.count('worker_seconds_total', metrics['data'], path = path, phase = 'data')
+        logger.count('worker_seconds_total', metrics['metadata'], path = path, phase = 'metadata')
+
+        if copied:
+            logger.count('codec_bytes_in_total', entry['size'], codec = codec_name)
+            logger.count('codec_bytes_out_total', metrics['written'], codec = codec_name)
+            logger.count('codec_seconds_total', metrics['data'], codec = codec_name)
+
+        # Sin compresión no se calcula el checksum al copiar
+        if checksum:
+            entry['checksum'] = checksum
+
+        for error in file_errors:
+            logger.warning('{}: {}'.format(filename, error))
+            errors.append((filename, error))
+
+        # Y actualizamos el fichero de registro
+        if copied:
+            new_registry [ filename ] = entry
+        else:
+            failed += 1
+
+    return failed
+
+
+def backup_path (path):
+    ''' Copia una ruta de origen al destino. Las rutas de distintos discos se
+    copian a la vez, cada una en su hilo. Devuelve False si la copia se
+    interrumpió. '''
+
+    # El path tiene que estar en ABSOLUTO.
+    path = os.path.abspath(path)
+
+    # Grabamos el momento que se inició la copia de respaldo.
+    start_time = time.time()
+
+    # Tiempo de cada fase, en segundos
+    phases = collections.Counter()
+
+
+    # Calculamnos la carpeta destino, dependiendo
+    # si quieremos solo una, o toda la ruta completa
+
+    # 'path' contiene la ruta absoluta del fichero que
+    # queremos. Le removemos el 1er slash para que
+    # os.path.join no descarte los parámetros anteriores
+    # (http://docs.python.org/3.2/library/os.path.html#os.path.join)
+    target_path = os.path.join(P['target'], historic_path, path[1:])
+
+    # La copia histórica empieza como un clon de la anterior, y luego solo
+    # se le aplican los cambios. Si está a medias (--resume), ya existe.
+    snapshot_method = None
+    clone_lost = []
+    if P['historic_backup'] and P['snapshot'] and 'last_historic_dir' in MD and not os.path.exists(target_path):
+        previous_path = os.path.join(P['target'], MD['last_historic_dir'], path[1:])
+
+        if os.path.isdir(previous_path):
+            logger.info('{}: Clonando la copia anterior...'.format(path))
+            phase_start = time.perf_counter()
+
+            try:
+                snapshot_method, clone_lost = snapshot.clone_tree(previous_path, target_path, max(4, P['jobs']), clone_errors)
+                logger.info('{}: Copia anterior clonada ({}).'.format(path, snapshot_method))
+            except Exception as e:
+                # Seguimos enlazando fichero por fichero
+                logger.warning('{}: No pude clonar la copia anterior ({}).'.format(path, str(e)))
+
+            phases['snapshot'] = time.perf_counter() - phase_start
+
+    # Creamos la carpeta destino siempre.
+    try:
+        if P['historic_backup'] and P['snapshot']:
+            snapshot.create_tree(target_path)
+        else:
+            target_storage.makedirs(target_path)
+    except:
+        pass
+
+    # Los ficheros temporales que dejó la copia interrumpida. En S3, las
+    # subidas a medias nunca llegan a ser objetos.
+    if interrupted and not target_storage.remote:
+        interrupted_path = os.path.join(P['target'], interrupted['dir'], path[1:])
+        if os.path.isdir(interrupted_path):
+            remove_temporary(interrupted_path)
+
+    # Esta ruta ya se terminó de copiar antes de la interrupción
+    if resuming and index.get(path, historic_path) is not None:
+        logger.info('{}: Ya se había copiado.'.format(path))
+        return True
+
+    # Luego escaneamos el destino, si no pide un full_backup
+    registry = fileindex.Registry()
+
+    # scan_path puede ser target_path para backups regulares
+    # o el anterior directorio creado, para historicos-
+    target_scan_path = target_path
 
-def is_excluded (path):
-    for regexp in P['exclude_regexp']:
+    if P['historic_backup']:
+        if 'last_historic_dir' in MD:
+            target_scan_path = os.path.join(P['target'], MD['last_historic_dir'], path[1:])
+        else:
+            target_scan_path = None
 
-        if regexp.search(path):
-            return True
+    # Los ficheros del destino que reemplazó una copia interrumpida, antes
+    # de que se escanee el destino
+    if not P['historic_backup']:
+        for target_name in index.get_superseded(path):
+            logger.debug("BORRANDO {}...".format(target_name))
+            try:
+                target_storage.remove(os.path.join(target_path, target_name))
+            except Exception as e:
+                logger.warning('No pude eliminar {} ({}).'.format(target_name, str(e)))
 
-def header(prepend = ''):
-    ''' Devuelve una cabecera para imprimir '''
-    h = prepend + 'backup.py v{} - Generador de copias de seguridad incrementales.\n'.format(VERSION)
-    h += prepend + 'por Oliver Etchebarne Bejarano\n'
-    h += prepend + 'https://drmad.org\n'
+    if not target_scan_path:
+        logger.info('{}: Primer backup. Usando backup total'.format(path))
+    elif not P['full_backup']:
+        phase_start = time.perf_counter()
+        registry = load_registry(path, target_scan_path)
+        phases['scan_target'] = time.perf_counter() - phase_start
+
+    # Los ficheros que no se pudieron enlazar en el clon no están en la
+    # copia nueva: se vuelven a copiar, como nuevos
+    lost = []
+    if clone_lost:
+        registry, lost = forget_lost(registry, clone_lost)
+
+    # Con el diario de cambios, solo se escanean los directorios que
+    # cambiaron desde la copia anterior. Se toma siempre, para que los
+    # cambios ya copiados no se vuelvan a escanear.
+    change_journal = None
+    changes = None
+    if P['journal']:
+        change_journal = changejournal.ChangeJournal(P['journal'], path, P['target'])
 
-    return h
+        try:
+            changes = change_journal.begin()
+        except OSError as e:
+            logger.warning('{}: No pude leer el diario de cambios ({}).'.format(path, str(e)))
+            change_journal = None
+
+        # Los ficheros sin cambios tienen que estar ya en el destino, y
+        # el vigilante no sigue los enlaces simbólicos
+        if changes is not None and (not registry or lost or P['follow_symlinks'] or (P['historic_backup'] and not snapshot_method)):
+            changes = None
+
+        if changes is not None:
+            logger.info('{}: Usando el diario de cambios: {} directorios cambiados.'.format(path, len(changes.dirs) + len(changes.trees)))
+        elif change_journal:
+            logger.info('{}: El diario de cambios no sirve para esta copia. Escaneando todo el origen.'.format(path))
+
+    # Con --execute-plan, solo se escanean los directorios donde el plan
+    # encontró cambios. Como con el diario, los ficheros sin cambios tienen
+    # que estar ya en el destino.
+    if backup_plan:
+        changes = plan.changes(backup_plan, path)
+
+        if changes is not None and (lost or (P['historic_backup'] and not snapshot_method)):
+            changes = None
+
+        if changes is not None:
+            logger.info('{}: Usando el plan: {} directorios con cambios.'.format(path, len(changes.dirs)))
+        else:
+            logger.info('{}: El plan no sirve para esta ruta. Escaneando todo el origen.'.format(path))
 
-def scan_files (path):
-    ''' Escanea la ruta, y devuelve sus ficheros con su timestamp '''
+    # El origen se escanea a medida que copiamos
+    logger.info('{}: Escaneando origen. Destino: "{}", iniciando copia.'.format ( path, target_path))
 
-    # Si no existe la ruta, salimos
-    if not os.path.exists ( path ):
-        return {}
+    # Aquí irá el registro con los nuevos timestamps. Solo añadimos los
+    # ficheros que efectivamente están en el destino. Los ficheros sin
+    # cambios solo ocupan un byte.
+    new_registry = fileindex.Registry(base = registry)
 
-    try:
-        raw = subprocess.check_output(
-          ['find', '-L' if P['follow_symlinks'] else '-P', path, '-type', 'f', '-printf', '%T@ %P\n']
-        )
-    except subprocess.CalledProcessError as e:
-        logger.fail("El proceso 'find' devolvió error. Saliendo")
+    # Aqui quedarán los ficheros por borrar: una vista del registro, sin
+    # copiarlo
+    erase_list = registry.remaining()
 
-    try:
-        filelist = raw.decode('utf-8').splitlines()
-    except UnicodeDecodeError as e:
-        # Vamos a mostrar mas o menos dónde está el error
-        pos_match = re.search('position ([0-9]+):', str(e))
+    # Los ficheros ya copiados en la copia histórica interrumpida
+    resumed = (index.get_partial(path, historic_path) if resuming else None) or {}
+    next_checkpoint = time.monotonic() + P['checkpoint_interval']
+
+    # Los ficheros nuevos que pueden ser ficheros movidos se copian al final,
+    # cuando ya sabemos cuáles desaparecieron del origen
+    rename_detector = renames.RenameDetector(registry)
+    deferred = []
+
+    # Los ficheros pequeños se agrupan por directorio, y al final del escaneo
+    # se escriben los paquetes que cambiaron
+    packer = packs.Packer(P['pack_threshold'] * 1024, registry) if P['pack_threshold'] else None
+
+    # Contadores
+    c_new = 0
+    c_updated = 0
+    c_moved = 0
+    c_deleted = 0
+    c_old = 0
+    c_errors = 0
+    c_files = 0
+    c_bytes = 0
+    c_resumed = 0
+
+    # Los trabajos de copia pendientes, y los errores de esta ruta
+    pending = collections.deque()
+    errors = []
+
+    # Los que faltan en el clon cuentan como errores, aunque se copien
+    for filename in lost:
+        errors.append((filename, 'No se pudo enlazar en la copia nueva.'))
+    c_errors += len(lost)
+
+
+    if changes is None:
+        source_files = scan_files (path)
+    else:
+        source_files, c_files = journal_files(path, changes, registry, new_registry, erase_list)
+
+    # Escaneamos sus ficheros
+    phase_start = time.perf_counter()
+    for filename, st in timed(source_files, phases, 'scan_source'):
+        if stop_requested:
+            break
+
+        c_files += 1
+
+        # No existe, o ha variado?
+        copy = False
+
+        # Hardlink para historic_backup?
+        hardlink = False
+
+        entry = registry.get(filename)
+        codec = codec_for(filename)
+        target_name = target_name_for(filename, codec)
+        checksum = None
+
+        # Ya está en la copia que estamos continuando
+        if resumed:
+            done = resumed.get(filename)
+            if done and done['target'] == target_name and not fileindex.stat_changed(done, st):
+                # Si cambió el nombre en el destino, el fichero clonado de la
+                # copia anterior se sigue borrando
+                if entry is None or entry['target'] == done['target']:
+                    erase_list.pop(filename, None)
+
+                new_registry [ filename ] = done
+                c_resumed += 1
+                continue
+
+        if packer and codec is default_codec and packer.accepts(st):
+            packer.add(filename, st)
+            continue
+
+        # ¿Ha variado? Si cambió el stat y pidieron --checksum, comparamos el
+        # contenido antes de volver a copiarlo.
+        changed = entry is not None and fileindex.stat_changed(entry, st)
+        if changed and P['checksum'] and entry['target'] == target_name:
+            unchanged, checksum = same_content(entry, os.path.join(path, filename), os.path.join(target_scan_path, entry['target']), st, codec is None)
+
+            if unchanged:
+                changed = False
+                entry = fileindex.new_entry(st, target_name, checksum)
+
+        if entry is None and rename_detector and rename_detector.is_candidate(st):
+            # ¿Nuevo, o movido?
+            deferred.append((filename, st, codec, target_name))
+        elif entry is None:
+            # Nuevo fichero.
+            copy = "GUARDANDO"
+            c_new += 1
+        elif entry['target'] != target_name:
+            # Cambió el nombre en el destino (e.g. cambió el compresor).
+            # Dejamos el anterior en erase_list para borrarlo.
+            copy = "ACTUALIZANDO"
+            c_updated += 1
+        elif changed:
+
+            # Actualizando uno antiguo
+            copy = "ACTUALIZANDO"
+            c_updated += 1
+            del erase_list[filename]
+        else:
+            # Igual, si no está modificado, lo borramos del erase_list
+            del erase_list[filename]
+            new_registry [ filename ] = entry
+
+            # Si es un historic_backup, hacemos un hardlink de la copia de
+            # respaldo anterior. Si la clonamos, ya está.
+            hardlink = P['historic_backup'] and not snapshot_method
 
-        possible_error = ''
-        if pos_match:
-            pos = int(pos_match.group(1))
+        if copy:
+            # Empezamos la generación de la copia de seguridad.
+            logger.debug("{} {}...".format(copy, filename))
+
+            c_bytes += st.st_size
+            start_copy(pending, path, target_path, filename, st, codec, target_name, checksum)
+
+        # Registramos las copias terminadas, dejando como máximo 'max_pending'
+        # trabajos en cola para que la memoria no crezca.
+        c_errors += process_results(pending, max_pending, new_registry, errors, path)
+
+        if hardlink:
+            hardlink_start = time.perf_counter()
+            source_filename = os.path.join(target_scan_path, entry['target'])
+            target_filename = os.path.join(target_path, entry['target'])
+
+            try:
+                target_storage.link(source_filename, target_filename)
+            except Exception as e:
+                logger.warning('No pude enlazar {} ({}).'.format(filename, str(e)))
+                del new_registry [ filename ]
+
+            phases['hardlink'] += time.perf_counter() - hardlink_start
+
+        logger.progress(path, c_files, c_bytes, len(registry))
+
+        if P['checkpoint_interval'] and time.monotonic() >= next_checkpoint:
+            checkpoint(path, registry, new_registry)
+            next_checkpoint = time.monotonic() + P['checkpoint_interval']
+
+    # Los ficheros anteriores de los movidos están en erase_list: los
+    # movemos en el destino (o los enlazamos desde la copia anterior), en vez
+    # de volver a copiarlos
+    in_place = not P['historic_backup'] or snapshot_method
+    for filename, st, codec, target_name in deferred:
+        if stop_requested:
+            break
+
+        old_name, checksum = rename_detector.match(st, os.path.join(path, filename), erase_list, target_name[len(filename):])
+
+        if old_name:
+            old_filename = os.path.join(target_path if in_place else target_scan_path, erase_list[old_name]['target'])
+
+            if move_target(old_filename, os.path.join(target_path, target_name), st, in_place):
+                logger.debug("MOVIENDO {} a {}...".format(old_name, filename))
+
+                new_registry [ filename ] = fileindex.new_entry(st, target_name, checksum or erase_list[old_name]['checksum'])
+                del erase_list[old_name]
+                c_moved += 1
+                continue
+
+        logger.debug("GUARDANDO {}...".format(filename))
+        c_new += 1
+        c_bytes += st.st_size
+        start_copy(pending, path, target_path, filename, st, codec, target_name, checksum)
+        c_errors += process_results(pending, max_pending, new_registry, errors, path)
+
+    packs_done = set()
+    if packer and not stop_requested:
+        counters, packs_done = backup_packs(path, target_path, target_scan_path, packer, new_registry, erase_list, errors, in_place)
+        c_new += counters['new']
+        c_updated += counters['updated']
+        c_bytes += counters['bytes']
+        c_errors += counters['errors']
+
+    if stop_requested:
+        # Los trabajos que no empezaron se descartan, y esperamos a los que
+        # ya están copiando
+        for job, result in pending:
+            if isinstance(result, concurrent.futures.Future):
+                result.cancel()
+
+        process_results(pending, 0, new_registry, errors, path)
+        checkpoint(path, registry, new_registry)
+
+        logger.warning('{}: Copia interrumpida. {} ficheros copiados quedaron registrados en el índice.'.format(path, len(new_registry)))
+        return False
+
+    # Esperamos a que terminen los trabajos pendientes
+    c_errors += process_results(pending, 0, new_registry, errors, path)
+
+    phases['copy'] = time.perf_counter() - phase_start - phases['scan_source'] - phases['hardlink']
+    phase_start = time.perf_counter()
+
+    # Hay por borrar? Solo si NO estamos en backup historico, o si la
+    # copia histórica ya tenía los ficheros anteriores: porque es un clon, o
+    # porque estamos continuando una interrumpida.
+    if erase_list and (not P['historic_backup'] or snapshot_method or resuming):
+        # Calculamos cuál sería el fichero destino
+        c_deleted = len (erase_list)
+        for filename, entry in erase_list.items():
+            # El paquete sigue en el destino sin este fichero, o ya se borró
+            if entry['target'] in packs_done:
+                continue
+            if packs.is_pack(entry['target']):
+                packs_done.add(entry['target'])
+
+            # borramos
+            logger.debug("BORRANDO {}...".format(entry['target']))
+            try:
+                target_filename = os.path.join(target_path, entry['target'])
+                target_storage.remove(target_filename)
+            except Exception as e:
+                logger.warning('No pude eliminar {} ({}).'.format(entry['target'], str(e)))
+
+    phases['delete'] = time.perf_counter() - phase_start
+    phase_start = time.perf_counter()
+
+    # Grabamos el índice con el nuevo estado del destino
+    with index_lock:
+        index.set(path, historic_path, new_registry)
+        index.clear_partial(path)
+        try:
+            index.save()
+        except Exception as e:
+            logger.warning('No pude grabar el índice de ficheros ({}).'.format(str(e)))
+
+    # Los cambios tomados del diario ya están en el destino
+    if change_journal:
+        try:
+            change_journal.commit()
+        except OSError as e:
+            logger.warning('{}: No pude actualizar el diario de cambios ({}).'.format(path, str(e)))
+
+    phases['index'] = time.perf_counter() - phase_start
+
+    # Calculamos el tiempo tomado
+    elapsed_time = str(timedelta(seconds = time.time() - start_time))
+
+    for phase, seconds in phases.items():
+        logger.count('phase_seconds_total', seconds, path = path, phase = phase)
+
+    for action, count in (('new', c_new), ('updated', c_updated), ('moved', c_moved), ('deleted', c_deleted), ('unchanged', c_files - c_new - c_updated - c_moved), ('error', c_errors)):
+        logger.count('files_total', count, path = path, action = action)
+
+    logger.count('bytes_copied_total', c_bytes, path = path)
+    logger.reset_progress(path)
+
+    logger.info('{}: Finalizado. {} ficheros: {} nuevos, {} actualizados, {} movidos, {} borrados, {} errores. Duración: {}'. format(path, c_files, c_new, c_updated, c_moved, c_deleted, c_errors, elapsed_time))
+
+    if c_resumed:
+        logger.info('{}: {} ficheros ya estaban copiados antes de la interrupción.'.format(path, c_resumed))
+
+    stats['paths'][path] = {
+        'files': c_files,
+        'new': c_new,
+        'updated': c_updated,
+        'moved': c_moved,
+        'deleted': c_deleted,
+        'errors': c_errors,
+        'bytes': c_bytes,
+        'elapsed': time.time() - start_time,
+        'phases': dict(phases),
+    }
+
+    # Reporte de errores, ordenado para que sea igual en cada ejecución
+    if errors:
+        logger.warning('{}: {} errores:'.format(path, len(errors)))
+        for filename, error in sorted(errors):
+            logger.warning('  {}: {}'.format(filename, error))
 
-            possible_error = '\n\nEl caracter con problemas (representado con un "\\x" más dos letras o números) está en el centro de la siguiente línea:\n\n' + str(raw[pos-40:pos+40])
+    return True
 
-        logger.fail('Fichero con nombre mal codificado. Debes de actualizar su nombre:\n' + str(e) + possible_error)
-        # Iuuu, un fichero que no está en UTF8
 
-    files = {}
+def backup_group (paths):
+    ''' Copia una tras otra las rutas de un mismo disco '''
+    for path in paths:
+        if not backup_path(path):
+            return False
 
-    for f in filelist:
+    return True
 
-        # Verificamos si es un excluido
-        if not is_excluded ( f ):
-            # Process!
+def disk_of (device):
+    ''' El disco donde está un dispositivo: las particiones de un mismo
+    disco (sda1, sda2) devuelven el disco (sda). Devuelve el mismo
+    dispositivo si no se puede saber, e.g. sin /sys. '''
+    sys_path = os.path.realpath('/sys/dev/block/{}:{}'.format(os.major(device), os.minor(device)))
 
-            # Devolvemos un array fichero => timestamp
-            parts = f.split (" ", 1)
+    if os.path.exists(os.path.join(sys_path, 'partition')):
+        return os.path.dirname(sys_path)
 
-            # Al revés
-            parts.reverse()
+    return sys_path if os.path.exists(sys_path) else device
 
-            files [ parts[0] ] = parts[1]
+def disk_groups (paths):
+    ''' Agrupa las rutas por disco, en el orden en que se especificaron '''
+    groups = {}
 
-    return files
+    for path in paths:
+        try:
+            disk = disk_of(os.stat(path).st_dev)
+        except OSError:
+            # El error se informa al escanearla
+            disk = path
+
+        groups.setdefault(disk, []).append(path)
+
+    return list(groups.values())
 
 
 # Creamos el dict P con los parámetros por defecto
@@ -141,17 +1750,55 @@ while True:
 
             options = (
                 ('-b', 'Comprime los ficheros con BZ2. Por defecto comprime con Gzip (más rápido).'),
-                ('-n', 'No comprime los ficheros.'),
+                ('-n', 'No comprime los ficheros. La copia la hace el kernel (reflink en btrfs/XFS, copy_file_range o sendfile), sin pasar por Python.'),
+                ('-z', 'Comprime los ficheros con Zstandard. Necesita el módulo "zstandard".'),
+                ('-L', 'Comprime los ficheros con LZ4, muy rápido. Necesita el módulo "lz4".'),
+                ('-C', 'Divide los ficheros en trozos, y guarda cada trozo distinto una sola vez, comprimido con Gzip. Ahorra espacio en ficheros grandes que cambian poco.'),
                 ('-f', 'Crea una copia completa, en vez de incremental. No es compatible con -h.'),
                 ('-h', 'Crea una copia histórica. No es compatible con -f.'),
                 ('-H nombre', 'Nombre del directorio para la copia histórica. De omitirse se usará la fecha y hora actual.'),
-                ('-x pat', 'Excluye los ficheros que encajan con el patrón de shell "pat". Se puede especificar varias veces.'),
+                ('-j N', 'Copia y comprime N ficheros en paralelo. Por defecto, 1. Las rutas de distintos discos se copian a la vez, hasta N.'),
+                ('-x pat', 'Excluye los ficheros y directorios que encajan con el patrón de shell "pat", con "**" y "/" inicial al estilo de .gitignore. Se puede especificar varias veces.'),
                 ('-l fich', 'Graba el registro de actividad completo en el fichero "fich".'),
                 ('-d', 'Muestra mayor información en la salida estándar.'),
                 ('-q', 'Suprime la salida de información en la salida estándar.'),
-                ('-F', 'Fuerza a "find" a seguir enlaces simbólicos'),
+                ('-F', 'Sigue los enlaces simbólicos al escanear el origen.'),
                 ('-g', 'Genera un fichero de configuración con las opciones especificadas en la línea de comandos.'),
                 ('-c conf', 'Usa los parámetros almacenados en el fichero de configuración "conf". Las opciones especificadas después de esta opción reemplazarán a las guardadas en el fichero.'),
+                ('--s3-endpoint URL', 'Con un destino "s3://bucket/prefijo", usa el servicio compatible con S3 en "URL", e.g. un MinIO. Por defecto usa la variable de entorno BACKUP_S3_ENDPOINT, o AWS.'),
+                ('--part-size MB', 'Sube a S3 los ficheros en partes de MB megabytes, en paralelo. Por defecto, 8.'),
+                ('--bwlimit MB', 'Lee el origen a como mucho MB megabytes por segundo, en total entre todos los hilos.'),
+                ('--iops N', 'Hace como mucho N lecturas por segundo del origen.'),
+                ('--max-load N', 'Pausa la lectura del origen mientras la carga media del sistema sea mayor que N.'),
+                ('--watch', 'No hace ninguna copia: vigila las rutas de origen, y anota en el diario de --journal los directorios que cambian. Se queda funcionando hasta recibir Ctrl-C o SIGTERM.'),
+                ('--journal dir', 'Usa el diario de cambios de la carpeta "dir": las copias incrementales solo escanean los directorios que cambiaron desde la copia anterior. Si el vigilante se reinició o perdió eventos, escanean todo el origen.'),
+                ('--keep-cache', 'No descarta de la caché de páginas los ficheros del origen ya leídos. Por defecto se descartan, para no desplazar los datos de otros servicios.'),
+                ('--pack KB', 'Guarda juntos los ficheros de menos de KB kilobytes de cada directorio, en un paquete con un diccionario de compresión común. Solo se reescriben los paquetes que cambiaron. Necesita compresión y un destino local.'),
+                ('--block-threshold MB', 'Con -j, comprime por bloques en paralelo los ficheros de más de MB megabytes. Por defecto, 64.'),
+                ('--scan-threads N', 'Escanea los directorios de origen con N hilos en paralelo.'),
+                ('--level N', 'Nivel de compresión. Por defecto, 9 para Gzip y BZ2, 3 para Zstandard y 0 para LZ4.'),
+                ('--zstd-threads N', 'Usa N hilos de Zstandard para comprimir cada fichero.'),
+                ('--skip-compressed', 'Los ficheros que ya vienen comprimidos (.jpg, .zip, .gz, .mp4...) se guardan con LZ4 o, sin el módulo "lz4", sin comprimir.'),
+                ('--codec-for .ext comp', 'Usa el compresor "comp" (gzip, bzip, zstd, lz4 o store) para los ficheros con extensión ".ext". Se puede especificar varias veces.'),
+                ('--checksum', 'Si cambió el tamaño, la fecha, el inodo o el ctime de un fichero, compara su contenido con el checksum guardado antes de volver a copiarlo.'),
+                ('--no-snapshot', 'En las copias históricas, enlaza los ficheros sin cambios uno a uno mientras escanea el origen, en vez de clonar primero la copia anterior.'),
+                ('--restore dir', 'Restaura en "dir" la copia del destino: la copia histórica de -H, o la última. Descomprime en paralelo (con -j, o un hilo por núcleo), y restaura permisos, dueño y fechas.'),
+                ('--filter pat', 'Con --restore, solo restaura los ficheros que encajan con el patrón "pat", o que están dentro de un directorio que encaja, e.g. "/home/usuario/docs" o "*.odt". Se puede especificar varias veces.'),
+                ('--verify', 'Lee y descomprime en paralelo los ficheros de la copia del destino (la de -H, o la última), y comprueba que coinciden con el checksum guardado en el índice. No hace ninguna copia. Con --bwlimit, --iops y --max-load se puede dejar funcionando sin afectar a otros servicios.'),
+                ('--sample PCT', 'Con --verify, solo lee el PCT por ciento de los ficheros, elegidos al azar.'),
+                ('--plan fich', 'No hace ninguna copia: escanea el origen, lo compara con la copia anterior, y graba en el fichero JSON "fich" los ficheros nuevos, actualizados y borrados, los bytes por leer y la duración estimada de la copia.'),
+                ('--execute-plan fich', 'Hace la copia del plan grabado en "fich" con --plan, escaneando solo los directorios con cambios. Las rutas de origen, si se omiten, salen del plan. Si el destino cambió desde que se hizo el plan, escanea todo el origen.'),
+                ('--prune', 'Borra las copias históricas que no conservan las opciones --keep-*, y los trozos de -C que ya no se usan. Si solo se especifica el destino, no hace ninguna copia.'),
+                ('--keep-last N', 'Al borrar, conserva las N copias históricas más recientes.'),
+                ('--keep-daily N', 'Al borrar, conserva la copia histórica más reciente de cada uno de los últimos N días.'),
+                ('--keep-weekly N', 'Al borrar, conserva la copia histórica más reciente de cada una de las últimas N semanas.'),
+                ('--keep-monthly N', 'Al borrar, conserva la copia histórica más reciente de cada uno de los últimos N meses.'),
+                ('--resume', 'Si la copia histórica anterior se interrumpió, la continúa en vez de empezar una nueva, sin volver a copiar los ficheros que ya se habían copiado.'),
+                ('--checkpoint N', 'Graba en el índice los ficheros ya copiados cada N segundos, para no perderlos si la copia se interrumpe. Por defecto, 300.'),
+                ('--verify-index', 'Ignora el índice de ficheros guardado en el destino, y vuelve a escanearlo.'),
+                ('--stats fich', 'Graba en el fichero JSON "fich" las estadísticas de la copia: ficheros, bytes y duración de cada fase.'),
+                ('--metrics fich', 'Añade al fichero "fich" las métricas de la copia, una por línea en JSON. Si "fich" acaba en ".prom", lo reemplaza con el formato de texto de Prometheus.'),
+                ('--progress N', 'Muestra el progreso de la copia cada N segundos. 0 no lo muestra. Por defecto, 60.'),
                 ('--help', 'Esta ayuda.'),
                 ('--version', 'Versión de éste script.')
             )
@@ -182,6 +1829,139 @@ while True:
         elif long_cmd == "version":
             print (header())
             sys.exit()
+        elif long_cmd == "verify-index":
+            P['verify_index'] = True
+        elif long_cmd == "checksum":
+            P['checksum'] = True
+        elif long_cmd == "no-snapshot":
+            P['snapshot'] = False
+        elif long_cmd == "restore":
+            try:
+                P['restore'] = args.pop()
+            except IndexError:
+                logger.fail('Falta la carpeta para --restore.')
+        elif long_cmd == "verify":
+            P['verify'] = True
+        elif long_cmd == "sample":
+            try:
+                P['verify_sample'] = float(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta el porcentaje para --sample.')
+        elif long_cmd == "plan":
+            try:
+                P['plan'] = args.pop()
+            except IndexError:
+                logger.fail('Falta el fichero para --plan.')
+        elif long_cmd == "execute-plan":
+            try:
+                P['execute_plan'] = args.pop()
+            except IndexError:
+                logger.fail('Falta el fichero del plan para --execute-plan.')
+        elif long_cmd == "filter":
+            try:
+                P['restore_filter'].append(args.pop())
+            except IndexError:
+                logger.fail('Falta el patrón para --filter.')
+        elif long_cmd == "prune":
+            P['prune'] = True
+        elif long_cmd in ("keep-last", "keep-daily", "keep-weekly", "keep-monthly"):
+            try:
+                P[long_cmd.replace('-', '_')] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta la cantidad para --{}.'.format(long_cmd))
+        elif long_cmd == "resume":
+            P['resume'] = True
+        elif long_cmd == "checkpoint":
+            try:
+                P['checkpoint_interval'] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Faltan los segundos para --checkpoint.')
+        elif long_cmd == "stats":
+            try:
+                P['stats_file'] = args.pop()
+            except IndexError:
+                logger.fail('Falta el fichero para --stats.')
+        elif long_cmd == "metrics":
+            try:
+                P['metrics_file'] = args.pop()
+            except IndexError:
+                logger.fail('Falta el fichero para --metrics.')
+        elif long_cmd == "progress":
+            try:
+                P['progress_interval'] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Faltan los segundos para --progress.')
+        elif long_cmd == "level":
+            try:
+                P['compress_level'] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta el nivel de compresión para --level.')
+        elif long_cmd == "zstd-threads":
+            try:
+                P['zstd_threads'] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta el número de hilos para --zstd-threads.')
+        elif long_cmd == "skip-compressed":
+            # No sobreescribimos lo que venga de --codec-for
+            for extension in compressors.COMPRESSED_EXTENSIONS:
+                P['codec_policy'].setdefault(extension, compressors.fast_codec_name())
+        elif long_cmd == "codec-for":
+            try:
+                extension = args.pop().lower()
+                P['codec_policy'][extension] = args.pop()
+            except IndexError:
+                logger.fail('--codec-for necesita una extensión y un compresor.')
+        elif long_cmd == "scan-threads":
+            try:
+                P['scan_threads'] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta el número de hilos para --scan-threads.')
+        elif long_cmd == "s3-endpoint":
+            try:
+                P['s3_endpoint'] = args.pop()
+            except IndexError:
+                logger.fail('Falta la URL para --s3-endpoint.')
+        elif long_cmd == "part-size":
+            try:
+                P['part_size'] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta el tamaño en MB para --part-size.')
+        elif long_cmd == "bwlimit":
+            try:
+                P['bwlimit'] = float(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta la velocidad en MB/s para --bwlimit.')
+        elif long_cmd == "iops":
+            try:
+                P['iops'] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta la cantidad de lecturas por segundo para --iops.')
+        elif long_cmd == "max-load":
+            try:
+                P['max_load'] = float(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta la carga máxima para --max-load.')
+        elif long_cmd == "journal":
+            try:
+                P['journal'] = args.pop()
+            except IndexError:
+                logger.fail('Falta la carpeta para --journal.')
+        elif long_cmd == "watch":
+            P['watch'] = True
+        elif long_cmd == "pack":
+            try:
+                P['pack_threshold'] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta el tamaño en KB para --pack.')
+        elif long_cmd == "keep-cache":
+            P['drop_cache'] = False
+        elif long_cmd == "block-threshold":
+            try:
+                P['block_threshold'] = int(args.pop())
+            except (IndexError, ValueError):
+                logger.fail('Falta el tamaño en MB para --block-threshold.')
+        else:
+            logger.fail('Opción desconocida: {}'.format(arg))
 
     # Si empieza con un guión, entonces lo separamos por letras
     elif arg[0] == '-':
@@ -195,8 +1975,10 @@ while True:
                     fail ( 'Falta el fichero de configuración' )
 
                 # Lo evaluamos.
+                # Usamos 'update' para que los parámetros que no estén en el
+                # fichero mantengan su valor por defecto.
                 with open(config_file) as f:
-                    P = eval(f.read())
+                    P.update(eval(f.read()))
 
             # Backup completo
             elif a == 'f':
@@ -206,6 +1988,16 @@ while True:
             elif a == 'F':
                 P['follow_symlinks'] = True
 
+            # Ficheros en paralelo
+            elif a == 'j':
+                try:
+                    P['jobs'] = int(args.pop())
+                except (IndexError, ValueError):
+                    logger.fail('Falta el número de trabajos en paralelo.')
+
+                if P['jobs'] < 1:
+                    logger.fail('El número de trabajos en paralelo debe ser mayor que cero.')
+
             # Patron a excluir
             elif a == 'x':
                 try:
@@ -242,8 +2034,20 @@ while True:
             elif a == 'b':
                 P['compressor'] = 'bzip'
 
+            # Trozos deduplicados
+            elif a == 'C':
+                P['compressor'] = 'chunks'
+
+            # Zstandard
+            elif a == 'z':
+                P['compressor'] = 'zstd'
+
+            # LZ4
+            elif a == 'L':
+                P['compressor'] = 'lz4'
+
             # Sin compresión.
-            elif a == 'u':
+            elif a == 'n' or a == 'u':
                 P['compressor'] = ''
 
             # Activamos la grabación de la configuración
@@ -269,15 +2073,44 @@ while True:
 if P['full_backup'] and P['historic_backup']:
     logger.fail('No se acepta -f y -h juntos.')
 
-# Procesamos las rutas. Tiene que haber AL MENOS 2 rutas
-if P['target'] == '' or P['paths'] == []:
-    if len(paths) < 2:
+# Procesamos las rutas. Con --watch, todas son de origen.
+if P['watch']:
+    if paths:
+        P['paths'] = paths
+
+    if not P['paths'] or not P['journal']:
+        logger.fail('--watch necesita las rutas de origen, y la carpeta del diario con --journal.')
+
+# Tiene que haber AL MENOS 2 rutas
+elif P['target'] == '' or P['paths'] == []:
+    # Con --prune, --restore, --verify o --execute-plan basta con el destino
+    if len(paths) < 2 and not ((P['prune'] or P['restore'] or P['verify'] or P['execute_plan']) and len(paths) == 1):
         logger.fail('Debes especificar al menos una ruta de origen, y la ruta de destino. Prueba la opción --help.')
 
     # La ruta de destino es la última
     P['target'] = paths[-1]
     P['paths'] = paths[:-1]
 
+# El plan de --execute-plan, que puede traer las rutas de origen
+backup_plan = None
+if P['execute_plan']:
+    if P['plan'] or P['journal']:
+        logger.fail('--execute-plan no es compatible con --plan ni con --journal.')
+
+    try:
+        backup_plan = plan.load(P['execute_plan'])
+    except (OSError, ValueError) as e:
+        logger.fail('No pude leer el plan {} ({}).'.format(P['execute_plan'], str(e)))
+
+    if backup_plan['target'] != plan.normalize_target(P['target']):
+        logger.fail('El plan {} es para el destino {}.'.format(P['execute_plan'], backup_plan['target']))
+
+    if not P['paths']:
+        P['paths'] = list(backup_plan['paths'])
+
+if P['plan'] and not P['paths']:
+    logger.fail('--plan necesita las rutas de origen.')
+
 # Queremos imprimir la configuración?
 if print_config:
     print(header('# '))
@@ -304,35 +2137,69 @@ if print_config:
 
     sys.exit()
 
-# Compilamos los patrones de exclusión
-P['exclude_regexp'] = []
-for pat in P['exclude']:
-    # Convertimos el patrón a un regexp.-
-    #   - Los asteriscos los reemplazamos por .*
-    #   - Las interrogaciones por .
-    #   - Los puntos los escapamos.
+# Configuramos el registro de actividad. debug_level 0 solo muestra avisos y
+# errores, 1 también la información, y 2 también la depuración.
+logger.set_log_level(P['debug_level'] + activitylog.ActivityLog.WARNING)
+logger.set_progress_interval(P['progress_interval'])
+if P['debug_file']:
+    try:
+        logger.set_log_file(P['debug_file'])
+    except OSError as e:
+        logger.fail('No pude abrir el fichero de registro {} ({}).'.format(P['debug_file'], str(e)))
+
+# Compilamos los patrones de exclusión en una sola expresión regular
+try:
+    exclude_matcher = exclude.ExcludeMatcher(P['exclude'])
+except ValueError as e:
+    logger.fail(str(e))
+
+# Vigilamos el origen, hasta que nos detengan
+if P['watch']:
+    sys.exit(changejournal.watch(P['journal'], [os.path.abspath(path) for path in P['paths']], logger))
+
+# El almacenamiento del destino: una carpeta local, o un bucket de S3
+try:
+    target_storage = storage.open_storage(P['target'], max(4, P['jobs'] * 2), P['s3_endpoint'], P['part_size'] * 1048576)
+except ValueError as e:
+    logger.fail(str(e))
 
-    #   - Lo anclamos al final de la linea con $
+if target_storage.remote:
+    if P['restore']:
+        logger.fail('--restore necesita un destino local. Descarga antes la copia del bucket.')
 
-    pat = pat.replace ( '.', '\.' )
-    pat = pat.replace ( '?', '.' )
-    pat = pat.replace ( '*', '.*' )
-    pat += '$'
+    if P['verify']:
+        logger.fail('--verify necesita un destino local.')
 
-    P['exclude_regexp'].append ( re.compile(pat) )
+    if P['compressor'] == 'chunks' or 'chunks' in P['codec_policy'].values():
+        logger.fail("El compresor 'chunks' necesita un destino local.")
 
+    # En S3 no hay snapshots ni enlaces duros: los ficheros sin cambios se
+    # copian dentro del bucket
+    P['snapshot'] = False
 
 # Definimos qué compresor vamos a usar.
-target_extension = ''
-if P['compressor'] == 'bzip':
-    target_extension = '.bz2'
-    target_module = bz2.BZ2File
-elif P['compressor'] == 'gzip':
-    target_extension = '.gz'
-    target_module = gzip.GzipFile
-else:
-    # Sin compresión. Copiamos
-    target_module = False
+try:
+    default_codec = compressors.get_codec(P['compressor'], P['compress_level'], P['zstd_threads'], P['target'])
+
+    # Los compresores por extensión solo se usan si hay compresión. Sin
+    # ella, el nombre en el destino podría chocar con el de otro fichero.
+    codec_policy = {}
+    if default_codec:
+        for extension, name in P['codec_policy'].items():
+            if not name:
+                logger.fail("El compresor para '{}' no puede ser vacío. Usa 'store' para no comprimir.".format(extension))
+
+            codec_policy[extension] = compressors.get_codec(name, P['compress_level'], P['zstd_threads'], P['target'])
+except ValueError as e:
+    logger.fail(str(e))
+
+# Los paquetes de ficheros pequeños se comprimen con deflate, con el nivel de
+# gzip
+if P['pack_threshold']:
+    if not default_codec or default_codec.name == 'chunks' or target_storage.remote:
+        logger.fail('--pack necesita un compresor (no -n ni -C) y un destino local.')
+
+    pack_level = P['compress_level'] if P['compress_level'] is not None and 0 <= P['compress_level'] <= 9 else 9
 
 start_time = time.time()
 
@@ -347,7 +2214,15 @@ for path in P['paths']:
 logger.info(header())
 logger.info('Línea de comandos: {}'.format (' '.join(sys.argv)))
 
-if P['full_backup']:
+if P['restore']:
+    logger.info('Iniciando restauración.')
+elif P['verify']:
+    logger.info('Iniciando verificación.')
+elif P['plan']:
+    logger.info('Iniciando plan de copia.')
+elif not P['paths']:
+    logger.info('Borrando copias históricas antiguas.')
+elif P['full_backup']:
     logger.info('Iniciando copia completa.')
 elif P['historic_backup']:
     logger.info('Iniciando copia incremental histórica.')
@@ -355,226 +2230,181 @@ else:
     logger.info('Iniciando copia incremental.')
 
 
-# Podemos escribir en la carpeta destino?
-if not os.access(P['target'], os.W_OK):
+# Podemos escribir en la carpeta destino? Para restaurar, verificar o planear
+# solo hace falta leerla.
+if not target_storage.check(not (P['restore'] or P['verify'] or P['plan'])):
     logger.fail('No puedo escribir en la carpeta destino {}'.format(P['target']))
 
 # Existe metadata en la ruta destino?
 MD = {}
 metadata_file = P["target"] + "/" + METADATA_FILENAME
-if os.path.exists(metadata_file):
-    with open(metadata_file) as f:
-        try:
-            MD = json.loads(f.read())
-        except json.decoder.JSONDecodeError:
-            logger.warning("Fichero de metadata existe, pero es ilegible. Eliminando...")
-            os.unlink(metadata_file)
+metadata = target_storage.read(metadata_file)
+if metadata is not None:
+    try:
+        MD = json.loads(metadata)
+    except json.decoder.JSONDecodeError:
+        logger.warning("Fichero de metadata existe, pero es ilegible. Eliminando...")
+        target_storage.remove(metadata_file)
+
+# El índice de ficheros, que evita escanear el destino. Lo graban los hilos
+# de cada ruta.
+index = fileindex.FileIndex(os.path.join(P['target'], fileindex.INDEX_FILENAME), target_storage)
+index_lock = threading.Lock()
+try:
+    index.load()
+except ValueError:
+    logger.warning("El índice de ficheros existe, pero es ilegible. Se escaneará el destino.")
+
+# Restauramos, y terminamos
+if P['restore']:
+    sys.exit(restore_backup())
+
+# Verificamos, y terminamos
+if P['verify']:
+    sys.exit(verify_backup())
+
+# Grabamos el plan, y terminamos
+if P['plan']:
+    sys.exit(plan_backup())
+
+# El plan solo sirve si el destino sigue como cuando se hizo
+if backup_plan and not plan.matches(backup_plan, MD, P['historic_backup']):
+    logger.warning('El destino cambió desde que se hizo el plan {}. Escaneando todo el origen.'.format(P['execute_plan']))
+    backup_plan = None
+
+# ¿Se interrumpió la copia anterior? Se registra al empezar cada copia, y se
+# borra al terminarla.
+interrupted = MD.get('in_progress')
+resuming = False
 
 # En historic_backup, debemos añadir una carpeta raiz extra
 historic_path = ''
 if P['historic_backup']:
+    if interrupted and interrupted['dir']:
+        if P['resume']:
+            P['historic_backup_dir'] = interrupted['dir']
+            resuming = True
+            logger.info('Continuando la copia histórica interrumpida {}.'.format(interrupted['dir']))
+        else:
+            logger.warning('La copia histórica {} quedó incompleta. Usa --resume para continuarla.'.format(interrupted['dir']))
+
     if not P['historic_backup_dir']:
         P['historic_backup_dir'] = datetime.now().strftime('%Y%m%d%H%M%S')
 
     historic_path = P['historic_backup_dir']
 
-for path in P['paths']:
-
-    # El path tiene que estar en ABSOLUTO.
-    path = os.path.abspath(path)
-
-    # Grabamos el momento que se inició la copia de respaldo.
-    start_time = time.time()
-
-
-    # Calculamnos la carpeta destino, dependiendo
-    # si quieremos solo una, o toda la ruta completa
-
-    # 'path' contiene la ruta absoluta del fichero que
-    # queremos. Le removemos el 1er slash para que
-    # os.path.join no descarte los parámetros anteriores
-    # (http://docs.python.org/3.2/library/os.path.html#os.path.join)
-    target_path = os.path.join(P['target'], historic_path, path[1:])
-
-    # Creamos la carpeta destino siempre. Para que el find no falle
-    try:
-        os.makedirs(target_path)
-    except:
-        pass
-
-    # Primero, escaneamos el origen
-    logger.info('{}: Escaneando origen...'.format (path))
-    files_data = scan_files (path)
-
-    # Luego escaneamos el destino, si no pide un full_backup
-    registry = {}
-
-    # scan_path puede ser target_path para backups regulares
-    # o el anterior directorio creado, para historicos-
-    target_scan_path = target_path
-
-    if P['historic_backup']:
-        if 'last_historic_dir' in MD:
-            target_scan_path = os.path.join(P['target'], MD['last_historic_dir'], path[1:])
-        else:
-            target_scan_path = None
-
-    if not target_scan_path:
-        logger.info('{}: Primer backup. Usando backup total'.format(path))
-    elif not P['full_backup']:
-        logger.info('{}: Escaneando destino...'.format(path))
-        registry = scan_files (target_scan_path)
-
-    logger.info('{}: {} ficheros. Destino: "{}", iniciando copia.'.format ( path, len(files_data), target_path))
-
-    # Aquí irá el registro con los nuevos timestamps
-    new_registry = registry.copy()
-
-    # Aqui quedarán los ficheros por borrar
-    erase_list = registry.copy()
-
-    # Contadores
-    c_new = 0
-    c_updated = 0
-    c_deleted = 0
-    c_old = 0
-
-
-    # Escaneamos sus ficheros
-    for filename, timestamp in files_data.items():
-
-        # De este timestamp sacamos el usuario, grupo, y permisos
-        # TODO
-
-        # No existe, o ha variado?
-        copy = False
-
-        # Hardlink para historic_backup?
-        hardlink = False
-
-        if not filename + target_extension in registry:
-            # Nuevo fichero.
-            copy = "GUARDANDO"
-            c_new += 1
-        elif registry [ filename + target_extension ] != timestamp:
-
-            # Actualizando uno antiguo
-            copy = "ACTUALIZANDO"
-            c_updated += 1
-            del erase_list[filename + target_extension]
-        else:
-            # Igual, si no está modificado, lo borramos del erase_list
-            del erase_list[filename + target_extension]
-
-            # Si es un historic_backup, hacemos un hardlink de la copia de respaldo anterior
-            hardlink = True
-
-        if copy:
-            # Empezamos la generación de la copia de seguridad.
-            target_filename = os.path.join (target_path, filename)
-
-            logger.debug("{} {}...".format(copy, filename))
-
-            # Creamos la carpeta destino, si no existe. Con algo de suerte,
-            # podemos ignorar tranquilamente los errores
-            try:
-                os.makedirs(os.path.dirname(target_filename))
-            except Exception as e :
-                pass
-
-            source_filename = os.path.join(path, filename)
-
-            # Ya que también copiamos los atributos del fichero, puede sucede
-            # que cuando actualizamos, el fichero anterior no tiene permisos
-            # de escritura. Asi que le damos permisos de escritura primero.
-
-            # Si no podemos camiarle, no podemos psss :)
-            try:
-                os.chmod (target_filename, stat.S_IWUSR)
-            except:
-                pass
-
-
-            # Comprimimos?
-            if target_module:
-                target_filename += target_extension
-
-                # Intentamos abrir el fichero
-                try:
-                    with target_module(target_filename, 'wb') as target_fd, open (source_filename, 'rb') as source_fd:
-
-                        # Procesamos en 9000k a la vez (10 chunks de 900k,
-                        # el usado por la máxima compresión del gzip. Debe de
-                        # ser igual para bzip2)
-                        while 1:
-                            count = target_fd.write (source_fd.read(9216000) )
-                            if count == 0:
-                                break;
+if P['resume'] and not resuming:
+    logger.info('No hay una copia histórica interrumpida para continuar.')
 
-                except Exception as e:
-                    logger.warning('No pude copiar {} ({}) '.format(filename, str(e)))
+# El catálogo de copias históricas. Los destinos anteriores al catálogo
+# empiezan con las copias que encontremos.
+if 'generations' not in MD and (P['historic_backup'] or 'last_historic_dir' in MD):
+    MD['generations'] = {} if target_storage.remote else retention.discover_generations(P['target'])
 
-            else:
-                # Si no hay target, es una simple copia.
-                try:
-                    shutil.copy (source_filename, target_filename)
-                except Exception as e:
-                    logger.warning('ADVERTENCIA: No pude copiar {} ({}) '.format(filename, str(e)))
+    last = MD.get('last_historic_dir')
+    if last and last not in MD['generations'] and os.path.isdir(os.path.join(P['target'], last)):
+        mtime = os.stat(os.path.join(P['target'], last)).st_mtime
+        MD['generations'][last] = {'time': datetime.fromtimestamp(mtime).isoformat(timespec = 'seconds')}
 
+# Sin rutas, solo borramos copias antiguas (--prune)
+if P['paths']:
+    MD['in_progress'] = {'dir': historic_path, 'started': datetime.now().isoformat()}
+    save_metadata()
 
-            try:
-                # Después de copiar, actualizamos permisos y dueño
-                st = os.stat (source_filename)
+# Ctrl-C y SIGTERM graban un punto de control antes de salir
+stop_requested = False
+signal.signal(signal.SIGINT, request_stop)
+signal.signal(signal.SIGTERM, request_stop)
 
-                shutil.copystat (source_filename, target_filename)
-                os.chown (target_filename, st.st_uid, st.st_gid)
-            except Exception as e:
-                # No pudimos cambiarle de permisos!
-                logger.warning('No pude copiar permisos ni dueño de {} ({}).'.format ( filename, str(e) ) )
+# Los hilos de trabajo para copiar y comprimir. gzip y bz2 liberan el GIL
+# mientras comprimen, así que los hilos aprovechan todos los núcleos.
+pool = None
+block_pool = None
+if P['jobs'] > 1:
+    pool = concurrent.futures.ThreadPoolExecutor(P['jobs'])
 
-            # Y actualizamos el fichero de registro
-            new_registry [ filename ] = timestamp
+    # Los bloques de los ficheros grandes van en otro pool, para que un
+    # fichero esperando sus bloques no bloquee a los hilos que los comprimen
+    block_pool = concurrent.futures.ThreadPoolExecutor(P['jobs'])
 
-        if hardlink:
-            source_filename = os.path.join(target_scan_path, filename + target_extension)
-            target_filename = os.path.join(target_path, filename + target_extension)
+# Cantidad máxima de trabajos en cola, para no llenar la memoria
+max_pending = P['jobs'] * 2
 
+# En S3, los ficheros se suben mientras se comprimen
+copy_file = upload_file if target_storage.remote else backup_file
 
-            # Creamos la carpeta destino, si no existe. Con algo de suerte,
-            # podemos ignorar tranquilamente los errores
-            try:
-                os.makedirs(os.path.dirname(target_filename))
-            except Exception as e :
-                pass
+# El planificador de la lectura del origen
+io_scheduler = iosched.IOScheduler(P['bwlimit'] * 1048576, P['iops'], P['max_load'], P['drop_cache'])
 
-            os.link(source_filename, target_filename)
+# Estadísticas de cada ruta, para --stats
+stats = {'version': VERSION, 'paths': {}}
+backup_start_time = time.time()
 
-            # BIG BIG CHANGE
+# Las rutas de un mismo disco se copian una tras otra, para no alternar
+# lecturas en distintas zonas del disco. Las de distintos discos se copian a
+# la vez, compartiendo los hilos de trabajo.
+path_groups = disk_groups([os.path.abspath(path) for path in P['paths']])
+path_threads = min(len(path_groups), P['jobs'])
 
-    # Hay por borrar? Solo si NO estamos en backup historico
-    if erase_list and not P['historic_backup']:
-        # Calculamos cuál sería el fichero destino
-        c_deleted = len (erase_list)
-        for filename in erase_list.keys():
+if path_threads > 1:
+    logger.info('Copiando {} discos en paralelo.'.format(path_threads))
 
-            # borramos
-            logger.debug("BORRANDO {}...".format(filename))
-            try:
-                target_filename = os.path.join(target_path, filename)
-                os.unlink(target_filename)
-            except Exception as e:
-                logger.warning('No pude eliminar {} ({}).'.format(filename, str(e)))
+    with concurrent.futures.ThreadPoolExecutor(path_threads) as path_pool:
+        finished = all(list(path_pool.map(backup_group, path_groups)))
+else:
+    finished = all(backup_group(group) for group in path_groups)
 
-    # Calculamos el tiempo tomado
-    elapsed_time = str(timedelta(seconds = time.time() - start_time))
+if not finished:
+    sys.exit(130)
 
-    logger.info('{}: Finalizado. {} nuevos, {} actualizados, {} borrados. Duración: {}'. format(path, c_new, c_updated, c_deleted, elapsed_time))
+if pool:
+    pool.shutdown()
+    block_pool.shutdown()
 
 # Si hay un historic_path, lo guardamos para la siguiente vez
-if historic_path:
+if historic_path and P['paths']:
     MD['last_historic_dir'] = historic_path
+    MD['generations'][historic_path] = {
+        'time': datetime.now().isoformat(timespec = 'seconds'),
+        'paths': [os.path.abspath(path) for path in P['paths']],
+    }
+
+# Compresión de cada compresor: bytes escritos por cada byte leído. Su
+# velocidad se guarda para estimar la duración de la próxima copia (--plan).
+codecs = {}
+for (name, labels), value in list(logger.metrics.items()):
+    if name == 'codec_bytes_in_total':
+        codec_name = dict(labels)['codec']
+        written = logger.get('codec_bytes_out_total', codec = codec_name)
+        codecs[codec_name] = {'bytes_in': value, 'bytes_out': written, 'ratio': written / value if value else 1}
+        logger.gauge('codec_ratio', codecs[codec_name]['ratio'], codec = codec_name)
+
+        seconds = logger.get('codec_seconds_total', codec = codec_name)
+        if value and seconds:
+            plan.update_throughput(MD.setdefault('throughput', {}), codec_name, value / seconds)
+
+# La copia terminó. Los planes hechos antes de esta copia ya no sirven.
+MD.pop('in_progress', None)
+if P['paths']:
+    MD['last_backup'] = {'dir': historic_path, 'finished': datetime.now().isoformat()}
+save_metadata()
+
+if P['prune']:
+    prune()
+
+logger.gauge('duration_seconds', time.time() - backup_start_time)
+logger.gauge('io_throttled_seconds', io_scheduler.waited)
+logger.gauge('last_run_timestamp_seconds', int(time.time()))
+
+if P['metrics_file']:
+    try:
+        logger.write_metrics(P['metrics_file'])
+    except OSError as e:
+        logger.warning('No pude grabar las métricas ({}).'.format(str(e)))
+
+if P['stats_file']:
+    stats['elapsed'] = time.time() - backup_start_time
+    stats['codecs'] = codecs
 
-# Si hay metadata, la grabamos
-if MD:
-    with open(metadata_file, 'w') as f:
-        f.write(json.dumps(MD))
+    with open(P['stats_file'], 'w') as f:
+        f.write(json.dumps(stats, indent = 2))
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+'''
+benchmark.py
+============
+
+Pruebas de rendimiento de backup.py.
+
+    benchmark.py tree carpeta [escala] [semilla]
+
+Genera un árbol de prueba reproducible: muchos ficheros pequeños, unos pocos
+muy grandes, directorios profundos, y contenido con distinta
+compresibilidad. 'escala' multiplica la cantidad y el tamaño de los ficheros.
+
+    benchmark.py run [escala] [opciones de backup.py...]
+
+Genera un árbol de prueba en una carpeta temporal, y ejecuta sobre él una
+copia completa, una incremental sin cambios, una incremental después de
+modificar algunos ficheros, y dos históricas. Muestra en JSON, por cada
+copia, ficheros/s, MB/s, la memoria máxima usada, y la duración de cada fase
+(escaneo del origen y del destino, copia, borrado).
+
+    benchmark.py exclude [ficheros] [patrones]
+
+Compara el motor de exclusión (exclude.ExcludeMatcher) con el bucle de una
+expresión regular por patrón que usaba backup.py antes, y comprueba que los
+dos excluyen los mismos ficheros (si no, termina con código 1).
+
+    benchmark.py chunks [MB]
+
+Compara la velocidad de búsqueda de cortes del almacén de trozos
+(chunkstore.cut_point) con el hash Gear byte a byte que usaba antes, sobre
+'MB' megabytes al azar (por defecto, 8) y sobre otros tantos de texto.
+
+    benchmark.py registry [ficheros]
+
+Compara la memoria máxima de una copia incremental sin cambios de
+'ficheros' ficheros (por defecto, un millón) con los registros como dict, y
+con fileindex.Registry: el registro anterior, los ficheros por borrar, y el
+registro nuevo. Cada uno se mide en un proceso aparte, y se extrapola a 20
+millones de ficheros.
+'''
+
+import sys, os, re, time, random, json, tempfile, shutil, subprocess, hashlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import exclude, fileindex, chunkstore
+
+def legacy_matcher(patterns):
+    ''' El motor de exclusión original: un regexp por patrón, recorridos uno
+    a uno por cada fichero '''
+    regexps = []
+    for pat in patterns:
+        pat = pat.replace('.', '\\.')
+        pat = pat.replace('?', '.')
+        pat = pat.replace('*', '.*')
+        pat += '$'
+        regexps.append(re.compile(pat))
+
+    def is_excluded(path):
+        for regexp in regexps:
+            if regexp.search(path):
+                return True
+
+    return is_excluded
+
+def synthetic_paths(count, rnd):
+    ''' Rutas relativas al azar, con varios niveles de directorios '''
+    words = ['src', 'lib', 'home', 'user', 'docs', 'data', 'cache', 'build', 'var', 'www', 'img', 'test']
+    extensions = ['.py', '.txt', '.jpg', '.html', '.css', '.js', '.c', '.h', '.json', '.md']
+
+    paths = []
+    for i in range(count):
+        depth = rnd.randint(1, 8)
+        dirs = [rnd.choice(words) + str(rnd.randint(0, 20)) for d in range(depth)]
+        paths.append('/'.join(dirs) + '/file{}{}'.format(i, rnd.choice(extensions)))
+
+    return paths
+
+def synthetic_patterns(count, rnd):
+    ''' Patrones de exclusión típicos: extensiones, nombres y directorios '''
+    patterns = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            patterns.append('*.ext{}'.format(i))
+        elif kind == 1:
+            patterns.append('*name{}*'.format(i))
+        else:
+            patterns.append('dir{}/*'.format(i))
+
+    # Algunos patrones que sí encajan
+    patterns[:4] = ['*.jpg', 'cache1/*', '*file12*', 'build2/*']
+
+    rnd.shuffle(patterns)
+    return patterns
+
+def bench_exclude(file_count = 200000, pattern_count = 200):
+    rnd = random.Random(1)
+    paths = synthetic_paths(file_count, rnd)
+    patterns = synthetic_patterns(pattern_count, rnd)
+
+    results = []
+    legacy = legacy_matcher(patterns)
+    matcher = exclude.ExcludeMatcher(patterns)
+
+    # Como en el escáner, un fichero también queda excluido si lo está alguno
+    # de sus directorios. El escáner prueba cada directorio una sola vez, así
+    # que solo medimos match_file().
+    def scanner_excluded(path):
+        parts = path.split('/')
+        return any(matcher.match_dir('/'.join(parts[:i])) for i in range(1, len(parts))) or matcher.match_file(path)
+
+    for label, measured, is_excluded in (('legacy', legacy, legacy), ('matcher', matcher.match_file, scanner_excluded)):
+        start = time.perf_counter()
+        excluded = {p for p in paths if measured(p)}
+        elapsed = time.perf_counter() - start
+
+        if is_excluded is not measured:
+            excluded = {p for p in paths if is_excluded(p)}
+
+        results.append((label, elapsed, excluded))
+        print('{:8} {:8.3f} s  {:10.0f} ficheros/s  {} excluidos'.format(label, elapsed, file_count / elapsed, len(excluded)))
+
+    print('Mejora: {:.1f}x con {} patrones'.format(results[0][1] / results[1][1], pattern_count))
+
+    # Los ficheros excluidos deben ser los mismos
+    only_legacy = sorted(results[0][2] - results[1][2])
+    only_matcher = sorted(results[1][2] - results[0][2])
+
+    if only_legacy or only_matcher:
+        print('Distintos: {} excluidos solo por legacy (e.g. {}), {} solo por matcher (e.g. {})'.format(
+            len(only_legacy), only_legacy[:3], len(only_matcher), only_matcher[:3]))
+        return False
+
+    print('Los dos excluyen los mismos ficheros.')
+    return True
+
+def legacy_cut_point(gear, data, start, end):
+    ''' La búsqueda de cortes original: el hash Gear, byte a byte en Python '''
+    limit = min(end, start + chunkstore.MAX_SIZE)
+
+    if limit - start <= chunkstore.MIN_SIZE:
+        return limit
+
+    h = 0
+    for i in range(start + chunkstore.MIN_SIZE, limit):
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+        if not h & (0xFFFF << 48):
+            return i + 1
+
+    return limit
+
+def bench_chunks(megabytes = 8):
+    rnd = random.Random(1)
+    size = megabytes * 1048576
+    words = [bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for i in range(rnd.randint(2, 10))) for w in range(5000)]
+    text = b' '.join(rnd.choice(words) for w in range(size // 6))[:size]
+    gear = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+    for label, data in (('random', rnd.randbytes(size)), ('text', text)):
+        results = []
+
+        for method in ('legacy', 'chunks'):
+            start = time.perf_counter()
+            bits = chunkstore.hash_bits(data) if method == 'chunks' else None
+            offset = 0
+            chunks = 0
+
+            while offset < len(data):
+                if bits is None:
+                    offset = legacy_cut_point(gear, data, offset, len(data))
+                else:
+                    offset = chunkstore.cut_point(data, offset, len(data), bits)
+                chunks += 1
+
+            elapsed = time.perf_counter() - start
+            results.append(elapsed)
+            print('{:7} {:7} {:8.1f} MB/s  {:8} bytes por trozo'.format(label, method, megabytes / elapsed, len(data) // chunks))
+
+        print('Mejora: {:.1f}x'.format(results[0] / results[1]))
+
+def synthetic_entries(count, seed = 1):
+    ''' Entradas del índice al azar, en unos cien mil directorios de hasta
+    cinco niveles '''
+    rnd = random.Random(seed)
+
+    for i in range(count):
+        name = '/'.join('dir{}'.format(rnd.randint(0, 9)) for d in range(rnd.randint(1, 5))) + '/file{}.txt'.format(i)
+        yield name, {
+            'size': rnd.randint(0, 1048576),
+            'mtime_ns': 1600000000000000000 + rnd.getrandbits(50),
+            'ino': 1000 + i,
+            'ctime_ns': 1600000000000000000 + rnd.getrandbits(50),
+            'target': name + '.gz',
+            'checksum': '{:064x}'.format(rnd.getrandbits(256)),
+        }
+
+def registry_child(kind, count):
+    ''' El registro de una copia sin cambios, como lo usa backup_path '''
+    if kind == 'dict':
+        registry = dict(synthetic_entries(count))
+        erase_list = registry.copy()
+        new_registry = {}
+    elif kind == 'compact':
+        registry = fileindex.Registry()
+        for name, entry in synthetic_entries(count):
+            registry[name] = entry
+        erase_list = registry.remaining()
+        new_registry = fileindex.Registry(base = registry)
+    else:
+        return
+
+    # El escaneo del origen: nombres nuevos, con el mismo stat
+    for name, entry in synthetic_entries(count):
+        entry = registry.get(name)
+        del erase_list[name]
+        new_registry[name] = entry
+
+def bench_registry(count = 1000000):
+    results = {}
+
+    for kind in ('none', 'dict', 'compact'):
+        command = [sys.executable, os.path.abspath(__file__), 'registry-child', kind, str(count)]
+
+        start = time.perf_counter()
+        process = subprocess.Popen(command)
+        pid, status, rusage = os.wait4(process.pid, 0)
+
+        results[kind] = {
+            'exit_code': os.waitstatus_to_exitcode(status),
+            'elapsed': time.perf_counter() - start,
+            'peak_rss_mb': rusage.ru_maxrss / 1024,
+        }
+
+    # Sin contar el intérprete
+    base = results.pop('none')['peak_rss_mb']
+    for result in results.values():
+        result['bytes_per_file'] = (result['peak_rss_mb'] - base) * 1048576 / count
+        result['peak_rss_20m_gb'] = (base * 1048576 + result['bytes_per_file'] * 20000000) / 1024 ** 3
+
+    print(json.dumps({
+        'files': count,
+        'interpreter_mb': base,
+        'results': results,
+    }, indent = 2))
+
+# Palabras para generar texto, que se comprime bien
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'backup', 'copia', 'fichero',
+    'datos', 'servidor', 'error', 'info', 'usuario', 'select', 'from', 'where')
+
+def random_content(rnd, size):
+    ''' Contenido con distinta compresibilidad: texto, binario al azar, o
+    ceros '''
+    kind = rnd.random()
+
+    if kind < 0.6:
+        line = ' '.join(rnd.choice(WORDS) for i in range(12)) + '\n'
+        return (line * (size // len(line) + 1)).encode()[:size]
+    elif kind < 0.9:
+        return rnd.getrandbits(size * 8).to_bytes(size, 'little') if size else b''
+    else:
+        return bytes(size)
+
+def write_big_file(filename, rnd, size):
+    ''' Ficheros grandes, mitad texto y mitad binario, escritos por bloques '''
+    block = 1048576
+    text = random_content(random.Random(1), block)
+    binary = rnd.getrandbits(block * 8).to_bytes(block, 'little')
+
+    with open(filename, 'wb') as f:
+        for i in range(size // block):
+            f.write(text if i % 2 else binary)
+
+def generate_tree(root, scale = 1, seed = 1):
+    ''' Genera el árbol de prueba. Devuelve la lista de ficheros creados. '''
+    rnd = random.Random(seed)
+    files = []
+
+    # Muchos ficheros pequeños, en directorios de hasta 12 niveles
+    dirs = ['']
+    for i in range(int(60 * scale)):
+        parent = rnd.choice(dirs)
+        if parent.count('/') < 12:
+            dirs.append(os.path.join(parent, 'dir{}'.format(i)))
+
+    for d in dirs:
+        os.makedirs(os.path.join(root, d), exist_ok = True)
+
+    for i in range(int(3000 * scale)):
+        name = os.path.join(rnd.choice(dirs), 'file{}{}'.format(i, rnd.choice(('.txt', '.log', '.bin', '.dat'))))
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(random_content(rnd, rnd.randint(0, 16384)))
+        files.append(name)
+
+    # Unos pocos ficheros grandes
+    for i in range(2):
+        name = 'big{}.img'.format(i)
+        write_big_file(os.path.join(root, name), rnd, int(32 * scale) * 1048576)
+        files.append(name)
+
+    return files
+
+def modify_tree(root, files, seed = 2):
+    ''' Modifica el 5% de los ficheros, borra el 1%, y crea un 1% nuevo '''
+    rnd = random.Random(seed)
+    small = [f for f in files if not f.startswith('big')]
+
+    for name in rnd.sample(small, len(small) // 20):
+        with open(os.path.join(root, name), 'ab') as f:
+            f.write(random_content(rnd, 512))
+
+    for name in rnd.sample(small, len(small) // 100):
+        if os.path.exists(os.path.join(root, name)):
+            os.unlink(os.path.join(root, name))
+
+    for i in range(len(small) // 100):
+        with open(os.path.join(root, 'new{}.txt'.format(i)), 'wb') as f:
+            f.write(random_content(rnd, 4096))
+
+def run_backup(backup_args, label):
+    ''' Ejecuta backup.py, y devuelve sus estadísticas y el uso de recursos '''
+    # Se crea vacío, para que nadie más pueda crearlo antes; backup.py
+    # escribe en él al terminar
+    fd, stats_file = tempfile.mkstemp(suffix = '.json')
+    os.close(fd)
+
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backup.py'),
+        '-q', '--stats', stats_file] + backup_args
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout = subprocess.DEVNULL)
+
+    # wait4() devuelve el uso de recursos solo de este proceso
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'label': label,
+        'exit_code': process.returncode,
+        'elapsed': elapsed,
+        # ru_maxrss está en KB en Linux
+        'peak_rss_mb': rusage.ru_maxrss / 1024,
+        'cpu_user': rusage.ru_utime,
+        'cpu_system': rusage.ru_stime,
+    }
+
+    with open(stats_file) as f:
+        stats = f.read()
+    os.unlink(stats_file)
+
+    if stats:
+        stats = json.loads(stats)
+
+        result['version'] = stats['version']
+        result['files'] = sum(p['files'] for p in stats['paths'].values())
+        result['bytes'] = sum(p['bytes'] for p in stats['paths'].values())
+        result['files_per_second'] = result['files'] / elapsed
+        result['mb_per_second'] = result['bytes'] / 1048576 / elapsed
+
+        phases = {}
+        for p in stats['paths'].values():
+            for phase, seconds in p['phases'].items():
+                phases[phase] = phases.get(phase, 0) + seconds
+        result['phases'] = phases
+
+    return result
+
+def bench_run(scale = 1, backup_args = ()):
+    workdir = tempfile.mkdtemp(prefix = 'backup-bench-')
+    source = os.path.join(workdir, 'source')
+    results = []
+
+    try:
+        start = time.perf_counter()
+        files = generate_tree(source, scale)
+        print('Árbol generado: {} ficheros en {:.1f} s'.format(len(files), time.perf_counter() - start), file = sys.stderr)
+
+        def target(name):
+            path = os.path.join(workdir, name)
+            os.makedirs(path, exist_ok = True)
+            return path
+
+        args = list(backup_args)
+
+        results.append(run_backup(args + ['-f', source, target('full')], 'full'))
+        results.append(run_backup(args + [source, target('incremental')], 'incremental_initial'))
+        results.append(run_backup(args + [source, target('incremental')], 'incremental_unchanged'))
+        results.append(run_backup(args + ['-h', '-H', 'gen1', source, target('historic')], 'historic_initial'))
+
+        modify_tree(source, files)
+
+        results.append(run_backup(args + [source, target('incremental')], 'incremental_modified'))
+        results.append(run_backup(args + ['-h', '-H', 'gen2', source, target('historic')], 'historic_modified'))
+    finally:
+        shutil.rmtree(workdir)
+
+    print(json.dumps({
+        'scale': scale,
+        'backup_args': list(backup_args),
+        'results': results,
+    }, indent = 2))
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == 'exclude':
+        sys.exit(0 if bench_exclude(*[int(a) for a in sys.argv[2:4]]) else 1)
+    elif command == 'chunks':
+        bench_chunks(*[int(a) for a in sys.argv[2:3]])
+    elif command == 'registry':
+        bench_registry(*[int(a) for a in sys.argv[2:3]])
+    elif command == 'registry-child':
+        registry_child(sys.argv[2], int(sys.argv[3]))
+    elif command == 'tree' and len(sys.argv) > 2:
+        files = generate_tree(sys.argv[2], *[float(a) if i == 0 else int(a) for i, a in enumerate(sys.argv[3:5])])
+        print('{} ficheros generados'.format(len(files)))
+    elif command == 'run':
+        scale = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+        bench_run(scale, sys.argv[3:])
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,401 @@
+'''
+Diario de cambios del origen, con inotify.
+
+Una copia incremental sin cambios igual tiene que recorrer todo el origen.
+En cambio, 'backup.py --watch' se queda vigilando las rutas de origen con
+inotify, y anota en un diario los directorios donde algo cambió. La
+siguiente copia solo escanea esos directorios, y el resto de ficheros los
+toma del índice, sin cambios.
+
+Por cada ruta de origen hay, en la carpeta del diario:
+
+  - ID.state: el vigilante que está funcionando (pid, sesión), escrito
+    cuando ya vigila todos los directorios. Se actualiza su fecha cada
+    HEARTBEAT segundos.
+  - ID.journal: los cambios, una línea JSON por cada directorio cambiado:
+    ["D", dir] solo para sus ficheros, ["R", dir] para todo su árbol (los
+    directorios nuevos, movidos o borrados), y ["!"] si se perdieron
+    eventos.
+  - ID.processing: los cambios que está usando una copia. Al empezar, la
+    copia mueve ahí el diario; si se interrumpe, la siguiente los vuelve a
+    usar.
+  - ID.synced: la sesión del vigilante con la que terminó la última copia,
+    y su destino.
+
+El diario solo se usa si el vigilante sigue siendo el mismo (la misma
+sesión) que cuando empezó la copia anterior al mismo destino, y no se
+perdieron eventos. Si no, la copia escanea todo el origen, como siempre.
+Cada diario es para un solo destino: con dos destinos, cada uno necesita su
+carpeta y su vigilante.
+'''
+
+import os, json, time, uuid, errno, struct, select, signal, hashlib, ctypes, ctypes.util
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Cada cuánto el vigilante graba los cambios y actualiza su estado
+FLUSH_INTERVAL = 1
+HEARTBEAT = 10
+
+# Sin actualizar el estado en este tiempo, el vigilante se considera muerto
+HEARTBEAT_TIMEOUT = 60
+
+# De linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+def _root_id(root):
+    return hashlib.sha1(root.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+
+def _read_json(filename):
+    try:
+        with open(filename) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def _write_json(filename, data):
+    with open(filename + '.tmp', 'w') as f:
+        f.write(json.dumps(data))
+    os.replace(filename + '.tmp', filename)
+
+class _Locked:
+    ''' Bloqueo entre el vigilante y la copia, para mover el diario sin
+    perder líneas '''
+    def __init__(self, base):
+        self.filename = base + '.lock'
+
+    def __enter__(self):
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+
+def _join(rel, name):
+    return rel + '/' + name if rel else name
+
+def _ancestors(rel):
+    ''' El directorio y todos sus padres, hasta la raíz ('') '''
+    while True:
+        yield rel
+        if not rel:
+            return
+        rel = rel.rpartition('/')[0]
+
+class Changes:
+    ''' Los directorios que cambiaron en una ruta de origen '''
+
+    def __init__(self, dirs, trees):
+        self.dirs = dirs
+        self.trees = trees
+
+    def covers(self, filename):
+        ''' ¿Está el fichero en un directorio que hay que escanear? '''
+        dirname = filename.rpartition('/')[0]
+        return dirname in self.dirs or any(parent in self.trees for parent in _ancestors(dirname))
+
+    def scan(self, path, scanner, follow_symlinks, is_excluded, is_dir_excluded, on_error):
+        ''' Escanea los directorios que cambiaron, con el módulo 'scanner'.
+        Devuelve tuplas (ruta relativa, stat) como scanner.scan_tree. '''
+        def excluded(rel):
+            return is_dir_excluded is not None and any(is_dir_excluded(parent) for parent in _ancestors(rel) if parent)
+
+        for rel in sorted(self.trees):
+            # Dentro de otro árbol que ya escaneamos
+            if any(parent in self.trees for parent in _ancestors(rel) if parent != rel) or excluded(rel):
+                continue
+
+            directory = os.path.join(path, rel)
+            if os.path.isdir(directory):
+                yield from scanner.scan_tree(directory, follow_symlinks, is_excluded, on_error, 1, is_dir_excluded, rel + '/' if rel else '')
+
+        for rel in sorted(self.dirs):
+            if any(parent in self.trees for parent in _ancestors(rel)) or excluded(rel):
+                continue
+
+            directory = os.path.join(path, rel)
+            if os.path.isdir(directory):
+                yield from scanner.scan_dir(directory, follow_symlinks, is_excluded, on_error, rel + '/' if rel else '')
+
+class ChangeJournal:
+    ''' El diario de cambios de una ruta de origen, del lado de la copia '''
+
+    def __init__(self, directory, root, target):
+        self.base = os.path.join(directory, _root_id(root))
+        self.target = target
+        self.session = None
+
+    def begin(self):
+        ''' Toma los cambios anotados hasta ahora. Devuelve un Changes, o None
+        si hay que escanear todo el origen. '''
+        journal = self.base + '.journal'
+        processing = self.base + '.processing'
+
+        with _Locked(self.base):
+            state = _read_json(self.base + '.state')
+
+            if os.path.exists(journal):
+                if os.path.exists(processing):
+                    # Los de una copia interrumpida, más los nuevos
+                    with open(journal) as source, open(processing, 'a') as target:
+                        target.write(source.read())
+                    os.unlink(journal)
+                else:
+                    os.rename(journal, processing)
+
+        if state and self._alive(state):
+            self.session = state['session']
+
+        synced = _read_json(self.base + '.synced')
+        if self.session is None or not synced or synced.get('session') != self.session or synced.get('target') != self.target:
+            return None
+
+        dirs = set()
+        trees = set()
+
+        try:
+            with open(processing) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record[0] == '!':
+                        return None
+                    (trees if record[0] == 'R' else dirs).add(record[1])
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            return None
+
+        return Changes(dirs, trees)
+
+    def _alive(self, state):
+        try:
+            if time.time() - os.stat(self.base + '.state').st_mtime > HEARTBEAT_TIMEOUT:
+                return False
+            os.kill(state['pid'], 0)
+        except PermissionError:
+            # Funciona, pero con otro usuario
+            pass
+        except (OSError, KeyError):
+            return False
+
+        return True
+
+    def commit(self):
+        ''' La copia terminó: los cambios tomados ya están en el destino '''
+        if self.session:
+            _write_json(self.base + '.synced', {'session': self.session, 'target': self.target})
+        else:
+            # Sin vigilante, la próxima copia también escanea todo
+            try:
+                os.unlink(self.base + '.synced')
+            except FileNotFoundError:
+                pass
+
+        try:
+            os.unlink(self.base + '.processing')
+        except FileNotFoundError:
+            pass
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify no está disponible')
+
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1: ' + os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        ''' Devuelve los eventos (wd, máscara, nombre) que llegan en 'timeout'
+        segundos '''
+        events = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return events
+
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+
+        return events
+
+class Watcher:
+    ''' Vigila las rutas de origen, y anota los cambios en sus diarios '''
+
+    def __init__(self, directory, roots, logger):
+        self.directory = directory
+        self.roots = roots
+        self.logger = logger
+        self.inotify = Inotify()
+
+        # wd => (raíz, directorio relativo)
+        self.watches = {}
+
+        # raíz => líneas por grabar
+        self.pending = {root: set() for root in roots}
+
+    def add_tree(self, root, rel):
+        ''' Vigila un directorio y todos sus subdirectorios '''
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(root, rel)
+
+            try:
+                self.watches[self.inotify.add_watch(path)] = (root, rel)
+                iterator = os.scandir(path)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise OSError(e.errno, 'No hay más vigilancias de inotify disponibles. Aumenta fs.inotify.max_user_watches.') from e
+
+                # Borrado mientras lo recorríamos: ya quedó anotado
+                continue
+
+            with iterator:
+                for entry in iterator:
+                    try:
+                        if entry.is_dir(follow_symlinks = False):
+                            stack.append(_join(rel, entry.name))
+                    except OSError:
+                        pass
+
+    def remove_tree(self, root, rel):
+        ''' Deja de vigilar un directorio movido fuera de su sitio '''
+        for wd, (watch_root, watch_rel) in list(self.watches.items()):
+            if watch_root == root and (watch_rel == rel or watch_rel.startswith(rel + '/')):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            for lines in self.pending.values():
+                lines.add(('!',))
+            return
+
+        if wd not in self.watches:
+            return
+
+        root, rel = self.watches[wd]
+
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if not rel:
+                # Se borró o se movió la raíz
+                self.pending[root].add(('!',))
+        elif mask & IN_ISDIR:
+            child = _join(rel, name)
+            if mask & IN_MOVED_FROM:
+                self.remove_tree(root, child)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(root, child)
+            self.pending[root].add(('R', child))
+        else:
+            self.pending[root].add(('D', rel))
+
+    def flush(self):
+        for root, lines in self.pending.items():
+            if not lines:
+                continue
+
+            base = os.path.join(self.directory, _root_id(root))
+            with _Locked(base):
+                with open(base + '.journal', 'a') as f:
+                    for line in sorted(lines):
+                        f.write(json.dumps(list(line)) + '\n')
+
+            lines.clear()
+
+    def run(self):
+        os.makedirs(self.directory, exist_ok = True)
+
+        for root in self.roots:
+            self.logger.info('{}: Vigilando...'.format(root))
+            self.add_tree(root, '')
+
+        # Recién ahora vigilamos todo: las copias pueden usar el diario
+        session = uuid.uuid4().hex
+        state_files = []
+        for root in self.roots:
+            state_file = os.path.join(self.directory, _root_id(root) + '.state')
+            _write_json(state_file, {'root': root, 'pid': os.getpid(), 'session': session})
+            state_files.append(state_file)
+
+        self.logger.info('Vigilando {} directorios.'.format(len(self.watches)))
+
+        next_heartbeat = time.monotonic() + HEARTBEAT
+        try:
+            while True:
+                for event in self.inotify.read(FLUSH_INTERVAL):
+                    self.handle(*event)
+
+                self.flush()
+
+                if time.monotonic() >= next_heartbeat:
+                    for state_file in state_files:
+                        os.utime(state_file)
+                    next_heartbeat = time.monotonic() + HEARTBEAT
+        finally:
+            self.flush()
+
+            # Sin vigilante, las copias vuelven a escanear todo
+            for state_file in state_files:
+                try:
+                    os.unlink(state_file)
+                except OSError:
+                    pass
+
+def watch(directory, roots, logger):
+    ''' Vigila las rutas 'roots' hasta recibir Ctrl-C o SIGTERM. Devuelve el
+    código de salida del programa. '''
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        Watcher(directory, roots, logger).run()
+    except KeyboardInterrupt:
+        logger.info('Vigilancia terminada.')
+    except OSError as e:
+        logger.error('No puedo vigilar el origen ({}).'.format(str(e)))
+        return 1
+
+    return 0
@@ -0,0 +1,258 @@
+'''
+Almacén de trozos deduplicados, direccionado por contenido.
+
+Cada fichero se divide en trozos con 'content-defined chunking': los cortes
+se hacen donde un hash de los últimos bytes cumple una condición, así que
+añadir o cambiar unos bytes solo cambia los trozos cercanos.
+
+El hash no se calcula byte a byte en Python, que no pasa de unos 5 MB/s: cada
+byte aporta un bit, el XOR de su valor en tres tablas, una para el byte y
+otras dos para los dos anteriores. Las tablas se aplican con
+bytes.translate(), el XOR se hace con enteros de Python, y el corte se busca
+con bytes.find(): todo en C. Se corta al final de los 16 bytes cuyos bits
+forman PATTERN, uno de cada 64k bytes. Cada trozo se guarda una sola vez, comprimido con gzip, en
+'.chunks/xx/<sha256>' dentro de la carpeta destino.
+
+En el lugar del fichero, en el árbol de la copia, queda un pequeño manifiesto
+'.chunks' con el hash de cada trozo, uno por línea. Así los manifiestos se
+pueden enlazar, borrar y escanear como cualquier otro fichero de la copia.
+Para recuperar un fichero a mano basta con concatenar sus trozos en orden y
+descomprimirlos con gunzip.
+'''
+
+import os, gzip, hashlib, threading
+
+CHUNKS_DIRNAME = '.chunks'
+CHUNK_EXTENSION = '.chunks'
+
+# Tamaños de los trozos. El promedio sale del patrón: 16 bits, 64k.
+MIN_SIZE = 16 * 1024
+MAX_SIZE = 256 * 1024
+
+def _bit_table(seed):
+    ''' Un bit por valor de byte, 0 o 1, la mitad de cada uno '''
+    order = sorted(range(256), key = lambda i: hashlib.sha256(bytes([seed, i])).digest())
+    return bytes(order.index(i) >> 7 for i in range(256))
+
+# Las tablas y el patrón deben ser siempre los mismos, o los trozos de una
+# copia nueva no coincidirán con los de las anteriores
+TABLES = [_bit_table(seed) for seed in range(3)]
+PATTERN = bytes(int(bit) for bit in '0110100010111001')
+
+def hash_bits(data):
+    ''' Devuelve un byte, 0 o 1, por cada byte de 'data': su bit del hash,
+    que depende del byte y de los dos anteriores '''
+    bits = 0
+    for shift, table in enumerate(TABLES):
+        bits ^= int.from_bytes(data.translate(table), 'little') << (8 * shift)
+
+    return bits.to_bytes(len(data) + len(TABLES), 'little')[:len(data)]
+
+def cut_point(data, start, end, bits = None):
+    ''' Devuelve el final del trozo que empieza en 'start' dentro de
+    data[start:end]. 'bits' es el hash_bits() de todo 'data', si ya se
+    calculó. '''
+    limit = min(end, start + MAX_SIZE)
+
+    if limit - start <= MIN_SIZE:
+        return limit
+
+    # Nunca cortamos antes de MIN_SIZE, así que ni siquiera lo calculamos
+    first = start + MIN_SIZE - len(PATTERN) + 1
+
+    if bits is None:
+        offset = first - len(TABLES) + 1
+        i = hash_bits(data[offset:limit]).find(PATTERN, first - offset)
+        i = i + offset if i >= 0 else -1
+    else:
+        i = bits.find(PATTERN, first, limit)
+
+    return i + len(PATTERN) if i >= 0 else limit
+
+class ChunkStore:
+    def __init__(self, target):
+        self.root = os.path.join(target, CHUNKS_DIRNAME)
+
+    def chunk_path(self, chunk_hash):
+        return os.path.join(self.root, chunk_hash[:2], chunk_hash)
+
+    def put(self, data):
+        ''' Guarda un trozo, si no existe ya. Devuelve su hash '''
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        filename = self.chunk_path(chunk_hash)
+
+        if not os.path.exists(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok = True)
+
+            # Grabamos a un temporal y lo renombramos, para que otro hilo que
+            # guarde el mismo trozo nunca vea un fichero a medias
+            tmp_filename = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+            with open(tmp_filename, 'wb') as f:
+                f.write(gzip.compress(data, mtime = 0))
+            os.replace(tmp_filename, filename)
+
+        return chunk_hash
+
+    def get(self, chunk_hash):
+        with open(self.chunk_path(chunk_hash), 'rb') as f:
+            return gzip.decompress(f.read())
+
+    def open(self, filename, mode = 'rb'):
+        ''' Abre un manifiesto. Tiene la misma firma que gzip.GzipFile, para
+        usarse como 'target_module' '''
+        if mode == 'wb':
+            return ChunkWriter(self, filename)
+
+        return ChunkReader(self, filename)
+
+    def referenced(self, manifest_filename):
+        ''' Devuelve los hashes de los trozos usados por un manifiesto '''
+        with open(manifest_filename) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def collect_garbage(self, roots, on_error = None):
+        ''' Borra los trozos que no usa ningún manifiesto dentro de 'roots'.
+        Devuelve una tupla (trozos borrados, bytes liberados). 'on_error'
+        recibe la excepción de cada trozo que no se pudo borrar. Si no se
+        puede leer algún manifiesto o directorio, lanza RuntimeError sin
+        borrar nada. '''
+
+        def walk_error(e):
+            raise RuntimeError('No pude leer {} ({}).'.format(e.filename, e.strerror))
+
+        # Marcamos los trozos usados. Los manifiestos enlazados entre copias
+        # históricas se leen una sola vez. Los hashes se guardan en binario,
+        # que ocupa la mitad.
+        referenced = set()
+        seen = set()
+
+        for root in roots:
+            for dir_path, dirnames, filenames in os.walk(root, onerror = walk_error):
+                for name in filenames:
+                    if not name.endswith(CHUNK_EXTENSION):
+                        continue
+
+                    filename = os.path.join(dir_path, name)
+                    try:
+                        st = os.lstat(filename)
+                        if (st.st_dev, st.st_ino) in seen:
+                            continue
+                        seen.add((st.st_dev, st.st_ino))
+
+                        referenced.update(bytes.fromhex(h) for h in self.referenced(filename))
+                    except (OSError, ValueError) as e:
+                        # Sin leer todos los manifiestos, no sabemos qué
+                        # trozos se pueden borrar
+                        raise RuntimeError('No pude leer el manifiesto {} ({}).'.format(filename, str(e)))
+
+        # Y borramos el resto, incluyendo temporales huérfanos
+        removed = 0
+        reclaimed = 0
+
+        if not os.path.isdir(self.root):
+            return removed, reclaimed
+
+        for subdir in os.scandir(self.root):
+            if not subdir.is_dir(follow_symlinks = False):
+                continue
+
+            for entry in os.scandir(subdir.path):
+                try:
+                    used = bytes.fromhex(entry.name) in referenced
+                except ValueError:
+                    used = False
+
+                if not used:
+                    try:
+                        size = entry.stat(follow_symlinks = False).st_size
+                        os.unlink(entry.path)
+                        removed += 1
+                        reclaimed += size
+                    except OSError as e:
+                        if on_error:
+                            on_error(e)
+
+        return removed, reclaimed
+
+class ChunkWriter:
+    ''' Fichero de escritura que corta los datos en trozos, los guarda en el
+    almacén, y escribe el manifiesto al cerrarse '''
+
+    def __init__(self, store, filename):
+        self.store = store
+        self.manifest = open(filename, 'w')
+        self.buffer = b''
+
+    def _flush(self, final = False):
+        buffer = self.buffer
+        start = 0
+
+        if len(buffer) < MAX_SIZE and not final:
+            return
+
+        # El buffer siempre empieza en un corte, así que el hash de todo el
+        # buffer sirve para todos sus trozos
+        bits = hash_bits(buffer)
+
+        # Sin los datos finales, solo cortamos si hay espacio para un trozo
+        # de tamaño máximo
+        while len(buffer) - start >= MAX_SIZE or (final and start < len(buffer)):
+            end = cut_point(buffer, start, len(buffer), bits)
+            self.manifest.write(self.store.put(memoryview(buffer)[start:end]) + '\n')
+            start = end
+
+        self.buffer = buffer[start:]
+
+    def write(self, data):
+        if data:
+            self.buffer += data
+            self._flush()
+
+        return len(data)
+
+    def close(self):
+        if self.manifest.closed:
+            return
+
+        try:
+            self._flush(True)
+        finally:
+            self.manifest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ChunkReader:
+    ''' Fichero de lectura que devuelve el contenido original de un
+    manifiesto, trozo a trozo '''
+
+    def __init__(self, store, filename):
+        self.store = store
+        self.hashes = iter(store.referenced(filename))
+        self.buffer = b''
+
+    def read(self, size = -1):
+        while size < 0 or len(self.buffer) < size:
+            chunk_hash = next(self.hashes, None)
+            if chunk_hash is None:
+                break
+            self.buffer += self.store.get(chunk_hash)
+
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
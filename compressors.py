@@ -0,0 +1,183 @@
+'''
+Compresores disponibles para los ficheros de la copia.
+
+Cada compresor (Codec) tiene la extensión que se añade al fichero, una
+función para abrir ficheros con la misma firma que gzip.GzipFile, y
+opcionalmente una función que comprime un bloque de datos de forma
+independiente.
+
+Estas últimas permiten comprimir un fichero por bloques en paralelo, igual
+que pigz o pbzip2: el fichero se divide en bloques, cada bloque se comprime
+por separado en un hilo de trabajo, y se escriben en orden. El resultado es
+un fichero con varios miembros (o 'frames') concatenados, que gunzip,
+bunzip2, zstd y lz4 descomprimen sin problemas.
+
+zstd y lz4 necesitan los módulos 'zstandard' y 'lz4', que son opcionales.
+'''
+
+import gzip, bz2, collections, functools, builtins
+
+import chunkstore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Tamaño de cada bloque: 10 veces los 900k de un bloque de bzip2
+BLOCK_SIZE = 9216000
+
+# Tipos de fichero que ya vienen comprimidos, para --skip-compressed
+COMPRESSED_EXTENSIONS = (
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.ogg', '.flac', '.aac', '.m4a', '.opus',
+    '.mp4', '.mkv', '.avi', '.mov', '.webm', '.m4v',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.lz4', '.7z', '.rar',
+    '.jar', '.apk', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub',
+)
+
+class Codec:
+    def __init__(self, name, extension, open, compress_block = None):
+        self.name = name
+        self.extension = extension
+        self.open = open
+        self.compress_block = compress_block
+
+def _gzip_codec(level):
+    level = 9 if level is None else level
+
+    return Codec('gzip', '.gz',
+        functools.partial(_gzip_open, compresslevel = level),
+        # mtime = 0 para que la salida no dependa de la hora
+        functools.partial(gzip.compress, compresslevel = level, mtime = 0))
+
+def _gzip_open(filename, mode = 'rb', compresslevel = 9):
+    ''' 'filename' puede ser un nombre o un fichero ya abierto, como con el
+    resto de compresores '''
+    if mode == 'rb':
+        return gzip.open(filename, mode)
+
+    return gzip.open(filename, mode, compresslevel)
+
+def _bzip_codec(level):
+    level = 9 if level is None else level
+
+    return Codec('bzip', '.bz2',
+        functools.partial(bz2.BZ2File, compresslevel = level),
+        functools.partial(bz2.compress, compresslevel = level))
+
+def _zstd_codec(level, threads):
+    if not zstandard:
+        raise ValueError("El compresor 'zstd' necesita el módulo 'zstandard' (pip install zstandard).")
+
+    level = 3 if level is None else level
+
+    def open(filename, mode = 'rb'):
+        if mode == 'rb':
+            # Como gzip, se puede leer de un fichero ya abierto. Los ficheros
+            # comprimidos por bloques tienen varios 'frames'.
+            source = filename if hasattr(filename, 'read') else builtins.open(filename, 'rb')
+            return zstandard.ZstdDecompressor().stream_reader(source, read_across_frames = True, closefd = source is not filename)
+
+        return zstandard.open(filename, mode, cctx = zstandard.ZstdCompressor(level = level, threads = threads))
+
+    def compress_block(data):
+        return zstandard.ZstdCompressor(level = level).compress(data)
+
+    return Codec('zstd', '.zst', open, compress_block)
+
+def _lz4_codec(level):
+    if not lz4:
+        raise ValueError("El compresor 'lz4' necesita el módulo 'lz4' (pip install lz4).")
+
+    level = 0 if level is None else level
+
+    def open(filename, mode = 'rb'):
+        if mode == 'rb':
+            return lz4.frame.open(filename, mode)
+
+        return lz4.frame.open(filename, mode, compression_level = level)
+
+    return Codec('lz4', '.lz4', open, functools.partial(lz4.frame.compress, compression_level = level))
+
+def get_codec(name, level = None, threads = 0, target = None):
+    ''' Devuelve el compresor 'name', o None para copiar sin comprimir.
+    Lanza ValueError si no existe o no está disponible. '''
+    if not name:
+        return None
+    elif name == 'gzip':
+        return _gzip_codec(level)
+    elif name == 'bzip':
+        return _bzip_codec(level)
+    elif name == 'zstd':
+        return _zstd_codec(level, threads)
+    elif name == 'lz4':
+        return _lz4_codec(level)
+    elif name == 'store':
+        # Gzip sin compresión: casi tan rápido como una copia, pero el fichero
+        # sigue teniendo extensión, y no choca con otros del destino.
+        codec = _gzip_codec(0)
+        codec.name = 'store'
+        return codec
+    elif name == 'chunks':
+        # Cada fichero queda como un manifiesto de trozos
+        return Codec('chunks', chunkstore.CHUNK_EXTENSION, chunkstore.ChunkStore(target).open)
+
+    raise ValueError("Compresor desconocido: '{}'".format(name))
+
+def fast_codec_name():
+    ''' El compresor más rápido disponible, para los ficheros que ya vienen
+    comprimidos '''
+    return 'lz4' if lz4 else 'store'
+
+# Extensiones de todos los compresores, para reconocerlas en el destino
+EXTENSIONS = ('.gz', '.bz2', '.zst', '.lz4', chunkstore.CHUNK_EXTENSION)
+
+# El compresor de cada extensión. 'store' se lee igual que 'gzip'.
+EXTENSION_CODECS = {
+    '.gz': 'gzip',
+    '.bz2': 'bzip',
+    '.zst': 'zstd',
+    '.lz4': 'lz4',
+    chunkstore.CHUNK_EXTENSION: 'chunks',
+}
+
+def codec_for_extension(filename, target = None):
+    ''' Devuelve el compresor con el que se lee un fichero de la copia,
+    según su extensión, o None si no tiene la de ningún compresor. Lanza
+    ValueError si el compresor no está disponible. '''
+    for extension, name in EXTENSION_CODECS.items():
+        if filename.endswith(extension):
+            return get_codec(name, target = target)
+
+    return None
+
+def compress_blocks(source_fd, target_fd, compress, executor, hasher = None, max_pending = 4):
+    ''' Lee 'source_fd' por bloques, los comprime con la función 'compress' en
+    los hilos de 'executor', y los escribe en orden en 'target_fd'. Como
+    mucho mantiene 'max_pending' bloques en memoria. Si se pasa 'hasher',
+    lo actualiza con los datos sin comprimir. '''
+
+    pending = collections.deque()
+
+    while True:
+        data = source_fd.read(BLOCK_SIZE)
+        if not data:
+            break
+
+        if hasher:
+            hasher.update(data)
+
+        pending.append(executor.submit(compress, data))
+
+        # Escribimos los bloques ya terminados, en orden
+        while len(pending) >= max_pending:
+            target_fd.write(pending.popleft().result())
+
+    while pending:
+        target_fd.write(pending.popleft().result())
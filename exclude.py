@@ -0,0 +1,152 @@
+'''
+Patrones de exclusión, compilados en una sola expresión regular.
+
+Los patrones son de shell, con las extensiones de .gitignore:
+
+  - '*' y '?' no cruzan directorios. '**' sí: 'a/**/b', '**/b', 'a/**'.
+  - '[abc]' y '[!abc]' son clases de caracteres.
+  - Un patrón que empieza con '/' está anclado a la raíz de la ruta
+    respaldada. Sin '/' inicial encaja en cualquier directorio.
+  - Un patrón que acaba con '/' solo encaja con directorios.
+
+Si un patrón encaja con un directorio, se excluye todo su contenido, y el
+escáner ni siquiera entra en él.
+
+Un patrón inválido, como una clase con un rango al revés ('[z-a]'), lanza
+ValueError.
+'''
+
+import re
+
+# Prefijo de los patrones que encajan en cualquier directorio
+UNANCHORED = '(?:.*/)?'
+
+def translate(pattern):
+    ''' Convierte un patrón a una expresión regular, sin anclar '''
+    regexp = ''
+    i = 0
+    n = len(pattern)
+
+    while i < n:
+        c = pattern[i]
+
+        if pattern.startswith('**/', i):
+            # Cero o más directorios
+            regexp += '(?:.*/)?'
+            i += 3
+            continue
+        elif pattern.startswith('**', i):
+            regexp += '.*'
+            i += 2
+            continue
+        elif c == '*':
+            regexp += '[^/]*'
+        elif c == '?':
+            regexp += '[^/]'
+        elif c == '[':
+            # Como en fnmatch, un ']' justo después de '[' o '[!' es un
+            # carácter más de la clase
+            start = i + 2 if pattern.startswith('[!', i) else i + 1
+            end = pattern.find(']', start + 1 if pattern.startswith(']', start) else start)
+
+            if end == -1:
+                regexp += re.escape(c)
+            else:
+                chars = re.sub(r'([\\\[\]^&~|])', r'\\\1', pattern[start:end])
+                regexp += ('[^' if start == i + 2 else '[') + chars + ']'
+                i = end
+        else:
+            regexp += re.escape(c)
+
+        i += 1
+
+    return regexp
+
+class ExcludeMatcher:
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+
+        # Los patrones se reparten en tres grupos, y cada grupo se compila en
+        # una sola expresión regular:
+        #   - Los '*.ext' se resuelven con un solo str.endswith().
+        #   - Los que no tienen '/' se comparan solo con el nombre del
+        #     fichero, sin recorrer la ruta completa.
+        #   - El resto se compara con la ruta completa.
+        suffixes = []
+        name_regexps = ([], [])
+        path_regexps = ([], [])
+
+        for original in self.patterns:
+            dir_only = original.endswith('/')
+            pattern = original.rstrip('/')
+
+            if not pattern:
+                continue
+
+            if pattern.startswith('/'):
+                group = path_regexps
+                regexp = translate(pattern[1:])
+            elif '/' in pattern:
+                group = path_regexps
+                regexp = UNANCHORED + translate(pattern)
+            elif re.fullmatch(r'\*\.[^*?\[]+', pattern) and not dir_only:
+                suffixes.append(pattern[1:])
+                continue
+            else:
+                group = name_regexps
+                regexp = translate(pattern)
+
+            # Cada patrón se compila por separado, para saber cuál es el
+            # inválido (e.g. un rango al revés, como '[z-a]')
+            try:
+                re.compile(regexp)
+            except re.error as e:
+                raise ValueError("El patrón de exclusión '{}' es inválido ({}).".format(original, e))
+
+            # Los directorios usan todos los patrones. Los ficheros, todos
+            # menos los que acaban en '/'
+            group[1].append(regexp)
+            if not dir_only:
+                group[0].append(regexp)
+
+        self.suffixes = tuple(suffixes)
+        self.file_regexps = (self._compile(name_regexps[0]), self._compile(path_regexps[0]))
+        self.dir_regexps = (self._compile(name_regexps[1]), self._compile(path_regexps[1]))
+
+    @staticmethod
+    def _compile(regexps):
+        if not regexps:
+            return None
+
+        # Los no anclados comparten el prefijo, así que lo sacamos factor
+        # común: se prueba una vez por cada '/' de la ruta, no una vez por
+        # patrón.
+        anchored = ['(?:{})'.format(r) for r in regexps if not r.startswith(UNANCHORED)]
+        unanchored = ['(?:{})'.format(r[len(UNANCHORED):]) for r in regexps if r.startswith(UNANCHORED)]
+
+        if unanchored:
+            anchored.append(UNANCHORED + '(?:{})'.format('|'.join(unanchored)))
+
+        return re.compile('|'.join(anchored), re.DOTALL)
+
+    def _match(self, path, regexps):
+        if self.suffixes and path.endswith(self.suffixes):
+            return True
+
+        name_regexp, path_regexp = regexps
+
+        if name_regexp and name_regexp.fullmatch(path, path.rfind('/') + 1):
+            return True
+
+        return bool(path_regexp and path_regexp.fullmatch(path))
+
+    def match_file(self, path):
+        ''' ¿Está excluido el fichero? 'path' es relativo a la ruta respaldada '''
+        return self._match(path, self.file_regexps)
+
+    def match_dir(self, path):
+        ''' ¿Está excluido el directorio, y todo su contenido? '''
+        return self._match(path, self.dir_regexps)
+
+    def __bool__(self):
+        return bool(self.patterns)
@@ -0,0 +1,196 @@
+'''
+Copia de ficheros sin pasar los datos por Python.
+
+Se prueba, en orden:
+
+  - Un reflink (ioctl FICLONE): en btrfs o XFS el fichero nuevo comparte los
+    bloques con el original, y la copia es instantánea.
+  - os.copy_file_range(): el kernel copia los datos, y en algunos sistemas
+    de ficheros (NFS, CIFS...) ni siquiera salen del servidor.
+  - os.sendfile(): el kernel copia los datos, sin pasar por Python.
+  - Leer y escribir los datos en Python, si nada de lo anterior está
+    disponible.
+
+En los ficheros dispersos (imágenes de máquinas virtuales, bases de datos)
+solo se copian las zonas con datos, según SEEK_DATA y SEEK_HOLE, y los
+huecos siguen siendo huecos en la copia.
+
+Además, los permisos, el dueño y las fechas se aplican de una vez, sobre el
+descriptor ya abierto, a partir del stat que ya teníamos del escaneo.
+'''
+
+import os, stat, errno
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOW(0x94, 9, int), de linux/fs.h
+FICLONE = 0x40049409
+
+# Errores que indican que el kernel o el sistema de ficheros no soportan la
+# llamada, y que hay que probar con la siguiente
+UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.ETXTBSY)
+
+# Cantidad máxima de bytes por llamada
+CHUNK_SIZE = 1 << 30
+
+# Con límite de velocidad, bloques más pequeños para que sea parejo
+THROTTLED_CHUNK_SIZE = 1 << 20
+
+def _reflink(source_fd, target_fd):
+    if not fcntl:
+        return False
+
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+        return True
+    except OSError as e:
+        if e.errno in UNSUPPORTED:
+            return False
+        raise
+
+def _copy_loop(function, source_fd, target_fd, offset, size, throttle = None):
+    ''' Copia con copy_file_range o sendfile desde 'offset' hasta 'size'.
+    Devuelve hasta dónde llegó. Lanza OSError si la llamada no está
+    soportada. '''
+    chunk_size = THROTTLED_CHUNK_SIZE if throttle else CHUNK_SIZE
+
+    while offset < size:
+        if function == 'copy_file_range':
+            count = os.copy_file_range(source_fd, target_fd, min(chunk_size, size - offset), offset, offset)
+        else:
+            os.lseek(target_fd, offset, os.SEEK_SET)
+            count = os.sendfile(target_fd, source_fd, offset, min(chunk_size, size - offset))
+
+        # El fichero se acortó mientras lo copiábamos
+        if count == 0:
+            break
+
+        offset += count
+
+        if throttle:
+            throttle(count)
+
+    return offset
+
+def data_extents(fd, size):
+    ''' Las zonas con datos de un fichero disperso, como tuplas (inicio,
+    largo), según SEEK_DATA y SEEK_HOLE. Si el sistema de ficheros no los
+    soporta, todo el fichero es una sola zona. '''
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)]
+
+    extents = []
+    offset = 0
+
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            # No hay más datos: el resto es un hueco
+            if e.errno == errno.ENXIO:
+                break
+            if e.errno in UNSUPPORTED:
+                return [(0, size)]
+            raise
+
+        if start >= size:
+            break
+
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        extents.append((start, end - start))
+        offset = end
+
+    return extents
+
+def copy_data(source_fd, target_fd, size, throttle = None, sparse = False):
+    ''' Copia el contenido entre dos descriptores. Devuelve el método usado.
+    Si se pasa 'throttle', se llama con la cantidad de bytes de cada bloque
+    copiado, y puede detener la copia para limitar la velocidad. Con
+    'sparse', solo se copian las zonas con datos, y los huecos del origen
+    quedan como huecos en el destino. '''
+    if _reflink(source_fd, target_fd):
+        return 'reflink'
+
+    extents = data_extents(source_fd, size) if sparse else [(0, size)]
+
+    # Un fichero disperso puede no tener datos
+    method = 'sparse'
+    for start, length in extents:
+        method = _copy_extent(source_fd, target_fd, start, start + length, throttle)
+
+    if sparse:
+        # El hueco del final no se escribe: lo creamos
+        os.ftruncate(target_fd, size)
+
+    return method
+
+def _copy_extent(source_fd, target_fd, offset, end, throttle = None):
+    ''' Copia desde 'offset' hasta 'end' con la primera llamada soportada.
+    Devuelve el método usado. '''
+    for function in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, function):
+            continue
+
+        try:
+            offset = _copy_loop(function, source_fd, target_fd, offset, end, throttle)
+        except OSError as e:
+            if e.errno in UNSUPPORTED:
+                continue
+            raise
+
+        return function
+
+    _copy_rest(source_fd, target_fd, offset, end, throttle)
+    return 'read'
+
+def _copy_rest(source_fd, target_fd, offset, end, throttle = None):
+    ''' Copia desde 'offset' hasta 'end', leyendo los datos en Python '''
+    os.lseek(source_fd, offset, os.SEEK_SET)
+    os.lseek(target_fd, offset, os.SEEK_SET)
+    chunk_size = THROTTLED_CHUNK_SIZE if throttle else 1048576
+
+    with open(source_fd, 'rb', closefd = False) as source, open(target_fd, 'wb', closefd = False) as target:
+        while offset < end:
+            data = source.read(min(chunk_size, end - offset))
+            if not data:
+                break
+
+            target.write(data)
+            offset += len(data)
+
+            if throttle:
+                throttle(len(data))
+
+def apply_metadata(target, st, source_filename = None):
+    ''' Aplica dueño, permisos y fechas del stat 'st' a 'target', que puede
+    ser una ruta o un descriptor abierto. Si se pasa 'source_filename',
+    también copia sus atributos extendidos. '''
+
+    # Primero el dueño, ya que chown() puede quitar los bits setuid/setgid
+    os.chown(target, st.st_uid, st.st_gid)
+    os.chmod(target, stat.S_IMODE(st.st_mode))
+
+    if source_filename and hasattr(os, 'listxattr'):
+        # Igual que shutil.copystat(), ignoramos los atributos que no se
+        # pueden leer o escribir
+        ignored = (errno.EPERM, errno.ENOTSUP, errno.ENODATA, errno.EINVAL)
+
+        try:
+            names = os.listxattr(source_filename)
+        except OSError as e:
+            if e.errno not in ignored:
+                raise
+            names = []
+
+        for name in names:
+            try:
+                os.setxattr(target, name, os.getxattr(source_filename, name))
+            except OSError as e:
+                if e.errno not in ignored:
+                    raise
+
+    # Al final, ya que cualquier cambio anterior podría tocar las fechas
+    os.utime(target, ns = (st.st_atime_ns, st.st_mtime_ns))
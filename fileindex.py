@@ -0,0 +1,822 @@
+'''
+Índice persistente de los ficheros respaldados.
+
+Se guarda junto al fichero de metadata, en la carpeta destino, y evita tener
+que escanear el destino en cada copia incremental. Por cada ruta de origen
+guarda el directorio de la copia (para las copias históricas) y, por cada
+fichero, su tamaño, mtime, inodo y ctime, su nombre en el destino y su
+checksum.
+
+Durante la copia se graban puntos de control: en las copias incrementales,
+el estado del destino hasta ese momento; en las históricas, los ficheros ya
+copiados en la nueva copia, en una sección aparte ('partial'), para poder
+continuarla con --resume.
+
+Un fichero se considera modificado cuando cambia cualquiera de los datos de
+su stat. El checksum sirve de caché para el modo --checksum: solo se vuelve
+a calcular cuando cambia el stat.
+
+En árboles de millones de ficheros, un dict por fichero ocupa varios GB. En
+memoria, los ficheros de cada ruta se guardan en un Registry: por cada
+directorio, los nombres ordenados y un registro binario de tamaño fijo por
+fichero. El índice se graba por líneas, un directorio por línea, para no
+tener nunca el índice entero en memoria como texto:
+
+    {"version": 2}
+    {"section": "paths" o "partial", "path": ruta, "dir": copia,
+     "superseded": [destino...], solo tras una copia interrumpida}
+    [directorio, [[nombre, tamaño, mtime_ns, inodo, ctime_ns, destino,
+        checksum], ...]]
+
+El destino se guarda sin el directorio, o con '/' delante si está en otro
+directorio. Los índices antiguos, un solo JSON, se siguen leyendo.
+'''
+
+import json, os, hashlib, struct, bisect, collections.abc
+
+INDEX_FILENAME = ".backup.index"
+
+# Algoritmo usado para los checksums de los ficheros
+CHECKSUM_ALGORITHM = 'sha256'
+
+def new_checksum():
+    ''' Devuelve un nuevo objeto hashlib para calcular checksums '''
+    return hashlib.new(CHECKSUM_ALGORITHM)
+
+# Campos del índice comparados con el stat del fichero de origen
+STAT_FIELDS = (
+    ('size', 'st_size'),
+    ('mtime_ns', 'st_mtime_ns'),
+    ('ino', 'st_ino'),
+    ('ctime_ns', 'st_ctime_ns'),
+)
+
+def new_entry(st, target, checksum = None):
+    ''' Crea una entrada del índice para un fichero, a partir de su stat '''
+    return {
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'ino': st.st_ino,
+        'ctime_ns': st.st_ctime_ns,
+        'target': target,
+        'checksum': checksum,
+    }
+
+def target_entry(st, target):
+    ''' Crea una entrada a partir del stat del fichero en el destino. Solo su
+    mtime corresponde al fichero de origen, ya que se copia junto con los
+    permisos. '''
+    return {
+        'size': None,
+        'mtime_ns': st.st_mtime_ns,
+        'ino': None,
+        'ctime_ns': None,
+        'target': target,
+        'checksum': None,
+    }
+
+def stat_changed(entry, st):
+    ''' ¿Cambió el stat del fichero desde que se registró? Los campos
+    desconocidos (None) no se comparan. '''
+    for key, attr in STAT_FIELDS:
+        value = entry.get(key)
+        if value is not None and value != getattr(st, attr):
+            return True
+
+    return False
+
+def file_checksum(filename):
+    ''' Calcula el checksum del contenido de un fichero '''
+    hasher = new_checksum()
+
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(1048576)
+            if not data:
+                break
+            hasher.update(data)
+
+    return hasher.hexdigest()
+
+def _upgrade_entry(entry):
+    ''' Los índices antiguos guardaban el mtime como el '%T@' de 'find' '''
+    if 'mtime_ns' not in entry:
+        seconds, _, fraction = entry.pop('mtime').partition('.')
+        entry['mtime_ns'] = int(seconds) * 1000000000 + int(fraction[:9].ljust(9, '0'))
+        entry.setdefault('ino', None)
+        entry.setdefault('ctime_ns', None)
+
+    return entry
+
+# Los campos de cada fichero en el Registry: tamaño, mtime, inodo, ctime,
+# código del nombre en el destino, campos vacíos, y checksum
+RECORD = struct.Struct('<QqQqHB32s')
+
+# Campos vacíos (None) del registro
+NO_SIZE = 1
+NO_INO = 2
+NO_CTIME = 4
+NO_CHECKSUM = 8
+
+# El destino o el checksum no caben en el registro, y están en 'extra'
+EXTRA_TARGET = 16
+EXTRA_CHECKSUM = 32
+
+# Nombres añadidos fuera de orden que se acumulan en cada directorio antes de
+# ordenarlos, como mínimo
+PENDING = 256
+
+# Ficheros de cada línea del índice, como máximo
+LINE_FILES = 10000
+
+class _Directory:
+    ''' Los ficheros de un directorio del Registry. 'names' está ordenado, y
+    el fichero names[i] tiene su registro en records[i * RECORD.size:]. Los
+    nombres nuevos que llegan fuera de orden esperan en 'pending' (nombre =>
+    registro). '''
+    __slots__ = ('path', 'names', 'records', 'pending')
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.records = bytearray()
+        self.pending = None
+
+    def find(self, base):
+        ''' Posición de 'base' en 'names', o -1 '''
+        i = bisect.bisect_left(self.names, base)
+        return i if i < len(self.names) and self.names[i] == base else -1
+
+    def merge(self):
+        ''' Ordena los nombres pendientes junto con los demás '''
+        if not self.pending:
+            self.pending = None
+            return
+
+        pending = sorted(self.pending.items())
+        self.pending = None
+
+        if not self.names or pending[0][0] > self.names[-1]:
+            self.names.extend(base for base, record in pending)
+            self.records += b''.join(record for base, record in pending)
+            return
+
+        names = []
+        records = bytearray()
+        start = 0
+        for base, record in pending:
+            end = bisect.bisect_left(self.names, base, start)
+            names.extend(self.names[start:end])
+            records += self.records[start * RECORD.size:end * RECORD.size]
+            names.append(base)
+            records += record
+            start = end
+
+        names.extend(self.names[start:])
+        records += self.records[start * RECORD.size:]
+
+        self.names = names
+        self.records = records
+
+class Registry(collections.abc.MutableMapping):
+    ''' Los ficheros de una ruta de origen: un dict de nombre => entrada del
+    índice (como las de new_entry), que ocupa mucho menos. Cada acceso
+    devuelve un dict nuevo: modificarlo no modifica el registro. Se recorre
+    ordenado por directorio.
+
+    Con 'base', el registro de la copia anterior, los ficheros que siguen
+    igual que en 'base' solo ocupan un byte. 'base' ya no se debe
+    modificar. '''
+
+    def __init__(self, base = None):
+        self.dirs = {}
+        self.count = 0
+        self.base = base
+
+        # El directorio del último fichero añadido
+        self.last = None
+
+        # Directorio => un byte por fichero del directorio en 'base': 1 si
+        # sigue igual
+        self.kept = {}
+
+        # Los nombres en el destino: ('+', sufijo) es el nombre del fichero
+        # más el sufijo; ('=', nombre), otro nombre en el mismo directorio.
+        # Con 'base' se comparten, para poder comparar los registros.
+        if base is not None:
+            base.merge()
+            self.targets = base.targets
+            self.target_codes = base.target_codes
+        else:
+            self.targets = []
+            self.target_codes = {}
+
+        # Nombre => (destino, checksum) que no caben en el registro
+        self.extra = {}
+
+    @classmethod
+    def from_dict(cls, files):
+        registry = cls()
+        for name, entry in files.items():
+            registry[name] = entry
+
+        return registry
+
+    def _directory(self, dirname):
+        directory = self.dirs.get(dirname)
+
+        if directory is None:
+            # El mismo nombre de directorio que en 'base'
+            shared = self.base.dirs.get(dirname) if self.base is not None else None
+            if shared is not None:
+                dirname = shared.path
+
+            directory = self.dirs[dirname] = _Directory(dirname)
+
+        return directory
+
+    def _in_base(self, dirname, base):
+        ''' Devuelve una tupla (directorio de 'base', posición), o None '''
+        if self.base is None:
+            return None
+
+        directory = self.base.dirs.get(dirname)
+        if directory is None:
+            return None
+
+        i = directory.find(base)
+        return (directory, i) if i >= 0 else None
+
+    def _is_kept(self, dirname, i):
+        kept = self.kept.get(dirname)
+        return kept is not None and kept[i] == 1
+
+    def _target_code(self, kind, text):
+        code = self.target_codes.get((kind, text))
+
+        if code is None:
+            if len(self.targets) > 0xffff:
+                return None
+
+            code = self.target_codes[(kind, text)] = len(self.targets)
+            self.targets.append((kind, text))
+
+        return code
+
+    def _encode(self, dirname, base, entry):
+        ''' Devuelve una tupla (registro, (destino, checksum) que no caben en
+        el registro, o None) '''
+        flags = 0
+        size = entry.get('size')
+        ino = entry.get('ino')
+        ctime_ns = entry.get('ctime_ns')
+        checksum = entry.get('checksum')
+        target = entry['target']
+        extra = [None, None]
+
+        if size is None:
+            flags |= NO_SIZE
+            size = 0
+        if ino is None:
+            flags |= NO_INO
+            ino = 0
+        if ctime_ns is None:
+            flags |= NO_CTIME
+            ctime_ns = 0
+
+        if checksum is None:
+            flags |= NO_CHECKSUM
+            raw = bytes(32)
+        else:
+            try:
+                raw = bytes.fromhex(checksum)
+            except ValueError:
+                raw = b''
+
+            if len(raw) != 32 or raw.hex() != checksum:
+                flags |= EXTRA_CHECKSUM
+                extra[1] = checksum
+                raw = bytes(32)
+
+        # Casi siempre, el nombre más la extensión del compresor, o el
+        # paquete del directorio
+        code = None
+        target_dir, _, target_base = target.rpartition('/')
+        if target_dir == dirname:
+            if target_base.startswith(base):
+                code = self._target_code('+', target_base[len(base):])
+            else:
+                code = self._target_code('=', target_base)
+
+        if code is None:
+            flags |= EXTRA_TARGET
+            extra[0] = target
+            code = 0
+
+        record = RECORD.pack(size, entry['mtime_ns'], ino, ctime_ns, code, flags, raw)
+        return record, (tuple(extra) if flags & (EXTRA_TARGET | EXTRA_CHECKSUM) else None)
+
+    def _decode(self, name, record, offset = 0):
+        size, mtime_ns, ino, ctime_ns, code, flags, raw = RECORD.unpack_from(record, offset)
+
+        if flags & (EXTRA_TARGET | EXTRA_CHECKSUM):
+            extra_target, extra_checksum = self.extra[name]
+
+        if flags & EXTRA_TARGET:
+            target = extra_target
+        else:
+            kind, text = self.targets[code]
+            target = name + text if kind == '+' else name[:name.rfind('/') + 1] + text
+
+        if flags & EXTRA_CHECKSUM:
+            checksum = extra_checksum
+        else:
+            checksum = None if flags & NO_CHECKSUM else raw.hex()
+
+        return {
+            'size': None if flags & NO_SIZE else size,
+            'mtime_ns': mtime_ns,
+            'ino': None if flags & NO_INO else ino,
+            'ctime_ns': None if flags & NO_CTIME else ctime_ns,
+            'target': target,
+            'checksum': checksum,
+        }
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        dirname, _, base = name.rpartition('/')
+        directory = self.dirs.get(dirname)
+
+        if directory is not None and (directory.find(base) >= 0 or (directory.pending and base in directory.pending)):
+            return True
+
+        found = self._in_base(dirname, base)
+        return found is not None and self._is_kept(dirname, found[1])
+
+    def __getitem__(self, name):
+        dirname, _, base = name.rpartition('/')
+        directory = self.dirs.get(dirname)
+
+        if directory is not None:
+            i = directory.find(base)
+            if i >= 0:
+                return self._decode(name, directory.records, i * RECORD.size)
+
+            if directory.pending and base in directory.pending:
+                return self._decode(name, directory.pending[base])
+
+        found = self._in_base(dirname, base)
+        if found is not None and self._is_kept(dirname, found[1]):
+            return self.base._decode(name, found[0].records, found[1] * RECORD.size)
+
+        raise KeyError(name)
+
+    def get(self, name, default = None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __setitem__(self, name, entry):
+        dirname, _, base = name.rpartition('/')
+        record, extra = self._encode(dirname, base, entry)
+
+        found = self._in_base(dirname, base)
+        if found is not None:
+            base_directory, i = found
+
+            # Sigue igual que en 'base'
+            if base_directory.records[i * RECORD.size:(i + 1) * RECORD.size] == record and self.base.extra.get(name) == extra:
+                # Un fichero está en este registro o marcado en 'kept', no en
+                # los dos
+                if self._remove_own(name, dirname, base) or not self._is_kept(dirname, i):
+                    self.count += 1
+
+                kept = self.kept.get(dirname)
+                if kept is None:
+                    kept = self.kept[dirname] = bytearray(len(base_directory.names))
+                kept[i] = 1
+                return
+
+            if self._is_kept(dirname, i):
+                self.kept[dirname][i] = 0
+                self.count -= 1
+
+            # El nombre, sin guardarlo dos veces
+            base = base_directory.names[i]
+
+        if extra is not None:
+            self.extra[name] = extra
+        else:
+            self.extra.pop(name, None)
+
+        directory = self._directory(dirname)
+
+        # El escaneo devuelve juntos los ficheros de cada directorio: al
+        # pasar al siguiente, se ordenan los pendientes del anterior, si no
+        # es mucho trabajo
+        last = self.last
+        if last is not directory:
+            if last is not None and last.pending and len(last.names) <= len(last.pending) * 8:
+                last.merge()
+            self.last = directory
+
+        # Cargando un índice, o un directorio en orden
+        if not directory.pending and (not directory.names or base > directory.names[-1]):
+            directory.names.append(base)
+            directory.records += record
+            self.count += 1
+            return
+
+        i = directory.find(base)
+        if i >= 0:
+            directory.records[i * RECORD.size:(i + 1) * RECORD.size] = record
+            return
+
+        if directory.pending is None:
+            directory.pending = {}
+
+        if base not in directory.pending:
+            self.count += 1
+
+        directory.pending[base] = record
+
+        if len(directory.pending) >= max(PENDING, len(directory.names) // 2):
+            directory.merge()
+
+    def _remove_own(self, name, dirname, base):
+        ''' Quita un fichero guardado en este registro, no en 'base'.
+        Devuelve False si no estaba. '''
+        directory = self.dirs.get(dirname)
+        if directory is None:
+            return False
+
+        if directory.pending and base in directory.pending:
+            del directory.pending[base]
+        else:
+            i = directory.find(base)
+            if i < 0:
+                return False
+
+            del directory.names[i]
+            del directory.records[i * RECORD.size:(i + 1) * RECORD.size]
+
+        self.extra.pop(name, None)
+        self.count -= 1
+        return True
+
+    def __delitem__(self, name):
+        dirname, _, base = name.rpartition('/')
+
+        if self._remove_own(name, dirname, base):
+            return
+
+        found = self._in_base(dirname, base)
+        if found is None or not self._is_kept(dirname, found[1]):
+            raise KeyError(name)
+
+        self.kept[dirname][found[1]] = 0
+        self.count -= 1
+
+    def _sorted_dirs(self):
+        ''' Devuelve, por cada directorio en orden, una tupla (directorio,
+        ficheros), donde los ficheros son tuplas (nombre, registro que lo
+        decodifica, registros, posición), en orden '''
+        for dirname in sorted(set(self.dirs) | set(self.kept)):
+            own = self.dirs.get(dirname)
+            files = []
+
+            if own is not None:
+                own.merge()
+                files = [(base, self, own.records, i) for i, base in enumerate(own.names)]
+
+            kept = self.kept.get(dirname)
+            if kept is not None:
+                directory = self.base.dirs[dirname]
+                files += [(base, self.base, directory.records, i) for i, base in enumerate(directory.names) if kept[i]]
+                files.sort(key = lambda file: file[0])
+
+            yield dirname, files
+
+    def __iter__(self):
+        for dirname, files in self._sorted_dirs():
+            prefix = dirname + '/' if dirname else ''
+            for base, registry, records, i in files:
+                yield prefix + base
+
+    def items(self):
+        for dirname, files in self._sorted_dirs():
+            prefix = dirname + '/' if dirname else ''
+            for base, registry, records, i in files:
+                name = prefix + base
+                yield name, registry._decode(name, records, i * RECORD.size)
+
+    def values(self):
+        for name, entry in self.items():
+            yield entry
+
+    def merge(self):
+        ''' Ordena todos los nombres pendientes. Después, el registro se
+        puede leer desde varios hilos a la vez. '''
+        for directory in self.dirs.values():
+            directory.merge()
+
+    def copy(self):
+        registry = Registry(self.base)
+        registry.count = self.count
+        registry.extra = dict(self.extra)
+        registry.kept = {dirname: bytearray(kept) for dirname, kept in self.kept.items()}
+
+        if self.base is None:
+            registry.targets = list(self.targets)
+            registry.target_codes = dict(self.target_codes)
+
+        for dirname, directory in self.dirs.items():
+            copied = registry.dirs[dirname] = _Directory(directory.path)
+            copied.names = list(directory.names)
+            copied.records = bytearray(directory.records)
+            copied.pending = dict(directory.pending) if directory.pending else None
+
+        return registry
+
+    def remaining(self):
+        ''' Una vista de los ficheros del registro de la que se pueden
+        quitar ficheros, sin copiar el registro (ver Remaining) '''
+        return Remaining(self if self.base is None else Registry.from_dict(self))
+
+    def rows(self):
+        ''' Devuelve, por cada directorio, una tupla (directorio, filas) con
+        sus ficheros en el formato del índice '''
+        for dirname, files in self._sorted_dirs():
+            prefix = dirname + '/' if dirname else ''
+            rows = []
+
+            for base, registry, records, i in files:
+                entry = registry._decode(prefix + base, records, i * RECORD.size)
+
+                target_dir, _, target = entry['target'].rpartition('/')
+                if target_dir != dirname:
+                    target = '/' + entry['target']
+
+                rows.append([base, entry['size'], entry['mtime_ns'], entry['ino'], entry['ctime_ns'], target, entry['checksum']])
+
+                if len(rows) == LINE_FILES:
+                    yield dirname, rows
+                    rows = []
+
+            if rows:
+                yield dirname, rows
+
+    def add_rows(self, dirname, rows):
+        ''' Añade los ficheros de una línea del índice '''
+        prefix = dirname + '/' if dirname else ''
+
+        for base, size, mtime_ns, ino, ctime_ns, target, checksum in rows:
+            self[prefix + base] = {
+                'size': size,
+                'mtime_ns': mtime_ns,
+                'ino': ino,
+                'ctime_ns': ctime_ns,
+                'target': target[1:] if target.startswith('/') else prefix + target,
+                'checksum': checksum,
+            }
+
+class Remaining:
+    ''' Los ficheros de un Registry que aún no se quitaron, e.g. los que
+    quedan por borrar del destino. En vez de una copia del registro, guarda
+    un byte por fichero. El Registry no se puede modificar mientras se usa la
+    vista. '''
+
+    def __init__(self, registry):
+        registry.merge()
+
+        self.registry = registry
+        self.removed = {}
+        self.count = len(registry)
+
+    def _find(self, name):
+        ''' Devuelve una tupla (directorio, posición), o None si el fichero no
+        está, o ya se quitó '''
+        dirname, _, base = name.rpartition('/')
+        directory = self.registry.dirs.get(dirname)
+        if directory is None:
+            return None
+
+        i = directory.find(base)
+        if i < 0:
+            return None
+
+        removed = self.removed.get(dirname)
+        if removed is not None and removed[i]:
+            return None
+
+        return dirname, i
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __getitem__(self, name):
+        if self._find(name) is None:
+            raise KeyError(name)
+
+        return self.registry[name]
+
+    def get(self, name, default = None):
+        return self[name] if name in self else default
+
+    def __delitem__(self, name):
+        found = self._find(name)
+        if found is None:
+            raise KeyError(name)
+
+        dirname, i = found
+        removed = self.removed.get(dirname)
+        if removed is None:
+            removed = self.removed[dirname] = bytearray(len(self.registry.dirs[dirname].names))
+
+        removed[i] = 1
+        self.count -= 1
+
+    def pop(self, name, *default):
+        try:
+            entry = self[name]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+        del self[name]
+        return entry
+
+    def __iter__(self):
+        for name, entry in self.items():
+            yield name
+
+    def items(self):
+        for dirname in sorted(self.registry.dirs):
+            directory = self.registry.dirs[dirname]
+            prefix = dirname + '/' if dirname else ''
+            removed = self.removed.get(dirname)
+
+            for i, base in enumerate(directory.names):
+                if removed is None or not removed[i]:
+                    name = prefix + base
+                    yield name, self.registry._decode(name, directory.records, i * RECORD.size)
+
+class FileIndex:
+    def __init__(self, filename, storage = None):
+        ''' Sin 'storage', el índice es un fichero local. Si no, se lee y se
+        graba con el almacenamiento del destino (ver storage.py). Los
+        ficheros locales se leen y se graban línea a línea. '''
+        self.filename = filename
+        self.storage = storage
+        self.remote = storage is not None and storage.remote
+        self.paths = {}
+        self.partial = {}
+
+    def load(self):
+        ''' Carga el índice. Lanza ValueError si el fichero está corrupto '''
+        if self.remote:
+            data = self.storage.read(self.filename)
+            if data is None:
+                return self
+
+            lines = iter(data.decode().splitlines())
+            self._load_lines(lines)
+        else:
+            if not os.path.exists(self.filename):
+                return self
+
+            with open(self.filename) as f:
+                self._load_lines(f)
+
+        return self
+
+    def _load_lines(self, lines):
+        try:
+            header = json.loads(next(lines, '{}'))
+        except json.decoder.JSONDecodeError as e:
+            raise ValueError('Índice ilegible ({})'.format(str(e)))
+
+        if not isinstance(header, dict):
+            raise ValueError('Formato de índice desconocido')
+
+        # El formato antiguo: un solo JSON
+        if 'version' not in header:
+            self._load_json(header)
+            return
+
+        if header['version'] != 2:
+            raise ValueError('Versión de índice desconocida')
+
+        files = None
+        try:
+            for line in lines:
+                data = json.loads(line)
+
+                if isinstance(data, dict):
+                    files = Registry()
+                    section = self.partial if data['section'] == 'partial' else self.paths
+                    section[data['path']] = {'dir': data['dir'], 'files': files}
+
+                    if data.get('superseded'):
+                        section[data['path']]['superseded'] = list(data['superseded'])
+                else:
+                    files.add_rows(*data)
+        except (json.decoder.JSONDecodeError, KeyError, TypeError, ValueError, AttributeError) as e:
+            raise ValueError('Índice ilegible ({})'.format(str(e)))
+
+    def _load_json(self, data):
+        if not isinstance(data.get('paths'), dict):
+            raise ValueError('Formato de índice desconocido')
+
+        for section, paths in ((self.paths, data['paths']), (self.partial, data.get('partial', {}))):
+            for path in list(paths):
+                path_data = paths.pop(path)
+                section[path] = {
+                    'dir': path_data['dir'],
+                    'files': Registry.from_dict({name: _upgrade_entry(entry) for name, entry in path_data['files'].items()}),
+                }
+
+    def get(self, path, generation = ''):
+        ''' Devuelve los ficheros indexados de 'path', o None si el índice
+        no existe o corresponde a otra copia histórica '''
+        data = self.paths.get(path)
+
+        if data is None or data['dir'] != generation:
+            return None
+
+        return data['files']
+
+    def set(self, path, generation, files, superseded = ()):
+        ''' 'files' es un Registry, que ya no se debe modificar.
+        'superseded' son los nombres en el destino que reemplazó una copia
+        interrumpida, y que hay que borrar en la siguiente. '''
+        files.merge()
+        self.paths[path] = {
+            'dir': generation,
+            'files': files,
+        }
+
+        if superseded:
+            self.paths[path]['superseded'] = sorted(superseded)
+
+    def get_superseded(self, path):
+        data = self.paths.get(path)
+        return data.get('superseded', []) if data else []
+
+    def get_partial(self, path, generation):
+        ''' Devuelve los ficheros ya copiados de una copia histórica
+        interrumpida, o None '''
+        data = self.partial.get(path)
+
+        if data is None or data['dir'] != generation:
+            return None
+
+        return data['files']
+
+    def set_partial(self, path, generation, files):
+        files.merge()
+        self.partial[path] = {
+            'dir': generation,
+            'files': files,
+        }
+
+    def clear_partial(self, path):
+        self.partial.pop(path, None)
+
+    def _lines(self):
+        yield json.dumps({'version': 2}) + '\n'
+
+        for section, paths in (('paths', self.paths), ('partial', self.partial)):
+            for path, data in paths.items():
+                header = {'section': section, 'path': path, 'dir': data['dir']}
+                if data.get('superseded'):
+                    header['superseded'] = data['superseded']
+
+                yield json.dumps(header) + '\n'
+
+                for dirname, rows in data['files'].rows():
+                    yield json.dumps([dirname, rows]) + '\n'
+
+    def save(self):
+        ''' Graba el índice de forma atómica: primero a un fichero temporal, y
+        luego lo renombra sobre el anterior '''
+        if self.remote:
+            self.storage.write(self.filename, ''.join(self._lines()).encode())
+            return
+
+        tmp_filename = self.filename + '.tmp'
+
+        with open(tmp_filename, 'w') as f:
+            for line in self._lines():
+                f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_filename, self.filename)
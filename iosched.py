@@ -0,0 +1,204 @@
+'''
+Planificador de entrada/salida para la lectura del origen.
+
+backup.py suele ejecutarse en servidores en producción, así que la lectura
+del origen no debe saturar el disco ni vaciar la caché de páginas de los
+servicios:
+
+  - Un 'token bucket' limita los bytes y las operaciones por segundo. Es
+    compartido por todos los hilos de trabajo, así que el límite es total.
+  - Al leer, se pide al kernel que lea por adelantado la siguiente ventana
+    (posix_fadvise WILLNEED), y que descarte de la caché lo ya leído
+    (DONTNEED), para no desplazar los datos de los servicios.
+  - Opcionalmente, la lectura se detiene mientras la carga del sistema
+    supere un límite.
+  - La escritura de los ficheros grandes se hace en otro hilo (WriteBehind),
+    así que la lectura del siguiente bloque se solapa con la compresión y
+    la escritura del anterior.
+'''
+
+import os, time, threading, queue
+
+# Ventana de lectura anticipada
+READAHEAD = 8 * 1048576
+
+# Segundos de espera cuando la carga del sistema es muy alta
+LOAD_BACKOFF = 5
+
+_fadvise = getattr(os, 'posix_fadvise', None)
+
+def _advise(fd, offset, length, advice):
+    if _fadvise:
+        try:
+            _fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+class TokenBucket:
+    ''' Limita un ritmo, en unidades por segundo, permitiendo ráfagas de
+    hasta un segundo '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        ''' Consume 'amount' fichas, y devuelve los segundos que hay que
+        esperar. Se pueden pedir más fichas de las que hay: el saldo queda en
+        negativo, y los siguientes hilos esperan también esa deuda. '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class IOScheduler:
+    def __init__(self, bandwidth = 0, iops = 0, max_load = 0, drop_cache = True):
+        ''' 'bandwidth' en bytes por segundo, 'iops' en lecturas por segundo,
+        y 'max_load' la carga media de un minuto a partir de la cual se
+        detiene la lectura. 0 no limita. '''
+        self.bandwidth = TokenBucket(bandwidth) if bandwidth else None
+        self.iops = TokenBucket(iops) if iops else None
+        self.max_load = max_load
+        self.drop_cache = drop_cache
+        self.limited = bool(bandwidth or iops or max_load)
+
+        self.next_load_check = 0
+        self.paused_until = 0
+
+        # Segundos que los hilos pasaron esperando, para las métricas
+        self.waited = 0
+
+    def throttle(self, nbytes, ops = 1):
+        ''' Espera lo necesario para leer 'nbytes' en 'ops' operaciones '''
+        wait = 0
+
+        if self.iops:
+            wait = max(wait, self.iops.consume(ops))
+
+        if self.bandwidth:
+            wait = max(wait, self.bandwidth.consume(nbytes))
+
+        if self.max_load:
+            wait += self._load_wait()
+
+        if wait:
+            self.waited += wait
+            time.sleep(wait)
+
+    def _load_wait(self):
+        ''' Como mucho una vez por segundo, comprueba la carga del sistema.
+        Si es muy alta, todos los hilos esperan LOAD_BACKOFF segundos. '''
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        if now >= self.next_load_check:
+            self.next_load_check = now + 1
+
+            if os.getloadavg()[0] > self.max_load:
+                self.paused_until = now + LOAD_BACKOFF
+                return LOAD_BACKOFF
+
+        return 0
+
+    def reader(self, f):
+        ''' Envuelve un fichero abierto para leer, para que sus lecturas
+        pasen por el planificador '''
+        return ThrottledReader(f, self)
+
+    def done(self, fd):
+        ''' Ya se leyó el fichero: lo descartamos de la caché '''
+        if self.drop_cache:
+            _advise(fd, 0, 0, getattr(os, 'POSIX_FADV_DONTNEED', 4))
+
+class ThrottledReader:
+    def __init__(self, f, scheduler):
+        self.f = f
+        self.fd = f.fileno()
+        self.scheduler = scheduler
+        self.offset = 0
+        self.prefetched = 0
+
+        _advise(self.fd, 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 2))
+
+    def read(self, size = -1):
+        # Mantenemos por delante una ventana de lectura anticipada
+        window = max(READAHEAD, 2 * size)
+        if self.offset + window > self.prefetched:
+            start = max(self.prefetched, self.offset)
+            _advise(self.fd, start, self.offset + window - start, getattr(os, 'POSIX_FADV_WILLNEED', 3))
+            self.prefetched = self.offset + window
+
+        data = self.f.read(size)
+
+        if data:
+            self.scheduler.throttle(len(data))
+
+            if self.scheduler.drop_cache:
+                _advise(self.fd, self.offset, len(data), getattr(os, 'POSIX_FADV_DONTNEED', 4))
+
+            self.offset += len(data)
+
+        return data
+
+    def fileno(self):
+        return self.fd
+
+class WriteBehind:
+    ''' Escribe en un fichero desde otro hilo. 'depth' es la cantidad máxima
+    de bloques en cola. Los errores de escritura se lanzan en la siguiente
+    escritura, o al cerrar. '''
+
+    def __init__(self, f, depth = 2):
+        self.f = f
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+
+            # Después de un error, solo vaciamos la cola
+            if self.error is None:
+                try:
+                    self.f.write(data)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+
+        self.queue.put(data)
+        return len(data)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type:
+            # Ya hay un error: solo esperamos al hilo
+            self.error = self.error or exc
+            try:
+                self.close()
+            except Exception:
+                pass
+        else:
+            self.close()
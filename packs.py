@@ -0,0 +1,202 @@
+'''
+Paquetes de ficheros pequeños.
+
+Un árbol con millones de ficheros de pocos KB genera millones de ficheros
+diminutos en el destino, que se comprimen mal (cada uno empieza sin
+diccionario) y que son lentos de escanear y de borrar. Con --pack, los
+ficheros pequeños de cada directorio se guardan juntos en un paquete,
+'.backup.pack', en el mismo directorio del destino:
+
+    MAGIC
+    diccionario, comprimido con zlib
+    los datos de cada fichero, comprimidos por separado
+    índice JSON, comprimido con zlib: {"dict": [inicio, largo], "files":
+        {nombre: [inicio, largo, tamaño, modo, uid, gid, atime_ns, mtime_ns]}}
+    largo del índice (8 bytes, big-endian)
+
+Cada fichero se comprime con deflate usando como diccionario el principio de
+todos los ficheros del paquete, así que lo que se repite entre ellos
+(cabeceras, plantillas) casi no ocupa. Como cada fichero se comprime por
+separado, se puede extraer uno solo sin leer el resto.
+
+El paquete se reescribe entero solo si cambió, se añadió o se borró alguno
+de sus ficheros. En el índice de la copia, el destino de los ficheros
+empaquetados es el paquete.
+'''
+
+import os, json, zlib, struct, types, collections
+
+import fileindex
+
+PACK_FILENAME = '.backup.pack'
+
+MAGIC = b'\0backup.py pack 1\n'
+
+# Tamaño máximo del diccionario de deflate
+DICT_SIZE = 32768
+
+# Bytes del principio de cada fichero que entran en el diccionario, como
+# mínimo
+MIN_SAMPLE = 256
+
+def is_pack(target_name):
+    ''' ¿Es 'target_name', un nombre en el destino, un paquete? '''
+    return target_name == PACK_FILENAME or target_name.endswith('/' + PACK_FILENAME)
+
+def pack_name(filename):
+    ''' El paquete donde se guarda el fichero 'filename' '''
+    dirname = filename.rpartition('/')[0]
+    return dirname + '/' + PACK_FILENAME if dirname else PACK_FILENAME
+
+class Packer:
+    ''' Agrupa por directorio los ficheros pequeños del escaneo, y decide qué
+    paquetes hay que volver a escribir '''
+
+    def __init__(self, threshold, registry):
+        self.threshold = threshold
+
+        # Paquete => [(nombre, stat)]
+        self.packs = collections.defaultdict(list)
+
+        # Paquete => {nombre: entrada}, de la copia anterior
+        self.previous = collections.defaultdict(dict)
+        for name, entry in registry.items():
+            if is_pack(entry['target']):
+                self.previous[entry['target']][name] = entry
+
+    def accepts(self, st):
+        return st.st_size < self.threshold
+
+    def add(self, filename, st):
+        self.packs[pack_name(filename)].append((filename, st))
+
+    def changes(self):
+        ''' Devuelve una tupla (paquete, ficheros, entradas anteriores,
+        cambió) por cada paquete '''
+        for pack, files in sorted(self.packs.items()):
+            previous = self.previous.get(pack, {})
+            changed = len(files) != len(previous) or any(name not in previous or fileindex.stat_changed(previous[name], st) for name, st in files)
+
+            yield pack, files, previous, changed
+
+def _dictionary(contents):
+    ''' El diccionario de un paquete: el principio de cada fichero, hasta
+    DICT_SIZE. deflate prefiere lo que está al final del diccionario. '''
+    if len(contents) < 2:
+        return b''
+
+    sample = max(MIN_SAMPLE, DICT_SIZE // len(contents))
+    return b''.join(data[:sample] for data in contents)[-DICT_SIZE:]
+
+def write_pack(source_path, files, target_filename, level = 9, throttle = None):
+    ''' Escribe el paquete 'target_filename' con los ficheros 'files' (tuplas
+    (nombre relativo a 'source_path', stat)). 'throttle' recibe los bytes
+    leídos de cada fichero. Se puede ejecutar en un hilo de trabajo:
+    devuelve una tupla (checksums de los ficheros guardados, errores de cada
+    fichero, métricas). Lanza OSError si no se pudo escribir el paquete. '''
+    checksums = {}
+    errors = []
+    contents = []
+
+    for filename, st in files:
+        try:
+            with open(os.path.join(source_path, filename), 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            errors.append((filename, 'No pude copiar ({}).'.format(str(e))))
+            continue
+
+        if throttle:
+            throttle(len(data))
+
+        hasher = fileindex.new_checksum()
+        hasher.update(data)
+        checksums[filename] = hasher.hexdigest()
+        contents.append((filename, st, data))
+
+    zdict = _dictionary([data for filename, st, data in contents])
+    members = {}
+
+    with open(target_filename, 'wb') as f:
+        os.fchmod(f.fileno(), 0o600)
+
+        packed_dict = zlib.compress(zdict, level) if zdict else b''
+        f.write(MAGIC)
+        f.write(packed_dict)
+        offset = len(MAGIC) + len(packed_dict)
+
+        for filename, st, data in contents:
+            if zdict:
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+            else:
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+            compressed = compressor.compress(data) + compressor.flush()
+            f.write(compressed)
+
+            members[filename.rpartition('/')[2]] = [offset, len(compressed), len(data),
+                st.st_mode, st.st_uid, st.st_gid, st.st_atime_ns, st.st_mtime_ns]
+            offset += len(compressed)
+
+        index = zlib.compress(json.dumps({'dict': [len(MAGIC), len(packed_dict)], 'files': members}).encode(), level)
+        f.write(index)
+        f.write(struct.pack('>Q', len(index)))
+
+        written = f.tell()
+        f.flush()
+        os.fsync(f.fileno())
+
+    return checksums, errors, {'written': written, 'read': sum(len(data) for filename, st, data in contents)}
+
+class PackReader:
+    ''' Lee los ficheros de un paquete, uno por uno. Se puede usar desde
+    varios hilos a la vez. '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} no es un paquete.'.format(filename))
+
+            try:
+                f.seek(-8, os.SEEK_END)
+                index_size, = struct.unpack('>Q', f.read(8))
+                f.seek(-8 - index_size, os.SEEK_END)
+                index = json.loads(zlib.decompress(f.read(index_size)))
+
+                start, length = index['dict']
+                f.seek(start)
+                self.zdict = zlib.decompress(f.read(length)) if length else b''
+                self.members = index['files']
+            except (zlib.error, struct.error, KeyError, TypeError) as e:
+                raise ValueError('El índice del paquete está dañado ({}).'.format(str(e))) from e
+
+    def names(self):
+        return sorted(self.members)
+
+    def stat(self, name):
+        ''' El stat guardado de un fichero, con los campos que usa
+        fastcopy.apply_metadata '''
+        offset, length, size, mode, uid, gid, atime_ns, mtime_ns = self.members[name]
+
+        return types.SimpleNamespace(st_size = size, st_mode = mode, st_uid = uid, st_gid = gid,
+            st_atime_ns = atime_ns, st_mtime_ns = mtime_ns)
+
+    def read(self, name):
+        ''' Devuelve el contenido de un fichero del paquete '''
+        offset, length = self.members[name][:2]
+
+        with open(self.filename, 'rb') as f:
+            data = os.pread(f.fileno(), length, offset)
+
+        if self.zdict:
+            decompressor = zlib.decompressobj(-15, zdict = self.zdict)
+        else:
+            decompressor = zlib.decompressobj(-15)
+
+        data = decompressor.decompress(data) + decompressor.flush()
+        if len(data) != self.members[name][2]:
+            raise ValueError('El fichero {} del paquete está dañado.'.format(name))
+
+        return data
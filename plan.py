@@ -0,0 +1,102 @@
+'''
+Planes de copia.
+
+--plan escanea el origen y lo compara con la copia anterior, igual que una
+copia, pero sin copiar nada: graba en un fichero JSON los ficheros nuevos,
+los actualizados y los borrados de cada ruta, los bytes que habría que leer,
+y cuánto tardaría la copia según la velocidad que tuvo cada compresor en las
+copias anteriores:
+
+    {"version": 1, "created": fecha, "target": destino, "historic": bool,
+     "base": la última copia del destino, "interrupted": bool,
+     "paths": {ruta: {"new": [[nombre, tamaño]...], "updated": [...],
+         "deleted": [nombre...], "unchanged": N, "bytes": N,
+         "codecs": {compresor: bytes}}},
+     "files": N, "bytes": N, "estimated_seconds": segundos o null}
+
+--execute-plan hace la copia de un plan grabado, escaneando solo los
+directorios donde el plan encontró cambios, así que la parte cara se puede
+programar para otro momento. El plan sirve mientras el destino siga como
+estaba: si después terminó, o se interrumpió, otra copia, se escanea todo el
+origen.
+'''
+
+import os, json
+
+import changejournal
+
+VERSION = 1
+
+# Peso de la última copia en la velocidad guardada de cada compresor
+SMOOTHING = 0.5
+
+def normalize_target(target):
+    ''' El destino, igual se escriba como se escriba '''
+    if target.startswith('s3://'):
+        return target.rstrip('/')
+
+    return os.path.abspath(target)
+
+def update_throughput(throughput, codec, measured):
+    ''' Actualiza en 'throughput' la velocidad del compresor 'codec', en bytes
+    por segundo de un hilo, con la medida en la última copia '''
+    previous = throughput.get(codec)
+    throughput[codec] = measured if not previous else previous + SMOOTHING * (measured - previous)
+
+def estimate(codec_bytes, throughput, jobs = 1, bwlimit = 0):
+    ''' Segundos que tardaría en leer 'codec_bytes' ({compresor: bytes}) con
+    las velocidades de 'throughput', en 'jobs' hilos y a como mucho 'bwlimit'
+    bytes por segundo. Los compresores que nunca se usaron cuentan con la
+    velocidad del más lento. Devuelve None si no hay ninguna medida. '''
+    total = sum(codec_bytes.values())
+    if not total:
+        return 0
+
+    measured = [speed for speed in throughput.values() if speed > 0]
+    if not measured:
+        return None
+
+    slowest = min(measured)
+    seconds = sum(size / (throughput.get(codec) or slowest) for codec, size in codec_bytes.items()) / max(1, jobs)
+
+    if bwlimit:
+        seconds = max(seconds, total / bwlimit)
+
+    return seconds
+
+def save(filename, plan):
+    ''' Graba el plan de forma atómica '''
+    tmp_filename = filename + '.tmp'
+
+    with open(tmp_filename, 'w') as f:
+        json.dump(plan, f, indent = 1)
+
+    os.replace(tmp_filename, filename)
+
+def load(filename):
+    ''' Lee un plan grabado. Lanza ValueError si no es un plan. '''
+    with open(filename) as f:
+        try:
+            plan = json.load(f)
+        except json.decoder.JSONDecodeError as e:
+            raise ValueError('No es un fichero JSON ({}).'.format(str(e)))
+
+    if not isinstance(plan, dict) or plan.get('version') != VERSION or not isinstance(plan.get('paths'), dict):
+        raise ValueError('No es un plan de esta versión de backup.py.')
+
+    return plan
+
+def matches(plan, metadata, historic):
+    ''' ¿Se hizo el plan sobre la copia que hay ahora en el destino? '''
+    return (not plan['interrupted'] and 'in_progress' not in metadata and
+        plan['base'] == metadata.get('last_backup') and plan['historic'] == historic)
+
+def changes(plan, path):
+    ''' Los directorios que cambiaron en la ruta de origen 'path', como un
+    changejournal.Changes, o None si el plan no tiene la ruta '''
+    planned = plan['paths'].get(path)
+    if planned is None:
+        return None
+
+    names = [name for name, size in planned['new'] + planned['updated']] + planned['deleted']
+    return changejournal.Changes({name.rpartition('/')[0] for name in names}, set())
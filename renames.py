@@ -0,0 +1,135 @@
+'''
+Detección de ficheros movidos o renombrados.
+
+El registro está indexado por la ruta de cada fichero, así que un fichero
+movido aparece como uno nuevo, que hay que volver a comprimir, y uno
+borrado. Al reorganizar un directorio de cientos de gigas, se vuelve a
+copiar todo.
+
+Mientras se escanea el origen, los ficheros nuevos que se parecen a alguno
+del registro se dejan para el final. Cuando termina el escaneo ya se sabe qué
+ficheros del registro desaparecieron del origen, y cada fichero nuevo se
+compara con ellos, en orden:
+
+  - Mismo inodo, tamaño y fecha de modificación: es el mismo fichero,
+    movido dentro del mismo sistema de ficheros. Como un inodo libre se
+    reutiliza, si el índice tiene el checksum también se compara.
+  - Mismo tamaño, fecha de modificación y checksum: movido a otro sistema
+    de ficheros, o copiado con 'cp -p' o 'rsync'. Que coincidan el tamaño
+    y la fecha no basta: el contenido puede ser otro.
+  - Mismo tamaño y checksum, para los ficheros grandes.
+
+Para comparar el checksum, el fichero nuevo se lee entero. Fuera del primer
+caso, solo se compara con los ficheros cuyo checksum está en el índice.
+
+Los índices sin tamaño ni inodo (e.g. reconstruidos escaneando el destino)
+no permiten detectar nada.
+
+Durante el escaneo solo se guarda un mapa de bits de los tamaños y fechas
+del registro, dos bytes por fichero: un fichero nuevo que encaja por
+casualidad solo se deja para el final. Los diccionarios para comparar se
+crean al final, solo con los ficheros que desaparecieron.
+'''
+
+import collections
+
+import fileindex
+
+# Tamaño mínimo para comparar por checksum: el origen se tiene que leer
+# entero, aunque sigue siendo más barato que comprimirlo
+MIN_CHECKSUM_SIZE = 1048576
+
+# Bits del mapa por cada fichero del registro
+BITS_PER_FILE = 16
+
+class RenameDetector:
+    def __init__(self, registry):
+        self.bits = bytearray(max(1, len(registry) * BITS_PER_FILE // 8))
+        self.count = 0
+
+        for name, entry in registry.items():
+            if entry.get('size') is None:
+                continue
+
+            self._set((entry['size'], entry['mtime_ns']))
+            if entry.get('checksum') and entry['size'] >= MIN_CHECKSUM_SIZE:
+                self._set(entry['size'])
+
+            self.count += 1
+
+        self.by_inode = None
+
+    def _bit(self, key):
+        bit = hash(key) % (len(self.bits) * 8)
+        return bit >> 3, 1 << (bit & 7)
+
+    def _set(self, key):
+        byte, mask = self._bit(key)
+        self.bits[byte] |= mask
+
+    def _test(self, key):
+        byte, mask = self._bit(key)
+        return bool(self.bits[byte] & mask)
+
+    def __bool__(self):
+        return self.count > 0
+
+    def is_candidate(self, st):
+        ''' ¿Puede ser un fichero movido? Se llama por cada fichero nuevo
+        durante el escaneo, así que solo consulta el mapa de bits. '''
+        return self._test((st.st_size, st.st_mtime_ns)) or (st.st_size >= MIN_CHECKSUM_SIZE and self._test(st.st_size))
+
+    def _index(self, missing):
+        self.by_inode = collections.defaultdict(list)
+        self.by_stat = collections.defaultdict(list)
+        self.by_size = collections.defaultdict(list)
+
+        for name, entry in missing.items():
+            if entry.get('size') is None:
+                continue
+
+            if entry.get('ino') is not None:
+                self.by_inode[(entry['ino'], entry['size'], entry['mtime_ns'])].append(name)
+
+            if not entry.get('checksum'):
+                continue
+
+            self.by_stat[(entry['size'], entry['mtime_ns'])].append(name)
+
+            if entry['size'] >= MIN_CHECKSUM_SIZE:
+                self.by_size[entry['size']].append(name)
+
+    def match(self, st, source_filename, missing, extension):
+        ''' Busca el fichero anterior de un fichero nuevo, entre los que
+        desaparecieron del origen ('missing', nombre => entrada). Solo se
+        comparan los que tienen la misma extensión en el destino, es decir, el
+        mismo compresor. Devuelve una tupla (nombre anterior o None,
+        checksum del fichero nuevo si se calculó). '''
+        if self.by_inode is None:
+            self._index(missing)
+
+        def available(names):
+            return [name for name in names if name in missing and missing[name]['target'][len(name):] == extension]
+
+        candidates = available(self.by_inode.get((st.st_ino, st.st_size, st.st_mtime_ns), ()))
+        for name in candidates:
+            if not missing[name].get('checksum'):
+                return name, None
+
+        # Si no, hay que comparar el contenido
+        for names in (self.by_stat.get((st.st_size, st.st_mtime_ns), ()), self.by_size.get(st.st_size, ())):
+            candidates += [name for name in available(names) if name not in candidates]
+
+        if not candidates:
+            return None, None
+
+        try:
+            checksum = fileindex.file_checksum(source_filename)
+        except OSError:
+            return None, None
+
+        for name in candidates:
+            if missing[name]['checksum'] == checksum:
+                return name, checksum
+
+        return None, checksum
@@ -0,0 +1,124 @@
+'''
+Restauración de los ficheros de una copia.
+
+Cada fichero de la copia se descomprime según su extensión, en un fichero
+temporal que se renombra al terminar, y recibe los permisos, el dueño y las
+fechas que tiene en la copia, que son los del fichero original. Los datos
+se leen y se escriben por bloques, así que los ficheros grandes nunca están
+enteros en memoria, y los ficheros dispersos recuperan sus huecos. Los
+ficheros de un paquete de ficheros pequeños (ver packs.py) se extraen uno por
+uno.
+'''
+
+import os
+
+import exclude, fastcopy, sparse
+
+def restore_file(source_filename, target_filename, st, codec):
+    ''' Restaura un fichero de la copia. 'st' es su stat en la copia, y
+    'codec' el compresor con que se lee, o None si no está comprimido. Se
+    puede ejecutar en un hilo de trabajo: devuelve una tupla (restaurado,
+    bytes escritos, errores). '''
+    errors = []
+    written = 0
+
+    head, tail = os.path.split(target_filename)
+    tmp_filename = os.path.join(head, '.' + tail + '.restore-tmp')
+
+    try:
+        os.makedirs(head, exist_ok = True)
+
+        if codec:
+            with codec.open(source_filename, 'rb') as source_fd, open(tmp_filename, 'wb') as target_fd:
+                is_container, head = sparse.read_magic(source_fd)
+
+                # Los ficheros dispersos recuperan sus huecos
+                if is_container:
+                    written = sparse.restore(source_fd, target_fd.fileno())
+                else:
+                    written = sparse.write_with_holes(source_fd, target_fd.fileno(), head)
+        else:
+            with open(source_filename, 'rb') as source_fd, open(tmp_filename, 'wb') as target_fd:
+                fastcopy.copy_data(source_fd.fileno(), target_fd.fileno(), st.st_size, sparse = sparse.is_sparse(st))
+                written = st.st_size
+    except Exception as e:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+
+        errors.append('No pude restaurar ({}).'.format(str(e)))
+        return False, 0, errors
+
+    try:
+        fastcopy.apply_metadata(tmp_filename, st, source_filename)
+    except Exception as e:
+        errors.append('No pude restaurar permisos ni dueño ({}).'.format(str(e)))
+
+    try:
+        os.replace(tmp_filename, target_filename)
+    except Exception as e:
+        errors.append('No pude renombrar el fichero temporal ({}).'.format(str(e)))
+        return False, 0, errors
+
+    return True, written, errors
+
+def restore_packed(reader, name, target_filename):
+    ''' Restaura el fichero 'name' del paquete abierto con 'reader' (un
+    packs.PackReader). Devuelve lo mismo que restore_file. '''
+    errors = []
+
+    head, tail = os.path.split(target_filename)
+    tmp_filename = os.path.join(head, '.' + tail + '.restore-tmp')
+
+    try:
+        os.makedirs(head, exist_ok = True)
+        data = reader.read(name)
+
+        with open(tmp_filename, 'wb') as target_fd:
+            target_fd.write(data)
+    except Exception as e:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+
+        errors.append('No pude restaurar ({}).'.format(str(e)))
+        return False, 0, errors
+
+    try:
+        fastcopy.apply_metadata(tmp_filename, reader.stat(name))
+    except Exception as e:
+        errors.append('No pude restaurar permisos ni dueño ({}).'.format(str(e)))
+
+    try:
+        os.replace(tmp_filename, target_filename)
+    except Exception as e:
+        errors.append('No pude renombrar el fichero temporal ({}).'.format(str(e)))
+        return False, 0, errors
+
+    return True, len(data), errors
+
+class RestoreFilter:
+    ''' Elige los ficheros a restaurar con patrones como los de exclusión.
+    Un fichero se restaura si encaja con algún patrón, o si encaja alguno de
+    sus directorios. Las rutas son las originales, sin el '/' inicial. '''
+
+    def __init__(self, patterns):
+        self.matcher = exclude.ExcludeMatcher(patterns)
+
+        # Directorio => ¿se restaura todo su contenido?
+        self.dirs = {'': False}
+
+    def _dir_matches(self, path):
+        if path not in self.dirs:
+            parent = os.path.dirname(path)
+            self.dirs[path] = self._dir_matches(parent) or self.matcher.match_dir(path)
+
+        return self.dirs[path]
+
+    def __call__(self, path):
+        if not self.matcher:
+            return True
+
+        return self.matcher.match_file(path) or self._dir_matches(os.path.dirname(path))
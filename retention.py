@@ -0,0 +1,171 @@
+'''
+Retención y borrado de copias históricas.
+
+Cada copia histórica queda registrada en el catálogo de la metadata
+(MD['generations']), con la hora en que terminó. La política de retención
+conserva las N copias más recientes, y la más reciente de cada uno de los
+últimos N días, semanas y meses, como restic o borg. El resto se borra.
+
+Las copias históricas comparten ficheros con enlaces duros (o con reflinks),
+así que borrar una copia no siempre libera espacio. Al borrar, por cada
+inodo se cuenta cuántos de sus enlaces se eliminaron: el espacio solo se
+libera cuando se elimina el último.
+'''
+
+import os, re, threading
+import concurrent.futures
+
+from datetime import datetime
+
+# Nombre de las copias sin -H, con la fecha y hora de creación
+GENERATION_NAME = re.compile(r'\d{14}$')
+GENERATION_FORMAT = '%Y%m%d%H%M%S'
+
+# Reglas de retención, y el periodo de cada una. 'last' conserva las N
+# copias más recientes.
+RULES = (
+    ('last', None),
+    ('daily', '%Y-%m-%d'),
+    ('weekly', '%G-%V'),
+    ('monthly', '%Y-%m'),
+)
+
+def discover_generations(target):
+    ''' Busca en el destino las copias históricas con nombre por defecto,
+    para los destinos creados antes del catálogo '''
+    generations = {}
+
+    for entry in os.scandir(target):
+        if entry.is_dir(follow_symlinks = False) and GENERATION_NAME.match(entry.name):
+            try:
+                time = datetime.strptime(entry.name, GENERATION_FORMAT)
+            except ValueError:
+                continue
+
+            generations[entry.name] = {'time': time.isoformat(timespec = 'seconds')}
+
+    return generations
+
+def kept_generations(generations, keep):
+    ''' Devuelve el conjunto de copias que conserva la política 'keep', un
+    dict con la cantidad de cada regla de RULES '''
+    times = {name: datetime.fromisoformat(data['time']) for name, data in generations.items()}
+    # Con la misma hora, la última registrada en el catálogo es la más nueva
+    order = {name: i for i, name in enumerate(generations)}
+    newest_first = sorted(times, key = lambda name: (times[name], order[name]), reverse = True)
+    kept = set()
+
+    for rule, period_format in RULES:
+        count = keep.get(rule, 0)
+        periods = set()
+
+        for name in newest_first:
+            if len(periods) >= count:
+                break
+
+            period = name if period_format is None else times[name].strftime(period_format)
+
+            # La copia más reciente de cada periodo
+            if period not in periods:
+                periods.add(period)
+                kept.add(name)
+
+    return kept
+
+class TreeRemover:
+    ''' Borra árboles de directorios en paralelo, contando el espacio que se
+    libera realmente '''
+
+    def __init__(self, threads = 4, on_error = None):
+        self.threads = threads
+        self.on_error = on_error
+        self.lock = threading.Lock()
+
+        # (dispositivo, inodo) => [enlaces, enlaces borrados], solo de los
+        # ficheros con más de un enlace
+        self.shared = {}
+
+        self.files = 0
+        self.reclaimed = 0
+
+    def _remove_file(self, path):
+        st = os.lstat(path)
+        key = (st.st_dev, st.st_ino)
+        freed = 0
+
+        # Un solo enlace, y no borramos otros antes: no es compartido
+        if st.st_nlink == 1 and key not in self.shared:
+            freed = st.st_blocks * 512
+        else:
+            # Registramos el enlace antes de borrarlo: si otro hilo borra
+            # otro enlace del mismo inodo, uno de los dos verá que era el
+            # último.
+            with self.lock:
+                links = self.shared.setdefault(key, [st.st_nlink, 0])
+                links[1] += 1
+                if links[1] >= links[0]:
+                    freed = st.st_blocks * 512
+
+        os.unlink(path)
+        return freed
+
+    def _remove_dir(self, path):
+        ''' Borra los ficheros de un directorio. Devuelve sus subdirectorios. '''
+        subdirs = []
+        files = 0
+        freed = 0
+
+        try:
+            iterator = os.scandir(path)
+        except OSError as e:
+            if self.on_error:
+                self.on_error(path, e)
+            return subdirs
+
+        with iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_dir(follow_symlinks = False):
+                        subdirs.append(entry.path)
+                    else:
+                        freed += self._remove_file(entry.path)
+                        files += 1
+                except OSError as e:
+                    if self.on_error:
+                        self.on_error(entry.path, e)
+
+        with self.lock:
+            self.files += files
+            self.reclaimed += freed
+
+        return subdirs
+
+    def remove(self, roots):
+        ''' Borra los árboles 'roots'. Cada directorio se procesa en un hilo.
+        Los directorios, ya vacíos, se borran al final, los más profundos
+        primero. '''
+        dirs = []
+
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as pool:
+            pending = [(root, pool.submit(self._remove_dir, root)) for root in roots]
+
+            while pending:
+                path, future = pending.pop()
+                dirs.append(path)
+
+                for subdir in future.result():
+                    pending.append((subdir, pool.submit(self._remove_dir, subdir)))
+
+        for path in sorted(dirs, key = lambda d: d.count(os.sep), reverse = True):
+            try:
+                os.rmdir(path)
+            except OSError as e:
+                if self.on_error:
+                    self.on_error(path, e)
+
+        return self
+
+    def still_shared(self):
+        ''' Cantidad de inodos con enlaces fuera de lo borrado, e.g. en las
+        copias que se conservan '''
+        return sum(1 for links, removed in self.shared.values() if removed < links)
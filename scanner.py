@@ -0,0 +1,165 @@
+'''
+Escaneo de directorios con os.scandir.
+
+Reemplaza al 'find' externo: devuelve los ficheros a medida que los
+encuentra, junto con su stat, así que la memoria usada depende de la
+profundidad del árbol y no de la cantidad de ficheros. Los nombres que no
+están en UTF-8 se devuelven con 'surrogateescape' (lo normal en Python para
+las rutas), así que se pueden seguir usando en las funciones de 'os'.
+'''
+
+import os, queue, threading
+
+def scan_tree(path, follow_symlinks = False, is_excluded = None, on_error = None, threads = 1, is_dir_excluded = None, prefix = ''):
+    ''' Generador que devuelve tuplas (ruta relativa, stat) por cada fichero
+    regular dentro de 'path'.
+
+    'is_excluded' recibe la ruta relativa de cada fichero, y si devuelve True
+    el fichero se descarta. 'is_dir_excluded' hace lo mismo con los
+    directorios, que ni siquiera se recorren. 'on_error' recibe la ruta y la
+    excepción de cada directorio o fichero que no se pudo leer. Con 'threads'
+    mayor que 1 los subdirectorios se escanean en paralelo, y el orden de los
+    ficheros deja de ser predecible. 'prefix' se antepone a las rutas
+    relativas, para escanear un subdirectorio de la raíz (e.g. 'dir/'). '''
+
+    excluded = (is_excluded, is_dir_excluded)
+
+    if threads > 1:
+        return _scan_parallel(path, follow_symlinks, excluded, on_error, threads, prefix)
+
+    return _scan(path, follow_symlinks, excluded, on_error, prefix)
+
+def scan_dir(path, follow_symlinks = False, is_excluded = None, on_error = None, prefix = ''):
+    ''' Como scan_tree, pero solo con los ficheros de 'path', sin entrar en
+    los subdirectorios '''
+    files, subdirs = _scan_dir(path, prefix, follow_symlinks, (is_excluded, None), on_error)
+    return files
+
+def _scan_dir(dir_path, rel_path, follow_symlinks, excluded, on_error):
+    ''' Escanea un solo directorio. Devuelve la lista de ficheros, y la lista
+    de subdirectorios (ruta, ruta relativa, stat) '''
+    is_excluded, is_dir_excluded = excluded
+    files = []
+    subdirs = []
+
+    try:
+        iterator = os.scandir(dir_path)
+    except OSError as e:
+        if on_error:
+            on_error(dir_path, e)
+        return files, subdirs
+
+    with iterator:
+        for entry in iterator:
+            name = rel_path + entry.name
+
+            try:
+                if entry.is_dir(follow_symlinks = follow_symlinks):
+                    if is_dir_excluded and is_dir_excluded(name):
+                        continue
+
+                    subdirs.append((entry.path, name + '/', entry.stat(follow_symlinks = follow_symlinks)))
+                    continue
+
+                if not entry.is_file(follow_symlinks = follow_symlinks):
+                    continue
+
+                if is_excluded and is_excluded(name):
+                    continue
+
+                files.append((name, entry.stat(follow_symlinks = follow_symlinks)))
+            except OSError as e:
+                # Enlaces rotos, ficheros borrados mientras escaneamos...
+                if on_error:
+                    on_error(entry.path, e)
+
+    return files, subdirs
+
+def _scan(path, follow_symlinks, excluded, on_error, prefix):
+    ''' Escaneo secuencial, en profundidad '''
+    try:
+        root_st = os.stat(path)
+    except OSError:
+        return
+
+    # Pila de directorios por escanear: (ruta, ruta relativa, directorios
+    # padres). Los padres sirven para evitar bucles al seguir enlaces.
+    stack = [(path, prefix, frozenset([(root_st.st_dev, root_st.st_ino)]))]
+
+    while stack:
+        dir_path, rel_path, parents = stack.pop()
+
+        files, subdirs = _scan_dir(dir_path, rel_path, follow_symlinks, excluded, on_error)
+
+        yield from files
+
+        for sub_path, sub_rel, st in reversed(subdirs):
+            key = (st.st_dev, st.st_ino)
+            if key in parents:
+                continue
+
+            stack.append((sub_path, sub_rel, parents | {key}))
+
+def _scan_parallel(path, follow_symlinks, excluded, on_error, threads, prefix):
+    ''' Escaneo con varios hilos. Cada hilo toma un directorio, y deja sus
+    ficheros en una cola de tamaño limitado. '''
+    try:
+        root_st = os.stat(path)
+    except OSError:
+        return
+
+    dirs = queue.Queue()
+    results = queue.Queue(threads * 4)
+
+    # Directorios encolados o en proceso. Cuando llega a cero, terminamos.
+    outstanding = [1]
+    lock = threading.Lock()
+
+    dirs.put((path, prefix, frozenset([(root_st.st_dev, root_st.st_ino)])))
+
+    def worker():
+        while True:
+            item = dirs.get()
+            if item is None:
+                break
+
+            dir_path, rel_path, parents = item
+
+            try:
+                files, subdirs = _scan_dir(dir_path, rel_path, follow_symlinks, excluded, on_error)
+
+                for sub_path, sub_rel, st in subdirs:
+                    key = (st.st_dev, st.st_ino)
+                    if key in parents:
+                        continue
+
+                    with lock:
+                        outstanding[0] += 1
+                    dirs.put((sub_path, sub_rel, parents | {key}))
+            except Exception as e:
+                files = []
+                if on_error:
+                    on_error(dir_path, e)
+
+            results.put(files)
+
+            with lock:
+                outstanding[0] -= 1
+                finished = outstanding[0] == 0
+
+            if finished:
+                results.put(None)
+
+    workers = [threading.Thread(target = worker, daemon = True) for i in range(threads)]
+    for w in workers:
+        w.start()
+
+    try:
+        while True:
+            files = results.get()
+            if files is None:
+                break
+            yield from files
+    finally:
+        for w in workers:
+            dirs.put(None)
@@ -0,0 +1,143 @@
+'''
+Creación de una copia histórica como clon de la anterior.
+
+En vez de enlazar cada fichero sin cambios mientras se escanea el origen, la
+nueva copia empieza como un clon completo de la anterior, y después solo se
+le aplican los cambios: los ficheros nuevos o modificados se reemplazan
+(renombrando un temporal, así que nunca se modifica un fichero compartido
+con la copia anterior) y los borrados se eliminan.
+
+El clon se crea, en orden de preferencia, con:
+
+  - Un snapshot de btrfs, si la copia anterior es un subvolumen. Es
+    instantáneo, sin importar la cantidad de ficheros.
+  - 'cp -a --reflink=always' en btrfs y XFS: los ficheros nuevos comparten
+    los bloques con los anteriores.
+  - Un árbol de enlaces duros, creado con varios hilos en paralelo.
+'''
+
+import os, subprocess, shutil
+import concurrent.futures
+
+# Sistemas de ficheros que permiten reflinks
+REFLINK_FILESYSTEMS = ('btrfs', 'xfs')
+
+# En btrfs, la raíz de un subvolumen siempre tiene este inodo
+BTRFS_SUBVOLUME_INODE = 256
+
+def filesystem_type(path):
+    ''' Tipo del sistema de ficheros donde está 'path', según /proc/mounts,
+    o None si no se puede saber '''
+    path = os.path.realpath(path)
+    best = ('', None)
+
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+
+                # Los espacios en el punto de montaje vienen como '\040'
+                mount_point = fields[1].replace('\\040', ' ')
+
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) >= len(best[0]):
+                    best = (mount_point, fields[2])
+    except OSError:
+        return None
+
+    return best[1]
+
+def _run(*command):
+    ''' Ejecuta un comando. Devuelve True si terminó bien. '''
+    try:
+        return subprocess.run(command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL).returncode == 0
+    except OSError:
+        # El comando no existe
+        return False
+
+def create_tree(target):
+    ''' Crea el directorio de una copia histórica sin copia anterior. En
+    btrfs lo crea como subvolumen, para que la siguiente copia sea un
+    snapshot. '''
+    if os.path.isdir(target):
+        return
+
+    os.makedirs(os.path.dirname(target), exist_ok = True)
+
+    if filesystem_type(os.path.dirname(target)) == 'btrfs' and _run('btrfs', 'subvolume', 'create', target):
+        return
+
+    os.makedirs(target, exist_ok = True)
+
+def clone_tree(source, target, threads = 4, on_error = None):
+    ''' Crea 'target', que no debe existir, como clon de 'source'. Devuelve
+    una tupla (método usado: 'snapshot', 'reflink' o 'hardlink', nombres
+    relativos a 'target' de los ficheros y directorios que faltan en el clon).
+    'on_error' recibe la ruta y la excepción de cada fichero que no se pudo
+    enlazar. '''
+    os.makedirs(os.path.dirname(target), exist_ok = True)
+    fs = filesystem_type(source)
+
+    if fs == 'btrfs' and os.stat(source).st_ino == BTRFS_SUBVOLUME_INODE:
+        if _run('btrfs', 'subvolume', 'snapshot', source, target):
+            return 'snapshot', []
+
+    if fs in REFLINK_FILESYSTEMS:
+        if _run('cp', '-a', '--reflink=always', source, target):
+            return 'reflink', []
+
+        # XFS sin reflinks, o un cp sin --reflink: empezamos de cero
+        if os.path.exists(target):
+            shutil.rmtree(target)
+
+    return 'hardlink', hardlink_tree(source, target, threads, on_error)
+
+def _link_dir(source, target, on_error, failed):
+    ''' Enlaza los ficheros de un directorio, y crea sus subdirectorios.
+    Añade a 'failed' lo que no se pudo enlazar o crear. Devuelve la lista de
+    subdirectorios (origen, destino) por recorrer. '''
+    subdirs = []
+
+    try:
+        iterator = os.scandir(source)
+    except OSError as e:
+        if on_error:
+            on_error(source, e)
+        failed.append(target)
+        return subdirs
+
+    with iterator:
+        for entry in iterator:
+            target_entry = os.path.join(target, entry.name)
+
+            try:
+                if entry.is_dir(follow_symlinks = False):
+                    os.mkdir(target_entry)
+                    subdirs.append((entry.path, target_entry))
+                else:
+                    os.link(entry.path, target_entry, follow_symlinks = False)
+            except OSError as e:
+                if on_error:
+                    on_error(entry.path, e)
+                failed.append(target_entry)
+
+    return subdirs
+
+def hardlink_tree(source, target, threads = 4, on_error = None):
+    ''' Recrea el árbol 'source' en 'target', con un enlace duro por fichero.
+    Cada directorio se procesa en un hilo: os.link() y os.mkdir() liberan el
+    GIL, y así las llamadas al sistema de ficheros se solapan. Devuelve los
+    nombres relativos a 'target' de los ficheros y directorios que no se
+    pudieron enlazar o crear (e.g. EMLINK, demasiados enlaces). '''
+    os.mkdir(target)
+    failed = []
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        pending = [pool.submit(_link_dir, source, target, on_error, failed)]
+
+        while pending:
+            for subdir_source, subdir_target in pending.pop().result():
+                pending.append(pool.submit(_link_dir, subdir_source, subdir_target, on_error, failed))
+
+    return [os.path.relpath(name, target) for name in failed]
@@ -0,0 +1,210 @@
+'''
+Ficheros dispersos en los destinos comprimidos.
+
+Un fichero disperso (una imagen de máquina virtual, una base de datos) puede
+tener gigas de huecos sin datos. Leerlos devuelve ceros, que habría que leer
+del disco. En cambio, solo se leen las zonas con datos, y los huecos se
+escriben como ceros en el compresor, donde casi no ocupan. Así, el fichero
+del destino se descomprime con las herramientas de siempre (e.g. con
+'zcat'), y su checksum es el de su contenido, como el de cualquier otro.
+
+Al restaurar, los bloques de ceros no se escriben: los huecos se vuelven a
+crear.
+
+Las copias de versiones anteriores guardaban un contenedor con solo las zonas
+con datos, que se sigue leyendo:
+
+    MAGIC
+    largo de la cabecera (8 bytes, big-endian)
+    cabecera JSON: {"size": tamaño, "extents": [[inicio, largo], ...]}
+    los datos de cada zona, uno tras otro
+
+Un fichero cuyo contenido empieza con MAGIC todavía se guarda en el
+contenedor, con una sola zona, para que nunca se confunda con uno.
+'''
+
+import os, json, struct
+
+import fastcopy
+
+MAGIC = b'\0backup.py sparse 1\n'
+
+# Los ficheros más pequeños no se tratan como dispersos
+MIN_SIZE = 1048576
+
+# Tamaño de cada lectura
+BLOCK_SIZE = 1048576
+
+ZEROS = bytes(BLOCK_SIZE)
+
+def is_sparse(st):
+    ''' ¿Tiene el fichero menos bloques que los que ocupan sus datos? '''
+    return st.st_size >= MIN_SIZE and st.st_blocks * 512 < st.st_size
+
+def sparse_extents(source_fd, st):
+    ''' Si el fichero se debe guardar con sparse.write(), devuelve sus zonas
+    con datos. Si no, None. '''
+    if is_sparse(st):
+        extents = fastcopy.data_extents(source_fd, st.st_size)
+
+        # Comprimido en btrfs, o con los huecos ya rellenos
+        if sum(length for start, length in extents) < st.st_size:
+            return extents
+
+    if os.pread(source_fd, len(MAGIC), 0) == MAGIC:
+        return [(0, st.st_size)]
+
+    return None
+
+def _zeros(length):
+    ''' Devuelve 'length' ceros, por bloques '''
+    while length > 0:
+        data = ZEROS[:min(BLOCK_SIZE, length)]
+        yield data
+        length -= len(data)
+
+def _blocks(source_fd, size, extents, throttle):
+    ''' Devuelve el contenido del fichero, por bloques, como tuplas (es un
+    hueco, datos). Solo se leen las zonas 'extents'. '''
+    offset = 0
+
+    for start, length in extents:
+        for data in _zeros(start - offset):
+            yield True, data
+
+        offset = start
+        end = start + length
+
+        while offset < end:
+            data = os.pread(source_fd, min(BLOCK_SIZE, end - offset), offset)
+
+            # El fichero se acortó mientras lo leíamos: rellenamos con
+            # ceros, para que las zonas sigan en su sitio
+            if not data:
+                data = ZEROS[:min(BLOCK_SIZE, end - offset)]
+            elif throttle:
+                throttle(len(data))
+
+            yield False, data
+            offset += len(data)
+
+    for data in _zeros(size - offset):
+        yield True, data
+
+def write(source_fd, target, size, extents, throttle = None, hasher = None):
+    ''' Escribe en 'target', un fichero abierto del compresor, el contenido
+    del descriptor 'source_fd', leyendo solo las zonas 'extents'. Con
+    'hasher', calcula el checksum del contenido, huecos incluidos. '''
+    container = os.pread(source_fd, len(MAGIC), 0) == MAGIC
+
+    if container:
+        header = json.dumps({'size': size, 'extents': extents}).encode()
+        target.write(MAGIC + struct.pack('>Q', len(header)) + header)
+
+    for hole, data in _blocks(source_fd, size, extents, throttle):
+        if hasher:
+            hasher.update(data)
+
+        if not (hole and container):
+            target.write(data)
+
+def _read_exact(source, size):
+    data = b''
+    while len(data) < size:
+        chunk = source.read(size - len(data))
+        if not chunk:
+            raise ValueError('El contenedor de fichero disperso está cortado.')
+        data += chunk
+
+    return data
+
+def read_magic(source):
+    ''' Lee el principio de un fichero del destino. Devuelve una tupla (es un
+    contenedor, bytes leídos que no son del contenedor). '''
+    data = b''
+    while len(data) < len(MAGIC):
+        chunk = source.read(len(MAGIC) - len(data))
+        if not chunk:
+            break
+        data += chunk
+
+    if data == MAGIC:
+        return True, b''
+
+    return False, data
+
+def read_container(source):
+    ''' Lee el contenedor 'source', ya leído hasta después de MAGIC. Devuelve
+    su tamaño, y sus datos por bloques, como tuplas (posición, datos): los
+    huecos no se devuelven. '''
+    header_size, = struct.unpack('>Q', _read_exact(source, 8))
+    header = json.loads(_read_exact(source, header_size))
+
+    def blocks():
+        for start, length in header['extents']:
+            offset = start
+            end = start + length
+
+            while offset < end:
+                data = _read_exact(source, min(BLOCK_SIZE, end - offset))
+                yield offset, data
+                offset += len(data)
+
+    return header['size'], blocks()
+
+def hash_container(source, hasher):
+    ''' Calcula con 'hasher' el checksum del contenido del contenedor
+    'source', ya leído hasta después de MAGIC, huecos incluidos. Devuelve
+    su tamaño. '''
+    size, blocks = read_container(source)
+    offset = 0
+
+    for start, data in blocks:
+        for zeros in _zeros(start - offset):
+            hasher.update(zeros)
+
+        hasher.update(data)
+        offset = start + len(data)
+
+    for zeros in _zeros(size - offset):
+        hasher.update(zeros)
+
+    return size
+
+def restore(source, target_fd):
+    ''' Recrea en el descriptor 'target_fd' el fichero disperso del
+    contenedor 'source', ya leído hasta después de MAGIC. Devuelve su
+    tamaño. '''
+    size, blocks = read_container(source)
+
+    for offset, data in blocks:
+        os.pwrite(target_fd, data, offset)
+
+    os.ftruncate(target_fd, size)
+    return size
+
+def write_with_holes(source, target_fd, head = b''):
+    ''' Copia el fichero abierto 'source' en el descriptor 'target_fd',
+    precedido de 'head'. Los bloques de ceros no se escriben, así que quedan
+    como huecos. Devuelve el tamaño. '''
+    offset = 0
+    data = head
+
+    while True:
+        # Bloques enteros y alineados, aunque el descompresor devuelva menos
+        while len(data) < BLOCK_SIZE:
+            chunk = source.read(BLOCK_SIZE - len(data))
+            if not chunk:
+                break
+            data += chunk
+
+        if data != ZEROS[:len(data)]:
+            os.pwrite(target_fd, data, offset)
+        offset += len(data)
+
+        if len(data) < BLOCK_SIZE:
+            break
+        data = b''
+
+    os.ftruncate(target_fd, offset)
+    return offset
@@ -0,0 +1,362 @@
+'''
+Almacenamiento del destino de la copia.
+
+Los pasos que escriben en el destino (grabar un fichero, enlazar uno sin
+cambios de la copia anterior, mover, borrar, y grabar la metadata y el
+índice)
+pasan por un almacenamiento. Hay dos:
+
+  - LocalStorage: una carpeta local, como siempre. Los ficheros sin cambios
+    de las copias históricas son enlaces duros.
+  - S3Storage: un bucket de S3, o de un servicio compatible como MinIO
+    ('s3://bucket/prefijo'). Los datos comprimidos se suben a medida que se
+    generan, sin pasar por un fichero local, en partes que se suben en
+    paralelo. Los ficheros sin cambios se copian dentro del propio bucket,
+    sin volver a subirlos. Necesita el módulo 'boto3', que es opcional.
+
+Los nombres son siempre rutas que empiezan con la raíz del destino, igual
+que las rutas locales, así que backup.py los construye con os.path.join en
+los dos casos.
+'''
+
+import os, types
+import concurrent.futures
+
+try:
+    import boto3
+    import botocore.config
+except ImportError:
+    boto3 = None
+
+# Variable de entorno con la URL de un servicio compatible con S3, e.g.
+# http://localhost:9000 para un MinIO local
+ENDPOINT_VARIABLE = 'BACKUP_S3_ENDPOINT'
+
+# Tamaño de cada parte de las subidas. S3 pide al menos 5 MB.
+PART_SIZE = 8 * 1048576
+
+# Partes de un mismo fichero subiéndose a la vez, como máximo
+MAX_PENDING_PARTS = 4
+
+# Reintentos de cada petición, con espera exponencial
+RETRIES = 10
+
+def open_storage(target, threads = 4, endpoint = None, part_size = PART_SIZE):
+    ''' Devuelve el almacenamiento para el destino 'target'. Lanza ValueError
+    si no está disponible. '''
+    if target.startswith('s3://'):
+        return S3Storage(target, threads, endpoint, part_size)
+
+    return LocalStorage(target)
+
+class LocalStorage:
+    remote = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def check(self, write = True):
+        ''' ¿Se puede leer, o escribir, en el destino? '''
+        return os.access(self.root, os.W_OK if write else os.R_OK)
+
+    def read(self, name):
+        ''' Devuelve el contenido de un fichero, o None si no existe '''
+        try:
+            with open(name, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, name, data):
+        ''' Graba un fichero de forma atómica: primero a un fichero temporal,
+        y luego lo renombra sobre el anterior '''
+        tmp_filename = name + '.tmp'
+
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_filename, name)
+
+    def makedirs(self, name):
+        os.makedirs(name, exist_ok = True)
+
+    def link(self, source, target):
+        ''' Enlaza 'source' de la copia anterior como 'target' '''
+        os.makedirs(os.path.dirname(target), exist_ok = True)
+
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            # Enlazado antes de interrumpir la copia que continuamos
+            os.unlink(target)
+            os.link(source, target)
+
+    def rename(self, source, target):
+        ''' Mueve un fichero dentro del destino '''
+        os.makedirs(os.path.dirname(target), exist_ok = True)
+        os.replace(source, target)
+
+    def remove(self, name):
+        ''' Borra un fichero. Si no existe, no hace nada. '''
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            pass
+
+    def stat(self, name):
+        return os.stat(name)
+
+class S3Storage:
+    remote = True
+
+    def __init__(self, url, threads = 4, endpoint = None, part_size = PART_SIZE, client = None):
+        if client is None and not boto3:
+            raise ValueError("El destino 's3://' necesita el módulo 'boto3' (pip install boto3).")
+
+        self.root = url.rstrip('/')
+        self.bucket, _, self.prefix = self.root[len('s3://'):].partition('/')
+        self.part_size = max(part_size, 5 * 1048576)
+
+        if not self.bucket:
+            raise ValueError('Falta el nombre del bucket en {}.'.format(url))
+
+        if client is None:
+            # Una conexión por hilo, y los reintentos esperan más mientras el
+            # servicio responda que vamos demasiado rápido
+            config = botocore.config.Config(
+                max_pool_connections = threads * 2,
+                retries = {'max_attempts': RETRIES, 'mode': 'adaptive'},
+            )
+            client = boto3.client('s3', endpoint_url = endpoint or os.environ.get(ENDPOINT_VARIABLE) or None, config = config)
+
+        self.client = client
+
+        # Las partes de todas las subidas comparten los hilos
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def key(self, name):
+        ''' La clave del objeto para un nombre bajo la raíz del destino '''
+        if name != self.root and not name.startswith(self.root + '/'):
+            raise ValueError('{} no está dentro de {}.'.format(name, self.root))
+
+        relative = os.path.normpath(name[len(self.root):].lstrip('/'))
+        if relative == '.':
+            relative = ''
+
+        return '/'.join(part for part in (self.prefix, relative) if part)
+
+    def check(self, write = True):
+        try:
+            self.client.head_bucket(Bucket = self.bucket)
+        except Exception:
+            return False
+
+        return True
+
+    def read(self, name):
+        try:
+            response = self.client.get_object(Bucket = self.bucket, Key = self.key(name))
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+        return response['Body'].read()
+
+    def write(self, name, data):
+        # Un objeto de S3 siempre se reemplaza entero
+        self.client.put_object(Bucket = self.bucket, Key = self.key(name), Body = data)
+
+    def makedirs(self, name):
+        # S3 no tiene directorios
+        pass
+
+    def link(self, source, target):
+        ''' Copia el objeto dentro del bucket, sin bajarlo ni volver a
+        subirlo. Los objetos grandes se copian por partes. '''
+        self.client.copy({'Bucket': self.bucket, 'Key': self.key(source)}, self.bucket, self.key(target))
+
+    def rename(self, source, target):
+        # S3 no puede renombrar: copiamos y borramos
+        self.link(source, target)
+        self.remove(source)
+
+    def remove(self, name):
+        # Borrar un objeto que no existe no es un error
+        self.client.delete_object(Bucket = self.bucket, Key = self.key(name))
+
+    def stat(self, name):
+        ''' Los permisos, el dueño y las fechas guardados al subir el
+        objeto '''
+        response = self.client.head_object(Bucket = self.bucket, Key = self.key(name))
+        return _stat_from_metadata(response.get('Metadata', {}), response.get('ContentLength'), response.get('LastModified'))
+
+    def open_write(self, name, st):
+        ''' Abre un objeto para escribir, con el stat 'st' del fichero de
+        origen como metadatos '''
+        metadata = {
+            'mode': str(st.st_mode),
+            'uid': str(st.st_uid),
+            'gid': str(st.st_gid),
+            'mtime-ns': str(st.st_mtime_ns),
+        }
+
+        return S3Upload(self, self.key(name), metadata)
+
+    def _list(self, name):
+        ''' Recorre los objetos bajo el directorio 'name' '''
+        prefix = self.key(name)
+        prefix = prefix + '/' if prefix else ''
+
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket = self.bucket, Prefix = prefix):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(prefix):], item
+
+    def scan(self, name, on_error = None):
+        ''' Como scanner.scan_tree: devuelve los ficheros bajo el directorio
+        'name', con su stat. El listado no trae los metadatos, así que se
+        piden en paralelo. '''
+        def head(relative, item):
+            response = self.client.head_object(Bucket = self.bucket, Key = item['Key'])
+            return _stat_from_metadata(response.get('Metadata', {}), item.get('Size'), item.get('LastModified'))
+
+        items = [(relative, item) for relative, item in self._list(name) if relative and not relative.endswith('/')]
+        futures = [(relative, self.pool.submit(head, relative, item)) for relative, item in items]
+
+        for relative, future in futures:
+            try:
+                yield relative, future.result()
+            except Exception as e:
+                if on_error:
+                    on_error(relative, e)
+
+    def remove_tree(self, name):
+        ''' Borra todos los objetos bajo el directorio 'name'. Devuelve la
+        cantidad de objetos y de bytes borrados. '''
+        files = 0
+        reclaimed = 0
+        batch = []
+
+        def delete(batch):
+            self.client.delete_objects(Bucket = self.bucket, Delete = {'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+
+        for relative, item in self._list(name):
+            batch.append(item['Key'])
+            files += 1
+            reclaimed += item['Size']
+
+            # Como mucho 1000 objetos por petición
+            if len(batch) == 1000:
+                delete(batch)
+                batch = []
+
+        if batch:
+            delete(batch)
+
+        return files, reclaimed
+
+def _stat_from_metadata(metadata, size, last_modified = None):
+    ''' Un stat con los campos que usa backup.py. Los objetos subidos sin
+    metadatos (por otro programa, o a mano) no tienen permisos ni dueño, y
+    su fecha es la de la subida, 'last_modified'. '''
+    def field(name):
+        value = metadata.get(name)
+        return int(value) if value is not None else None
+
+    mtime_ns = field('mtime-ns')
+    if mtime_ns is None:
+        mtime_ns = int(last_modified.timestamp() * 1000000) * 1000 if last_modified else 0
+
+    return types.SimpleNamespace(
+        st_size = size or 0,
+        st_mode = field('mode'),
+        st_uid = field('uid'),
+        st_gid = field('gid'),
+        st_mtime_ns = mtime_ns,
+    )
+
+class S3Upload:
+    ''' Fichero de escritura que sube un objeto a medida que se escribe. Los
+    objetos pequeños se suben de una vez al cerrar; los grandes, por partes
+    en los hilos del almacenamiento. El objeto solo aparece en el bucket si
+    se cierra sin errores: si no, la subida se aborta. '''
+
+    def __init__(self, storage, key, metadata):
+        self.storage = storage
+        self.client = storage.client
+        self.key = key
+        self.metadata = metadata
+
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+
+        # Bytes escritos, ya comprimidos
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.written += len(data)
+
+        while len(self.buffer) >= self.storage.part_size:
+            self._upload_part(bytes(self.buffer[:self.storage.part_size]))
+            del self.buffer[:self.storage.part_size]
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket = self.storage.bucket, Key = self.key, Metadata = self.metadata)['UploadId']
+
+        # No dejamos más de MAX_PENDING_PARTS partes en memoria
+        if len(self.parts) >= MAX_PENDING_PARTS:
+            self.parts[-MAX_PENDING_PARTS].result()
+
+        part_number = len(self.parts) + 1
+        self.parts.append(self.storage.pool.submit(self._send_part, part_number, data))
+
+    def _send_part(self, part_number, data):
+        response = self.client.upload_part(Bucket = self.storage.bucket, Key = self.key,
+            UploadId = self.upload_id, PartNumber = part_number, Body = data)
+
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def close(self):
+        if self.upload_id is None:
+            self.client.put_object(Bucket = self.storage.bucket, Key = self.key, Body = bytes(self.buffer), Metadata = self.metadata)
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+
+            parts = [future.result() for future in self.parts]
+            self.client.complete_multipart_upload(Bucket = self.storage.bucket, Key = self.key,
+                UploadId = self.upload_id, MultipartUpload = {'Parts': parts})
+
+        self.buffer = bytearray()
+
+    def abort(self):
+        ''' Descarta la subida, y las partes ya subidas '''
+        if self.upload_id is None:
+            return
+
+        concurrent.futures.wait(self.parts)
+
+        try:
+            self.client.abort_multipart_upload(Bucket = self.storage.bucket, Key = self.key, UploadId = self.upload_id)
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
@@ -0,0 +1,113 @@
+'''
+Almacén de trozos: los cortes dependen solo del contenido, y un manifiesto
+devuelve los mismos datos que se escribieron.
+'''
+
+import sys, os, unittest, tempfile, random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chunkstore
+
+def reference_bits(data):
+    ''' hash_bits() byte a byte: el XOR del byte y los dos anteriores en
+    cada tabla '''
+    tables = chunkstore.TABLES
+    return bytes(
+        tables[0][data[i]] ^ (tables[1][data[i - 1]] if i >= 1 else 0) ^ (tables[2][data[i - 2]] if i >= 2 else 0)
+        for i in range(len(data))
+    )
+
+def text(rnd, size):
+    words = [bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for i in range(rnd.randint(2, 10))) for w in range(2000)]
+    return b' '.join(rnd.choice(words) for w in range(size // 6))[:size]
+
+def cuts(data):
+    offsets = []
+    offset = 0
+    while offset < len(data):
+        offset = chunkstore.cut_point(data, offset, len(data))
+        offsets.append(offset)
+
+    return offsets
+
+class CutPointTest(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(1)
+
+    def test_hash_bits(self):
+        data = self.rnd.randbytes(5000)
+        self.assertEqual(chunkstore.hash_bits(data), reference_bits(data))
+        self.assertEqual(chunkstore.hash_bits(b''), b'')
+
+    def test_cut_point(self):
+        data = text(self.rnd, 2 * 1048576)
+        bits = chunkstore.hash_bits(data)
+
+        offset = 0
+        while offset < len(data):
+            end = chunkstore.cut_point(data, offset, len(data))
+
+            # Con el hash ya calculado, el mismo corte
+            self.assertEqual(chunkstore.cut_point(data, offset, len(data), bits), end)
+            self.assertLessEqual(end - offset, chunkstore.MAX_SIZE)
+            if end < len(data):
+                self.assertGreaterEqual(end - offset, chunkstore.MIN_SIZE)
+
+            offset = end
+
+    def test_content_defined(self):
+        # Insertar unos bytes al principio solo cambia los primeros cortes
+        data = self.rnd.randbytes(2 * 1048576)
+        original = cuts(data)
+        shifted = [offset - 5 for offset in cuts(b'12345' + data)]
+
+        self.assertGreater(len(set(original) & set(shifted)), len(original) - 3)
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = chunkstore.ChunkStore(self.directory.name)
+        self.rnd = random.Random(2)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data, block = 100000):
+        filename = os.path.join(self.directory.name, name + chunkstore.CHUNK_EXTENSION)
+        with self.store.open(filename, 'wb') as f:
+            for i in range(0, len(data), block):
+                f.write(data[i:i + block])
+
+        return filename
+
+    def read(self, filename, block = 70000):
+        data = b''
+        with self.store.open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(block)
+                if not chunk:
+                    break
+                data += chunk
+
+        return data
+
+    def test_round_trip(self):
+        for size in (0, 1, chunkstore.MIN_SIZE, chunkstore.MAX_SIZE + 1, 1500000):
+            data = text(self.rnd, size) if size > 100 else b'x' * size
+            filename = self.write('f{}'.format(size), data)
+
+            self.assertEqual(self.read(filename), data)
+            self.assertEqual(b''.join(self.store.get(h) for h in self.store.referenced(filename)), data)
+
+    def test_same_chunks(self):
+        # La misma secuencia de cortes, se escriba como se escriba
+        data = self.rnd.randbytes(1500000)
+        first = self.store.referenced(self.write('uno', data))
+        second = self.store.referenced(self.write('dos', data, 4096))
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(first), len(cuts(data)))
+
+if __name__ == '__main__':
+    unittest.main()
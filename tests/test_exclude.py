@@ -0,0 +1,36 @@
+'''
+Patrones de exclusión.
+'''
+
+import sys, os, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exclude
+
+class ExcludeMatcherTest(unittest.TestCase):
+    def test_semantics(self):
+        matcher = exclude.ExcludeMatcher(['*.log', 'cache', '/build', 'src/*.c', 'tmp/', '[]]x', 'a[!]]b'])
+
+        self.assertTrue(matcher.match_file('a/b/error.log'))
+        self.assertTrue(matcher.match_dir('a/cache'))
+        self.assertTrue(matcher.match_dir('build'))
+        self.assertFalse(matcher.match_dir('a/build'))
+        self.assertTrue(matcher.match_file('x/src/main.c'))
+        self.assertFalse(matcher.match_file('src/a/main.c'))
+        self.assertFalse(matcher.match_file('x/tmp'))
+        self.assertTrue(matcher.match_dir('x/tmp'))
+        self.assertTrue(matcher.match_file(']x'))
+        self.assertTrue(matcher.match_file('acb'))
+        self.assertFalse(matcher.match_file('a]b'))
+        self.assertFalse(matcher.match_file('a/xcache'))
+
+    def test_invalid(self):
+        for pattern in ('?[a-?]', '[z-a]', 'ok/[9-0]/'):
+            with self.assertRaises(ValueError) as raised:
+                exclude.ExcludeMatcher(['*.tmp', pattern])
+
+            self.assertIn(pattern, str(raised.exception))
+
+if __name__ == '__main__':
+    unittest.main()
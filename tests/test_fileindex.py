@@ -0,0 +1,113 @@
+'''
+El índice: lo que se graba se vuelve a leer igual, con las filas de cada
+directorio, los destinos superados y la sección 'partial' de las copias
+interrumpidas.
+'''
+
+import sys, os, unittest, tempfile, json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fileindex
+
+def entry(size, mtime_ns, target, checksum = None, ino = 7, ctime_ns = 11):
+    return {'size': size, 'mtime_ns': mtime_ns, 'ino': ino, 'ctime_ns': ctime_ns, 'target': target, 'checksum': checksum}
+
+FILES = {
+    'a.txt': entry(10, 1700000000000000001, 'a.txt.gz', 'ab' * 32),
+    'dir/b.txt': entry(0, -5, 'dir/b.txt'),
+    'dir/c.txt': entry(None, 3, 'dir/c.txt.zst', None, None, None),
+    # Empaquetado, renombrado a otro directorio, y con un checksum que no es
+    # un sha256
+    'dir/d.txt': entry(20, 4, 'dir/.backup.pack'),
+    'dir/sub/e.txt': entry(30, 5, 'otro/e.txt.gz', 'no-hex'),
+    'dir/f ñ "x".txt': entry(2 ** 40, 6, 'dir/f ñ "x".txt.bz2', 'cd' * 32, 2 ** 63, 2 ** 62),
+}
+
+class RegistryTest(unittest.TestCase):
+    def test_rows(self):
+        registry = fileindex.Registry.from_dict(FILES)
+        self.assertEqual(dict(registry.items()), FILES)
+
+        copied = fileindex.Registry()
+        for dirname, rows in registry.rows():
+            # Las filas pasan por JSON, como en el fichero del índice
+            copied.add_rows(*json.loads(json.dumps([dirname, rows])))
+
+        self.assertEqual(dict(copied.items()), FILES)
+        self.assertEqual(list(copied), sorted(FILES, key = lambda name: (name.rpartition('/')[0], name)))
+
+    def test_base(self):
+        base = fileindex.Registry.from_dict(FILES)
+        registry = fileindex.Registry(base)
+
+        changed = dict(FILES)
+        changed['dir/b.txt'] = entry(1, 8, 'dir/b.txt')
+        changed['nuevo'] = entry(2, 9, 'nuevo.gz')
+        del changed['a.txt']
+
+        for name, data in changed.items():
+            registry[name] = data
+
+        self.assertEqual(len(registry), len(changed))
+        self.assertEqual(dict(registry.items()), changed)
+        self.assertEqual(dict(base.items()), FILES)
+
+        copied = registry.copy()
+        del copied['dir/c.txt']
+        self.assertEqual(dict(registry.items()), changed)
+        self.assertNotIn('dir/c.txt', copied)
+
+class FileIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, '.backup.index')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_save_load(self):
+        index = fileindex.FileIndex(self.filename)
+        index.set('/origen', '', fileindex.Registry.from_dict(FILES), ['dir/viejo.gz', 'a.txt.bz2'])
+        index.set('/otro', 'g1', fileindex.Registry())
+        index.save()
+
+        with open(self.filename) as f:
+            self.assertEqual(json.loads(f.readline()), {'version': 2})
+
+        loaded = fileindex.FileIndex(self.filename).load()
+        self.assertEqual(dict(loaded.get('/origen').items()), FILES)
+        self.assertEqual(loaded.get_superseded('/origen'), ['a.txt.bz2', 'dir/viejo.gz'])
+        self.assertEqual(loaded.get_superseded('/otro'), [])
+        self.assertEqual(dict(loaded.get('/otro', 'g1').items()), {})
+
+        # De otra copia histórica
+        self.assertIsNone(loaded.get('/otro'))
+
+    def test_partial(self):
+        # El punto de control de una copia histórica interrumpida
+        done = {name: data for name, data in FILES.items() if name.startswith('dir/')}
+
+        index = fileindex.FileIndex(self.filename)
+        index.set('/origen', 'g1', fileindex.Registry.from_dict(FILES))
+        index.set_partial('/origen', 'g2', fileindex.Registry.from_dict(done))
+        index.save()
+
+        loaded = fileindex.FileIndex(self.filename).load()
+        self.assertEqual(dict(loaded.get_partial('/origen', 'g2').items()), done)
+        self.assertIsNone(loaded.get_partial('/origen', 'g3'))
+        self.assertEqual(dict(loaded.get('/origen', 'g1').items()), FILES)
+
+        loaded.clear_partial('/origen')
+        loaded.save()
+        self.assertIsNone(fileindex.FileIndex(self.filename).load().get_partial('/origen', 'g2'))
+
+    def test_corrupt(self):
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps({'version': 2}) + '\n["dir", [["a"]]]\n')
+
+        with self.assertRaises(ValueError):
+            fileindex.FileIndex(self.filename).load()
+
+if __name__ == '__main__':
+    unittest.main()
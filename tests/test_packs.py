@@ -0,0 +1,72 @@
+'''
+Paquetes de ficheros pequeños: cada fichero se extrae igual que se guardó,
+con su stat.
+'''
+
+import sys, os, unittest, tempfile, hashlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import packs
+
+class PacksTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'origen')
+        self.target = os.path.join(self.directory.name, packs.PACK_FILENAME)
+        os.makedirs(os.path.join(self.source, 'dir'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create(self, contents):
+        files = []
+        for name, data in contents.items():
+            with open(os.path.join(self.source, name), 'wb') as f:
+                f.write(data)
+            files.append((name, os.stat(os.path.join(self.source, name))))
+
+        return files
+
+    def test_round_trip(self):
+        contents = {
+            'dir/vacio': b'',
+            'dir/a.html': b'<html><body>' + b'hola ' * 200 + b'</body></html>',
+            'dir/b.html': b'<html><body>' + b'adios ' * 150 + b'</body></html>',
+            'dir/binario': os.urandom(3000),
+        }
+        files = self.create(contents)
+        os.chmod(os.path.join(self.source, 'dir/binario'), 0o640)
+        files = [(name, os.stat(os.path.join(self.source, name))) for name, st in files]
+
+        checksums, errors, metrics = packs.write_pack(self.source, files + [('dir/no-existe', files[0][1])], self.target)
+
+        self.assertEqual([name for name, error in errors], ['dir/no-existe'])
+        self.assertEqual(checksums, {name: hashlib.sha256(data).hexdigest() for name, data in contents.items()})
+        self.assertEqual(metrics['written'], os.path.getsize(self.target))
+
+        reader = packs.PackReader(self.target)
+        self.assertEqual(reader.names(), sorted(name.rpartition('/')[2] for name in contents))
+
+        for name, st in files:
+            base = name.rpartition('/')[2]
+            self.assertEqual(reader.read(base), contents[name])
+
+            stored = reader.stat(base)
+            self.assertEqual((stored.st_size, stored.st_mode, stored.st_mtime_ns), (st.st_size, st.st_mode, st.st_mtime_ns))
+
+    def test_without_dictionary(self):
+        files = self.create({'dir/uno': b'x'})
+        packs.write_pack(self.source, files, self.target)
+
+        self.assertEqual(packs.PackReader(self.target).read('uno'), b'x')
+
+    def test_not_a_pack(self):
+        with open(self.target, 'wb') as f:
+            f.write(b'otra cosa')
+
+        with self.assertRaises(ValueError):
+            packs.PackReader(self.target)
+
+if __name__ == '__main__':
+    unittest.main()
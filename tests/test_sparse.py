@@ -0,0 +1,97 @@
+'''
+Ficheros dispersos: lo que se escribe en el compresor se lee con las
+herramientas de siempre, y se restaura con el mismo contenido.
+'''
+
+import sys, os, unittest, tempfile, hashlib, gzip, io, json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fastcopy, fileindex, sparse, verify, compressors
+
+SIZE = 5 * sparse.BLOCK_SIZE + 1000
+
+class SparseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'disco.img')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create(self, head = b''):
+        ''' Un fichero con dos zonas con datos, y huecos entre ellas '''
+        with open(self.filename, 'wb') as f:
+            f.truncate(SIZE)
+            f.write(head)
+            f.seek(sparse.BLOCK_SIZE + 100)
+            f.write(os.urandom(300000))
+            f.seek(4 * sparse.BLOCK_SIZE)
+            f.write(b'datos' * 1000)
+
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def write(self):
+        ''' Escribe el fichero con sparse.write(). Devuelve una tupla
+        (contenido comprimido con gzip, checksum). '''
+        hasher = fileindex.new_checksum()
+        output = io.BytesIO()
+
+        with open(self.filename, 'rb') as f:
+            extents = fastcopy.data_extents(f.fileno(), SIZE)
+            with gzip.open(output, 'wb') as target:
+                sparse.write(f.fileno(), target, SIZE, extents, hasher = hasher)
+
+        return output.getvalue(), hasher.hexdigest()
+
+    def restore(self, compressed):
+        restored = os.path.join(self.directory.name, 'restaurado')
+
+        with gzip.open(io.BytesIO(compressed)) as source, open(restored, 'wb') as target:
+            is_container, head = sparse.read_magic(source)
+            if is_container:
+                size = sparse.restore(source, target.fileno())
+            else:
+                size = sparse.write_with_holes(source, target.fileno(), head)
+
+        with open(restored, 'rb') as f:
+            return size, f.read()
+
+    def test_plain(self):
+        content = self.create()
+        compressed, checksum = self.write()
+
+        # Se descomprime como cualquier otro fichero
+        self.assertEqual(gzip.decompress(compressed), content)
+        self.assertEqual(checksum, hashlib.sha256(content).hexdigest())
+        self.assertEqual(self.restore(compressed), (SIZE, content))
+
+    def test_magic(self):
+        # Empieza como el contenedor: se guarda dentro de uno
+        content = self.create(sparse.MAGIC)
+        compressed, checksum = self.write()
+
+        self.assertTrue(gzip.decompress(compressed).startswith(sparse.MAGIC))
+        self.assertEqual(checksum, hashlib.sha256(content).hexdigest())
+        self.assertEqual(self.restore(compressed), (SIZE, content))
+
+    def test_container(self):
+        # Un contenedor de las copias anteriores, con huecos
+        content = self.create()
+        extents = [(sparse.BLOCK_SIZE, 400000), (4 * sparse.BLOCK_SIZE, 5000)]
+        header = json.dumps({'size': SIZE, 'extents': extents}).encode()
+        container = sparse.MAGIC + len(header).to_bytes(8, 'big') + header + b''.join(content[start:start + length] for start, length in extents)
+        compressed = gzip.compress(container)
+
+        self.assertEqual(self.restore(compressed), (SIZE, content))
+
+        target = self.filename + '.gz'
+        with open(target, 'wb') as f:
+            f.write(compressed)
+
+        entry = {'size': SIZE, 'checksum': hashlib.sha256(content).hexdigest()}
+        self.assertEqual(verify.verify_file(target, compressors.get_codec('gzip'), entry), (SIZE, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+'''
+El destino S3, con un cliente falso en memoria: los objetos subidos sin los
+metadatos de backup.py (por otro programa, o a mano) se escanean igual.
+'''
+
+import sys, os, unittest, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fileindex, storage
+
+LAST_MODIFIED = datetime.datetime(2024, 5, 1, 12, 30, tzinfo = datetime.timezone.utc)
+
+class FakeClient:
+    ''' Los métodos de un cliente de boto3 que usa S3Storage.scan '''
+    def __init__(self, objects):
+        # Clave => (tamaño, metadatos)
+        self.objects = objects
+
+    def head_object(self, Bucket, Key):
+        size, metadata = self.objects[Key]
+        response = {'ContentLength': size, 'LastModified': LAST_MODIFIED}
+        if metadata is not None:
+            response['Metadata'] = metadata
+
+        return response
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {'Contents': [
+            {'Key': key, 'Size': size, 'LastModified': LAST_MODIFIED}
+            for key, (size, metadata) in sorted(self.objects.items()) if key.startswith(Prefix)
+        ]}
+
+class S3StorageTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient({
+            'copia/con-metadatos.gz': (10, {'mode': '33188', 'uid': '1000', 'gid': '1000', 'mtime-ns': '1700000000123456789'}),
+            'copia/sin-metadatos.gz': (20, None),
+            'copia/metadatos-vacios.gz': (30, {}),
+        })
+        self.storage = storage.S3Storage('s3://bucket/copia', client = self.client)
+
+    def tearDown(self):
+        self.storage.pool.shutdown()
+
+    def test_stat(self):
+        st = self.storage.stat('s3://bucket/copia/con-metadatos.gz')
+        self.assertEqual((st.st_size, st.st_mode, st.st_uid, st.st_mtime_ns), (10, 33188, 1000, 1700000000123456789))
+
+        st = self.storage.stat('s3://bucket/copia/sin-metadatos.gz')
+        self.assertEqual((st.st_size, st.st_mode, st.st_uid), (20, None, None))
+        self.assertEqual(st.st_mtime_ns, int(LAST_MODIFIED.timestamp()) * 1000000000)
+
+    def test_scan(self):
+        errors = []
+        files = dict(self.storage.scan('s3://bucket/copia', lambda name, e: errors.append((name, e))))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(files), ['con-metadatos.gz', 'metadatos-vacios.gz', 'sin-metadatos.gz'])
+
+        # Todos caben en el registro del índice
+        registry = fileindex.Registry()
+        for name, st in files.items():
+            registry[name[:-3]] = fileindex.target_entry(st, name)
+
+        self.assertEqual(registry['sin-metadatos']['mtime_ns'], int(LAST_MODIFIED.timestamp()) * 1000000000)
+        self.assertEqual(registry['con-metadatos']['mtime_ns'], 1700000000123456789)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+'''
+Verificación de cada compresor: un fichero escrito con él se lee entero, y
+su checksum coincide con el del contenido original.
+'''
+
+import sys, os, unittest, tempfile, hashlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compressors, verify
+
+CONTENT = b''.join(hashlib.sha256(bytes([i % 256, i // 256])).digest() * (i % 7 + 1) for i in range(20000))
+
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.target = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, codec_name):
+        codec = compressors.get_codec(codec_name, target = self.target)
+        filename = os.path.join(self.target, 'fichero' + codec.extension)
+
+        with codec.open(filename, 'wb') as f:
+            f.write(CONTENT)
+
+        return codec, filename
+
+    def entry(self):
+        return {'size': len(CONTENT), 'checksum': hashlib.sha256(CONTENT).hexdigest()}
+
+    def check(self, codec_name):
+        codec, filename = self.write(codec_name)
+
+        self.assertEqual(verify.verify_file(filename, codec, self.entry()), (len(CONTENT), None))
+
+        # Un checksum distinto en el índice
+        size, error = verify.verify_file(filename, codec, dict(self.entry(), checksum = '0' * 64))
+        self.assertEqual(size, len(CONTENT))
+        self.assertIsNotNone(error)
+
+    def test_gzip(self):
+        self.check('gzip')
+
+    def test_bzip(self):
+        self.check('bzip')
+
+    def test_store(self):
+        self.check('store')
+
+    def test_chunks(self):
+        self.check('chunks')
+
+    @unittest.skipUnless(compressors.zstandard, "Falta el módulo 'zstandard'")
+    def test_zstd(self):
+        self.check('zstd')
+
+    @unittest.skipUnless(compressors.lz4, "Falta el módulo 'lz4'")
+    def test_lz4(self):
+        self.check('lz4')
+
+    def test_uncompressed(self):
+        filename = os.path.join(self.target, 'fichero')
+        with open(filename, 'wb') as f:
+            f.write(CONTENT)
+
+        self.assertEqual(verify.verify_file(filename, None, self.entry()), (len(CONTENT), None))
+        self.assertIsNotNone(verify.verify_file(filename, None, dict(self.entry(), size = 1))[1])
+
+    def test_truncated(self):
+        codec, filename = self.write('gzip')
+        os.truncate(filename, os.path.getsize(filename) // 2)
+
+        size, error = verify.verify_file(filename, codec, self.entry())
+        self.assertTrue(error.startswith('Ilegible'))
+
+if __name__ == '__main__':
+    unittest.main()
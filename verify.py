@@ -0,0 +1,101 @@
+'''
+Verificación de los ficheros de una copia.
+
+Cada fichero de la copia se lee entero y se descomprime, sin escribirlo en
+ningún sitio. Un fichero cortado o con bits cambiados hace fallar al
+descompresor (gzip, bzip2, zstd y lz4 comprueban su propio CRC), y el
+contenido descomprimido se compara con el checksum que se guardó en el
+índice al copiarlo. Los ficheros sin comprimir se comparan con el tamaño
+guardado; los que no están en el índice solo se leen.
+'''
+
+import contextlib
+
+import fileindex, sparse
+
+# Tamaño de cada lectura
+BLOCK_SIZE = 1048576
+
+def verify_file(filename, codec, entry = None, scheduler = None):
+    ''' Verifica un fichero de la copia. 'codec' es el compresor con que se
+    lee, o None; 'entry', su entrada del índice, si la hay; y las lecturas
+    pasan por 'scheduler' (un iosched.IOScheduler), si se pasa. Se puede
+    ejecutar en un hilo de trabajo: devuelve una tupla (bytes leídos,
+    descripción del error o None). '''
+    hasher = fileindex.new_checksum()
+    size = 0
+    is_container = False
+
+    try:
+        with open(filename, 'rb') as f:
+            source = scheduler.reader(f) if scheduler else f
+
+            # Los manifiestos de trozos se abren por nombre: limitamos sobre
+            # los datos descomprimidos
+            if codec and codec.name == 'chunks':
+                stream = codec.open(filename, 'rb')
+                throttle = scheduler.throttle if scheduler else None
+            elif codec:
+                stream = codec.open(source, 'rb')
+                throttle = None
+            else:
+                stream = contextlib.nullcontext(source)
+                throttle = None
+
+            with stream as stream:
+                data = b''
+                if codec:
+                    is_container, data = sparse.read_magic(stream)
+
+                # El contenedor de las copias anteriores: el checksum es el
+                # del contenido, huecos incluidos
+                if is_container:
+                    size = sparse.hash_container(stream, hasher)
+                else:
+                    while True:
+                        if data:
+                            hasher.update(data)
+                            size += len(data)
+
+                            if throttle:
+                                throttle(len(data))
+
+                        data = stream.read(BLOCK_SIZE)
+                        if not data:
+                            break
+
+            if scheduler:
+                scheduler.done(f.fileno())
+    except Exception as e:
+        return size, 'Ilegible ({}).'.format(str(e) or type(e).__name__)
+
+    return size, _compare(entry, size, hasher.hexdigest(), codec is None)
+
+def verify_packed(reader, name, entry = None, scheduler = None):
+    ''' Como verify_file, para el fichero 'name' del paquete abierto con
+    'reader' (un packs.PackReader) '''
+    try:
+        if scheduler:
+            scheduler.throttle(reader.members[name][1])
+
+        data = reader.read(name)
+    except Exception as e:
+        return 0, 'Ilegible ({}).'.format(str(e) or type(e).__name__)
+
+    hasher = fileindex.new_checksum()
+    hasher.update(data)
+
+    return len(data), _compare(entry, len(data), hasher.hexdigest(), False)
+
+def _compare(entry, size, checksum, uncompressed):
+    if entry is None:
+        return None
+
+    # Sin comprimir, el checksum solo está si lo calculó --checksum
+    if uncompressed and entry.get('size') is not None and entry['size'] != size:
+        return 'El tamaño es {}, y debería ser {}.'.format(size, entry['size'])
+
+    if entry.get('checksum') and entry['checksum'] != checksum:
+        return 'El checksum no coincide con el del índice.'
+
+    return None